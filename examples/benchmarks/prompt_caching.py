@@ -0,0 +1,90 @@
+"""
+Share of prompt tokens served from a provider-side prompt cache, with the "classic" and
+"cacheable" prompt layouts (`Settings.prompt_layout`), against the fake LLM provider
+simulating prefix caching.
+
+    python examples/benchmarks/prompt_caching.py --num-rows 200 --cache-min-tokens 128
+
+The static part of the grading prompts (instructions, few-shot examples and output
+format) is around 500-600 tokens, under the 1024 tokens OpenAI needs before it caches a
+prompt - use a lower `--cache-min-tokens` to model providers with a smaller minimum.
+"""
+
+import argparse
+import warnings
+
+from uptrain import Settings
+from uptrain.operators import (
+    ContextRelevance,
+    ResponseCompletenessWrtContext,
+    ResponseFactualScore,
+)
+from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_fake import FakeAsyncOpenAI, FakeLLMConfig
+
+OPERATORS = {
+    "context_relevance": ContextRelevance,
+    "completeness_wrt_context": ResponseCompletenessWrtContext,
+    "factual_accuracy": ResponseFactualScore,
+}
+
+SCENARIOS = {
+    "no scenario": None,
+    "static scenario": "The responses are generated by a customer support chatbot for an online bookstore.",
+    "scenario with row fields": "The user asked {{question}} to a customer support chatbot for an online bookstore.",
+}
+
+
+def make_data(num_rows: int) -> list[dict]:
+    return [
+        {
+            "question": f"Where is my order number {idx}?",
+            "context": f"Order {idx} was shipped on day {idx % 28 + 1} and will arrive within 5 days. "
+            * 3,
+            "response": f"Your order {idx} is on its way and should arrive within 5 days.",
+        }
+        for idx in range(num_rows)
+    ]
+
+
+def run(operator: str, scenario: str, layout: str, args) -> float:
+    """Fraction of the prompt tokens served from the cache."""
+    settings = Settings(
+        openai_api_key="sk-fake",
+        prompt_layout=layout,
+        response_cache=False,
+        # the fake provider has no rate limits
+        rpm_limit=1_000_000,
+        tpm_limit=1_000_000_000,
+    )
+    aclient = FakeAsyncOpenAI(
+        FakeLLMConfig(
+            prompt_caching=True,
+            cache_min_tokens=args.cache_min_tokens,
+            cache_block_tokens=args.cache_block_tokens,
+        )
+    )
+    op = OPERATORS[operator](scenario_description=SCENARIOS[scenario]).setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+    op.evaluate_local(make_data(args.num_rows))
+    provider = aclient.provider
+    return provider.num_cached_tokens / max(provider.num_prompt_tokens, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-rows", type=int, default=100)
+    parser.add_argument("--cache-min-tokens", type=int, default=128)
+    parser.add_argument("--cache-block-tokens", type=int, default=128)
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+
+    print(f"{'operator':<28}{'scenario':<28}{'classic':>10}{'cacheable':>12}")
+    for operator in OPERATORS:
+        for scenario in SCENARIOS:
+            ratios = [run(operator, scenario, layout, args) for layout in ("classic", "cacheable")]
+            print(f"{operator:<28}{scenario:<28}{ratios[0]:>10.1%}{ratios[1]:>12.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Test EvalLLM evaluating checks locally, against the in-process stand-in for the LLM
+provider. No network access is required.
+"""
+
+import polars as pl
+import pytest
+
+from uptrain import Evals, Settings
+from uptrain.framework import evalllm
+from uptrain.operators import ColumnOp, register_op
+from uptrain.operators.language import llm
+from uptrain.operators.language.llm_fake import FakeAsyncOpenAI
+
+
+@register_op
+class UppercaseResponse(ColumnOp):
+    """Overwrites the response column, and scores every row 1."""
+
+    def setup(self, settings):
+        return self
+
+    def run(self, data):
+        return {
+            "output": data.with_columns(
+                pl.col("response").str.to_uppercase(),
+                pl.lit(1.0).alias("score_uppercase"),
+            )
+        }
+
+
+@register_op
+class ConstantRelevance(ColumnOp):
+    """Scores every row 0.5, under the column of the context relevance check."""
+
+    def setup(self, settings):
+        return self
+
+    def run(self, data):
+        return {"output": data.with_columns(pl.lit(0.5).alias("score_context_relevance"))}
+
+
+@register_op
+class ResponseLength(ColumnOp):
+    """Scores every row with the length of its response."""
+
+    def setup(self, settings):
+        return self
+
+    def run(self, data):
+        return {
+            "output": data.with_columns(
+                pl.col("response").str.len_chars().cast(pl.Float64).alias("score_length")
+            )
+        }
+
+
+@register_op
+class FailingCheck(ColumnOp):
+    def setup(self, settings):
+        return self
+
+    def run(self, data):
+        raise RuntimeError("check failed")
+
+
+DATA = [
+    {
+        "question": f"What is the capital of country {idx}?",
+        "context": f"The capital of country {idx} is city {idx}.",
+        "response": f"City {idx}.",
+    }
+    for idx in range(5)
+]
+
+
+class FakeServer:
+    """Stand-in for the UpTrain server, scoring the rows of every check 0.5 and
+    appending "!" to the responses."""
+
+    def __init__(self):
+        self.calls = []
+
+    def evaluate(self, data, checks, metadata):
+        self.calls.append([check["check_name"] for check in checks])
+        results = []
+        for row in data:
+            row = {**row, "response": row["response"] + "!"}
+            for check in checks:
+                row["score_" + check["check_name"]] = 0.5
+            results.append(row)
+        return results
+
+
+def evaluate_like_baseline(eval_llm, data, checks):
+    """The results of the checks merged into the rows one check at a time, each
+    check's output rows updating the rows, as `EvalLLM.evaluate` used to."""
+    results = [dict(row) for row in data]
+    for check in checks:
+        if isinstance(check, Evals) and check in evalllm.EVAL_TO_OPERATOR_MAPPING:
+            op = evalllm.EVAL_TO_OPERATOR_MAPPING[check].model_copy()
+            res = op.setup(eval_llm.settings).run(pl.DataFrame(data))["output"]
+        elif isinstance(check, Evals):
+            ser_check = {"check_name": check.value, "scenario_description": None}
+            res = pl.DataFrame(
+                eval_llm.evaluate_on_server(data, [ser_check], evalllm.DataSchema())
+            )
+        else:
+            op = evalllm.Check(name="dummy", operators=[check])
+            res = op.setup(eval_llm.settings).run(pl.DataFrame(data))
+        for result, row in zip(results, res.to_dicts()):
+            result.update(row)
+    return results
+
+
+def items(rows):
+    return [list(row.items()) for row in rows]
+
+
+@pytest.fixture
+def fake_clients(monkeypatch):
+    """The fake clients of the LLM clients created, one per operator set up - or one
+    for all the operators sending their requests on the background event loop."""
+    clients = []
+
+    class RecordedFakeAsyncOpenAI(FakeAsyncOpenAI):
+        def __init__(self, **kwargs):
+            super().__init__()
+            clients.append(self)
+
+    monkeypatch.setattr(llm, "AsyncOpenAI", RecordedFakeAsyncOpenAI)
+    return clients
+
+
+@pytest.fixture
+def make_eval_llm(tmp_path, monkeypatch, fake_clients):
+    monkeypatch.setattr(evalllm, "check_openai_api_key", lambda key: True)
+
+    def make(**settings_kwargs):
+        settings_kwargs.setdefault("openai_api_key", "sk-fake")
+        settings = Settings(
+            logs_folder=str(tmp_path),
+            evaluate_locally=True,
+            **settings_kwargs,
+        )
+        return evalllm.EvalLLM(settings)
+
+    return make
+
+
+def test_concurrent_checks(make_eval_llm):
+    checks = [Evals.CONTEXT_RELEVANCE, Evals.RESPONSE_CONCISENESS, UppercaseResponse()]
+    serial = make_eval_llm(max_concurrent_checks=1).evaluate(
+        [dict(row) for row in DATA], checks
+    )
+    concurrent = make_eval_llm(max_concurrent_checks=4).evaluate(
+        [dict(row) for row in DATA], checks
+    )
+
+    # the rows and columns come back in the same order either way
+    assert concurrent == serial
+    assert list(serial[0]) == [
+        "question",
+        "context",
+        "response",
+        "score_context_relevance",
+        "explanation_context_relevance",
+        "score_response_conciseness",
+        "explanation_response_conciseness",
+        "score_uppercase",
+    ]
+    # the last check returning an input column overwrites it
+    assert [row["response"] for row in serial] == [row["response"].upper() for row in DATA]
+    assert all(row["score_uppercase"] == 1.0 for row in serial)
+
+    # a failing check fails the evaluation
+    with pytest.raises(RuntimeError, match="check failed"):
+        make_eval_llm(max_concurrent_checks=4).evaluate(
+            [dict(row) for row in DATA], [Evals.CONTEXT_RELEVANCE, FailingCheck()]
+        )
+
+
+def test_concurrent_checks_share_concurrency_cap(make_eval_llm, monkeypatch):
+    import asyncio
+
+    from uptrain.operators.language import llm_fake
+
+    # the number of requests in flight, and the most there were at once
+    in_flight = {"now": 0, "max": 0}
+    create = llm_fake._FakeCompletions.create
+
+    async def record_in_flight(completions, **kwargs):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        try:
+            await asyncio.sleep(0.01)
+            return await create(completions, **kwargs)
+        finally:
+            in_flight["now"] -= 1
+
+    monkeypatch.setattr(llm_fake._FakeCompletions, "create", record_in_flight)
+    checks = [Evals.CONTEXT_RELEVANCE, Evals.RESPONSE_CONCISENESS, Evals.FACTUAL_ACCURACY]
+    # a key of its own, with rate limits the other tests haven't used up
+    eval_llm = make_eval_llm(
+        openai_api_key="sk-concurrent", max_concurrent_checks=3, max_concurrency=2
+    )
+    eval_llm.evaluate([dict(row) for row in DATA], checks)
+    assert in_flight["max"] == 2
+
+
+def test_results_match_baseline(make_eval_llm):
+    checks = [
+        Evals.CONTEXT_RELEVANCE,
+        UppercaseResponse(),
+        ConstantRelevance(),
+        Evals.RESPONSE_CONCISENESS,
+        Evals.RESPONSE_ALIGNMENT_WITH_SCENARIO,
+    ]
+    # checks run one after another, each with its own fake client as in the baseline -
+    # a fake client shared by concurrent checks samples anew the prompts it has seen
+    eval_llm = make_eval_llm(max_concurrent_checks=1)
+    eval_llm.executor = FakeServer()
+    expected = evaluate_like_baseline(eval_llm, DATA, checks)
+    # every check is given the rows as they were, and returns them with its outputs -
+    # an input column is the one of the last check, here evaluated on the server
+    assert [row["response"] for row in expected] == [row["response"] + "!" for row in DATA]
+    # and a column added by several checks the one of the last of them
+    assert all(row["score_context_relevance"] == 0.5 for row in expected)
+
+    # row by row, with the keys in the same order
+    results = eval_llm.evaluate([dict(row) for row in DATA], checks)
+    assert items(results) == items(expected)
+    frame = eval_llm.evaluate(pl.DataFrame(DATA), checks)
+    assert items(frame) == items(expected)
+    frame = eval_llm.evaluate([dict(row) for row in DATA], checks, return_format="polars")
+    assert isinstance(frame, pl.DataFrame)
+    assert items(frame.to_dicts()) == items(expected)
+
+
+def test_results_evaluated_on_server(make_eval_llm):
+    eval_llm = make_eval_llm()
+    eval_llm.settings.evaluate_locally = False
+    eval_llm.executor = server = FakeServer()
+    checks = [Evals.CONTEXT_RELEVANCE, Evals.RESPONSE_CONCISENESS]
+
+    results = eval_llm.evaluate([dict(row) for row in DATA], checks)
+    assert server.calls == [["context_relevance", "response_conciseness"]]
+    assert items(results) == items(server.evaluate(DATA, server_checks(checks), None))
+    frame = eval_llm.evaluate(pl.DataFrame(DATA), checks, return_format="polars")
+    assert items(frame.to_dicts()) == items(results)
+
+
+def server_checks(checks):
+    return [{"check_name": check.value} for check in checks]
+
+
+def test_shared_sub_evaluations(make_eval_llm, fake_clients):
+    checks = [
+        Evals.RESPONSE_RELEVANCE,
+        Evals.RESPONSE_COMPLETENESS,
+        Evals.RESPONSE_CONCISENESS,
+    ]
+    results, spend = make_eval_llm().evaluate(
+        [dict(row) for row in DATA], checks, return_spend=True
+    )
+
+    # the relevance is graded from the completeness and conciseness of the rows, each
+    # graded once for the three checks, and charged to the first check grading them
+    assert sum(client.provider.num_requests for client in fake_clients) == 2 * len(DATA)
+    assert all(row["score_response_relevance"] is not None for row in results)
+    assert sum(op["tokens"] for op in spend["by_operator"].values()) == spend["total"]["tokens"]
+
+    # checks run one after another, the relevance check grades them all
+    results, spend = make_eval_llm(max_concurrent_checks=1).evaluate(
+        [dict(row) for row in DATA], checks, return_spend=True
+    )
+    assert list(spend["by_operator"]) == ["ResponseRelevance"]
+
+
+def test_results_assembled_from_the_rows(make_eval_llm):
+    eval_llm = make_eval_llm()
+    data = [dict(row) for row in DATA]
+    expected = [{**row, "score_length": float(len(row["response"]))} for row in DATA]
+
+    # the rows come back with the scores added, in the order given
+    results = eval_llm.evaluate(data, [ResponseLength()])
+    assert results == expected
+    assert list(results[0]) == ["question", "context", "response", "score_length"]
+    # and the rows passed in are left as they were
+    assert data == DATA
+
+    # a Polars frame is evaluated as is, and returned as a frame if asked
+    assert eval_llm.evaluate(pl.DataFrame(DATA), [ResponseLength()]) == expected
+    frame = eval_llm.evaluate(data, [ResponseLength()], return_format="polars")
+    assert isinstance(frame, pl.DataFrame)
+    assert frame.to_dicts() == expected
+
+    with pytest.raises(ValueError, match="Unknown return format"):
+        eval_llm.evaluate(data, [ResponseLength()], return_format="pandas")
+
+
+def test_checkpointed_check_overwriting_inputs(tmp_path):
+    from uptrain.framework.checkpoint import CheckpointStore, evaluate_checkpointed
+
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    data = pl.DataFrame({"response": ["a", "b", "c"]})
+    calls = []
+
+    def evaluate(rows):
+        calls.append(rows.height)
+        return rows.with_columns(
+            pl.col("response").str.replace("b", "B"), pl.lit(1.0).alias("score")
+        )
+
+    # the second chunk leaves its input as it was
+    expected = [
+        {"response": "a", "score": 1.0},
+        {"response": "B", "score": 1.0},
+        {"response": "c", "score": 1.0},
+    ]
+    assert evaluate_checkpointed(store, "key", data, evaluate, 2).to_dicts() == expected
+    assert evaluate_checkpointed(store, "key", data, evaluate, 2, resume=True).to_dicts() == expected
+    assert calls == [2, 1]
+
+
+def test_evaluate_resume(make_eval_llm, fake_clients):
+    def num_requests():
+        return sum(client.provider.num_requests for client in fake_clients)
+
+    checks = [Evals.CONTEXT_RELEVANCE, Evals.RESPONSE_CONCISENESS]
+    eval_llm = make_eval_llm(checkpoint=True)
+    eval_llm.evaluate([dict(row) for row in DATA[:3]], checks)
+    assert num_requests() == 2 * 3
+
+    # only the rows added since are graded
+    results = make_eval_llm().evaluate([dict(row) for row in DATA], checks, resume=True)
+    assert num_requests() == 2 * len(DATA)
+    expected = make_eval_llm(max_concurrent_checks=1).evaluate(
+        [dict(row) for row in DATA], checks
+    )
+    assert items(results) == items(expected)
+    assert num_requests() == 2 * 2 * len(DATA)
+
+    # resuming a completed run grades nothing, and gives the same results
+    again = make_eval_llm().evaluate([dict(row) for row in DATA], checks, resume=True)
+    assert num_requests() == 2 * 2 * len(DATA)
+    assert items(again) == items(results)
+
+    # nor are the outputs graded with other settings reused
+    make_eval_llm(truncate_long_prompts=True).evaluate(
+        [dict(row) for row in DATA], checks, resume=True
+    )
+    assert num_requests() == 3 * 2 * len(DATA)
+
+
+def test_interactive_run_goes_first(make_eval_llm, monkeypatch):
+    import threading
+    import time
+
+    from uptrain.operators.language.llm_fake import FakeLLMProvider
+    from uptrain.operators.language.llm_ratelimit import get_shared_limiters
+
+    # the run each request sent belongs to, in the order they were sent
+    sent = []
+    complete = FakeLLMProvider.complete
+
+    def record_run(provider, body):
+        prompt = body["messages"][-1]["content"]
+        sent.append("interactive" if "interactive" in prompt else "bulk")
+        return complete(provider, body)
+
+    monkeypatch.setattr(FakeLLMProvider, "complete", record_run)
+    settings_kwargs = {"rpm_limit": 4, "tpm_limit": 10**9}
+    bulk_llm = make_eval_llm(request_priority="bulk", **settings_kwargs)
+    interactive_llm = make_eval_llm(request_priority="interactive", **settings_kwargs)
+    # both runs wait for the same requests per minute limit, refilled every half second
+    rpm_limiter, _ = get_shared_limiters(bulk_llm.settings, "openai", "sk-fake")
+    monkeypatch.setattr(rpm_limiter, "time_period", 0.5)
+    rpm_limiter.adjust(10**9)
+
+    bulk_data = [
+        {"question": f"bulk question {idx}", "context": "bulk context", "response": "bulk"}
+        for idx in range(40)
+    ]
+    interactive_data = [
+        {"question": f"interactive question {idx}", "context": "interactive context"}
+        for idx in range(4)
+    ]
+    results = {}
+
+    def evaluate(name, eval_llm, data):
+        results[name] = eval_llm.evaluate(data, [Evals.CONTEXT_RELEVANCE])
+
+    bulk = threading.Thread(target=evaluate, args=("bulk", bulk_llm, bulk_data))
+    bulk.start()
+    # the interactive run starts once the bulk one used up the burst and is waiting
+    deadline = time.monotonic() + 10
+    while len(sent) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    interactive = threading.Thread(
+        target=evaluate, args=("interactive", interactive_llm, interactive_data)
+    )
+    interactive.start()
+    interactive.join()
+    bulk.join()
+
+    # the requests of the interactive run go ahead of those of the bulk run waiting
+    assert len(results["bulk"]) == 40 and len(results["interactive"]) == 4
+    last_interactive = max(idx for idx, run in enumerate(sent) if run == "interactive")
+    assert sent[last_interactive + 1 :].count("bulk") >= 30
@@ -0,0 +1,1287 @@
+"""
+Test the LLMMulticlient request pipeline against an in-process stand-in for the
+chat completions API. No network access is required.
+"""
+
+import asyncio
+import os
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from uptrain.framework import Settings
+from uptrain.operators.language.llm import LLMMulticlient
+
+
+class FakeCompletions:
+    def __init__(self, content='{"Choice": "A"}', responder=None):
+        self.content = content
+        self.responder = responder
+        self.calls = []
+        self.loops = set()
+
+    async def create(self, **kwargs):
+        kwargs.pop("timeout", None)
+        self.calls.append(kwargs)
+        self.loops.add(asyncio.get_running_loop())
+        await asyncio.sleep(0.01)
+        contents = self.content if self.responder is None else self.responder(kwargs)
+        if isinstance(contents, str):
+            contents = [contents]
+        return ChatCompletion.model_validate(
+            {
+                "id": f"fake-{len(self.calls)}",
+                "object": "chat.completion",
+                "created": 0,
+                "model": kwargs["model"],
+                "choices": [
+                    {
+                        "index": idx,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                    for idx, content in enumerate(contents)
+                ],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 5,
+                    "total_tokens": 15,
+                },
+            }
+        )
+
+
+class FakeAsyncClient:
+    def __init__(self, **kwargs):
+        self.completions = FakeCompletions(**kwargs)
+        self.chat = self
+
+
+def make_client(tmp_path, **settings_kwargs):
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        **settings_kwargs,
+    )
+    aclient = FakeAsyncClient()
+    return LLMMulticlient(settings, aclient=aclient), aclient.completions
+
+
+def test_response_cache(tmp_path):
+    client, completions = make_client(tmp_path, response_cache=True)
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(3)]
+    outputs = client.fetch_responses(payloads)
+    assert len(completions.calls) == 3
+    assert all(res.response.choices[0].message.content == '{"Choice": "A"}' for res in outputs)
+    assert os.path.exists(os.path.join(tmp_path, "llm_response_cache.sqlite"))
+
+    # a second client with the same settings is served from disk
+    client_2, completions_2 = make_client(tmp_path, response_cache=True)
+    payloads = [client_2.make_payload(idx, f"prompt {idx}") for idx in range(3)]
+    outputs = client_2.fetch_responses(payloads)
+    assert len(completions_2.calls) == 0
+    assert all(res.metadata.get("cached") for res in outputs)
+    assert outputs[0].response.choices[0].message.content == '{"Choice": "A"}'
+    assert client_2._cache.stats()["hits"] == 3
+
+
+def test_response_cache_skips_invalid_responses(tmp_path):
+    client, completions = make_client(tmp_path, response_cache=True)
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(2)]
+    client.fetch_responses(payloads, validate_func=lambda output: "Score" in output)
+    # every retry failed the validation, none of the responses is kept
+    assert len(completions.calls) == 2 * client._max_tries
+    assert client._cache.stats()["entries"] == 0
+
+    # the cache is shared per file, with the limits of the latest settings
+    client_2, _ = make_client(
+        tmp_path, response_cache=True, response_cache_ttl=60, response_cache_max_entries=10
+    )
+    assert client_2._cache is client._cache
+    assert (client_2._cache.ttl, client_2._cache.max_entries) == (60, 10)
+
+
+def test_request_coalescing(tmp_path):
+    client, completions = make_client(tmp_path, coalesce_requests=True)
+    payloads = [client.make_payload(idx, f"prompt {idx % 2}") for idx in range(6)]
+    outputs = client.fetch_responses(payloads)
+    assert len(completions.calls) == 2
+    assert client.num_coalesced_requests == 4
+    assert sorted(res.metadata["index"] for res in outputs) == list(range(6))
+    assert all(res.response is not None for res in outputs)
+
+    # requests sampling several choices each get their own samples
+    payloads = [client.make_payload(idx, "prompt 0", n=3) for idx in range(2)]
+    client.fetch_responses(payloads)
+    assert len(completions.calls) == 4
+    assert client.num_coalesced_requests == 4
+
+
+def test_token_budget_settled_from_usage(tmp_path):
+    from uptrain.operators.language.llm import async_process_payload
+    from uptrain.operators.language.llm_ratelimit import TokenBucketLimiter
+
+    client, completions = make_client(tmp_path)
+    payload = client.make_payload(0, "How many sonnets did Shakespeare write?")
+
+    async def run():
+        rpm_limiter = TokenBucketLimiter(100, time_period=60)
+        tpm_limiter = TokenBucketLimiter(10_000, time_period=60)
+        await async_process_payload(
+            payload,
+            rpm_limiter,
+            tpm_limiter,
+            client.aclient,
+            max_retries=1,
+            completion_tokens_reserve=1000,
+        )
+        return tpm_limiter._level
+
+    # the fake API reports 15 tokens used, so the 1000 token reservation is refunded
+    assert asyncio.run(run()) <= 15
+
+
+def test_adaptive_concurrency_controller():
+    from uptrain.operators.language.llm_ratelimit import (
+        AdaptiveConcurrencyController,
+        backoff_delay,
+        parse_retry_after,
+    )
+
+    controller = AdaptiveConcurrencyController(initial_concurrency=4, max_concurrency=8)
+    for _ in range(10):
+        controller.on_success({})
+    assert controller.limit == 8
+
+    delay = controller.on_throttle({"retry-after": "2"}, attempt=0)
+    assert controller.limit == 4
+    assert 2 <= delay <= 3
+    # throttles of requests sent before the decrease don't shrink it further
+    controller.on_throttle({}, attempt=0)
+    assert controller.limit == 4
+
+    # without a hint, the retries of a throttled request span the one minute window
+    # of the rate limits, other errors are retried sooner
+    for _ in range(100):
+        waits = [controller.on_throttle({}, attempt) for attempt in range(3)]
+        assert 60 <= sum(waits) <= 120
+        assert sum(backoff_delay(attempt, throttled=True) for attempt in range(3)) >= 60
+        assert sum(backoff_delay(attempt) for attempt in range(3)) <= 7
+
+    assert parse_retry_after({"retry-after-ms": "250"}) == 0.25
+    assert parse_retry_after({"x-ratelimit-reset-requests": "1m30s"}) == 90
+
+
+def test_concurrency_controller_across_loops():
+    from uptrain.operators.language.llm_ratelimit import AdaptiveConcurrencyController
+
+    controller = AdaptiveConcurrencyController(max_concurrency=1, adaptive=False)
+    peak = {"in_flight": 0, "max": 0}
+
+    async def request():
+        async with controller.slot():
+            peak["in_flight"] += 1
+            peak["max"] = max(peak["max"], peak["in_flight"])
+            await asyncio.sleep(0.01)
+            peak["in_flight"] -= 1
+
+    # a slot held on one loop survives the controller being used on another
+    loop = asyncio.new_event_loop()
+    try:
+        held = controller.slot()
+        loop.run_until_complete(held.__aenter__())
+        asyncio.run(request())
+        loop.run_until_complete(held.__aexit__(None, None, None))
+
+        async def requests():
+            await asyncio.gather(*[request() for _ in range(3)])
+
+        loop.run_until_complete(requests())
+    finally:
+        loop.close()
+    assert peak["max"] == 1
+
+    # without a bound, slots don't wait
+    unbounded = AdaptiveConcurrencyController(max_concurrency=None, adaptive=False)
+    assert unbounded.limit == float("inf")
+
+
+def test_shared_rate_limiters(tmp_path):
+    from uptrain.operators.language.llm_ratelimit import (
+        SqliteTokenBucketLimiter,
+        get_shared_limiters,
+    )
+
+    settings = Settings(openai_api_key="sk-fake", logs_folder=str(tmp_path))
+    rpm_limiter, tpm_limiter = get_shared_limiters(settings, "openai", "sk-fake")
+    assert get_shared_limiters(settings, "openai", "sk-fake") == (rpm_limiter, tpm_limiter)
+    assert get_shared_limiters(settings, "openai", "sk-other")[0] is not rpm_limiter
+
+    # the sqlite backend shares the bucket across limiter instances (and processes)
+    fpath = str(tmp_path / "limits.sqlite")
+    limiter_a = SqliteTokenBucketLimiter(fpath, "bucket", max_rate=10)
+    limiter_b = SqliteTokenBucketLimiter(fpath, "bucket", max_rate=10)
+    asyncio.run(limiter_a.acquire(8))
+    assert limiter_b._try_acquire(5) > 0
+    limiter_b.adjust(6)
+    assert limiter_b._try_acquire(5) == 0
+
+    # waiting on another process for the database lock doesn't block the event loop
+    import sqlite3
+
+    other_process = sqlite3.connect(fpath, isolation_level=None)
+    other_process.execute("BEGIN IMMEDIATE")
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.2, other_process.execute, "COMMIT")
+        ticks = 0
+        acquire = asyncio.ensure_future(limiter_a.acquire(1))
+        while not acquire.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        await acquire
+        return ticks
+
+    assert asyncio.run(run()) >= 10
+    other_process.close()
+
+
+def test_background_event_loop_reused(tmp_path):
+    client, completions = make_client(tmp_path, persistent_event_loop=True)
+    client.fetch_responses([client.make_payload(0, "first call")])
+    client.fetch_responses([client.make_payload(0, "second call")])
+    assert len(completions.loops) == 1
+
+    client, completions = make_client(tmp_path)
+    client.fetch_responses([client.make_payload(0, "first call")])
+    client.fetch_responses([client.make_payload(0, "second call")])
+    assert len(completions.loops) == 2
+
+
+def test_background_event_loop_after_fork():
+    import signal
+    import time
+
+    import pytest
+
+    from uptrain.utilities import get_background_loop
+
+    if not hasattr(os, "fork"):
+        pytest.skip("os.fork isn't available")
+    background_loop = get_background_loop()
+    assert background_loop.run(asyncio.sleep(0, result=1)) == 1
+
+    pid = os.fork()
+    if pid == 0:
+        # the child doesn't have the thread running the loop of the parent
+        try:
+            result = background_loop.run(asyncio.sleep(0, result=2), timeout=5)
+            os._exit(0 if result == 2 else 1)
+        except BaseException:
+            os._exit(1)
+
+    deadline = time.monotonic() + 10
+    while True:
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    if not finished:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    assert finished and os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_async_clients_closed_with_their_loop(tmp_path, monkeypatch):
+    from uptrain.operators.language import llm
+
+    created = []
+
+    class RecordingAsyncOpenAI(llm.AsyncOpenAI):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            created.append(self)
+
+    monkeypatch.setattr(llm, "AsyncOpenAI", RecordingAsyncOpenAI)
+    client, _ = make_client(
+        tmp_path, hedge_requests=True, hedge_api_base="http://localhost:1/v1"
+    )
+    for _ in range(2):
+        client.fetch_responses([client.make_payload(0, "prompt")])
+    # one hedging client per call, closed along with the event loop of the call
+    assert len(created) == 2
+    assert all(aclient.is_closed() for aclient in created)
+
+
+def test_iter_responses(tmp_path):
+    client, completions = make_client(tmp_path)
+    payloads = (client.make_payload(idx, f"prompt {idx}") for idx in range(10))
+    outputs = list(client.iter_responses(payloads, max_pending=3))
+    assert sorted(res.metadata["index"] for res in outputs) == list(range(10))
+    assert all(res.response is not None for res in outputs)
+
+    # breaking out early cancels the remaining requests
+    payloads = [client.make_payload(idx, f"other prompt {idx}") for idx in range(10)]
+    for res in client.iter_responses(payloads, max_pending=2):
+        break
+    assert len(completions.calls) < 20
+
+
+def test_batch_execution_mode(tmp_path):
+    from uptrain.operators.language.llm_batch import LocalBatchProvider
+
+    settings = Settings(
+        openai_api_key="sk-fake", logs_folder=str(tmp_path), execution_mode="batch"
+    )
+    responder = lambda body: '{"Choice": "B"}' if "bad" not in body["messages"][0]["content"] else "oops"
+    provider = LocalBatchProvider(responder, str(tmp_path / "provider"))
+    aclient = FakeAsyncClient()
+    client = LLMMulticlient(settings, aclient=aclient, batch_provider=provider)
+
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(4)]
+    payloads.append(client.make_payload(4, "bad prompt"))
+    outputs = client.fetch_responses(
+        payloads, validate_func=lambda output: output["Choice"] in ["A", "B"]
+    )
+    assert [res.metadata["index"] for res in outputs] == list(range(5))
+    assert all(res.error is None for res in outputs)
+    assert outputs[0].response.choices[0].message.content == '{"Choice": "B"}'
+    # the request that failed validation in the batch was retried online
+    assert len(aclient.completions.calls) == 1
+    assert outputs[4].response.choices[0].message.content == '{"Choice": "A"}'
+
+
+def test_batch_partial_results(tmp_path):
+    from uptrain.operators.language.llm_batch import LocalBatchProvider
+
+    class ExpiringBatchProvider(LocalBatchProvider):
+        """Batches expire with only the first 3 requests completed."""
+
+        async def status(self, batch_id):
+            return "expired"
+
+        async def download_results(self, batch_id, fpath):
+            await super().download_results(batch_id, fpath)
+            with open(fpath) as f:
+                lines = f.readlines()[:3]
+            with open(fpath, "w") as f:
+                f.writelines(lines)
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        execution_mode="batch",
+        custom_llm_provider="openai",
+        api_base="http://localhost:1/v1",
+    )
+    bodies = []
+
+    def responder(body):
+        bodies.append(body)
+        return '{"Choice": "B"}'
+
+    provider = ExpiringBatchProvider(responder, str(tmp_path / "provider"))
+    aclient = FakeAsyncClient()
+    client = LLMMulticlient(settings, aclient=aclient, batch_provider=provider)
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(5)]
+    outputs = client.fetch_responses(payloads)
+
+    # the results of the expired batch are kept, only the missing requests are sent
+    # again online
+    assert all(res.error is None for res in outputs)
+    contents = [res.response.choices[0].message.content for res in outputs]
+    assert contents == ['{"Choice": "B"}'] * 3 + ['{"Choice": "A"}'] * 2
+    assert len(aclient.completions.calls) == 2
+    # the batch requests hold only the keys of the API
+    assert not any("custom_llm_provider" in body or "api_base" in body for body in bodies)
+    # and the request and result files are removed once read
+    assert os.listdir(tmp_path / "batches") == []
+
+
+def test_batch_execution_telemetry_and_budget(tmp_path):
+    from uptrain.operators.language.llm_batch import LocalBatchProvider
+    from uptrain.operators.language.llm_budget import BudgetTracker, budget_context
+    from uptrain.operators.language.llm_metrics import summarize_payloads
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        execution_mode="batch",
+        completion_tokens_reserve=10,
+    )
+    responder = lambda body: '{"Choice": "B"}' if "bad" not in body["messages"][0]["content"] else "oops"
+    validate_func = lambda output: output["Choice"] in ["A", "B"]
+
+    def make_client(budget):
+        provider = LocalBatchProvider(responder, str(tmp_path / "provider"))
+        with budget_context(budget):
+            return LLMMulticlient(settings, aclient=FakeAsyncClient(), batch_provider=provider)
+
+    # every payload has its telemetry recorded once, the online retry included
+    budget = BudgetTracker()
+    client = make_client(budget)
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(4)]
+    payloads.append(client.make_payload(4, "bad prompt"))
+    outputs = client.fetch_responses(payloads, validate_func)
+    stats = summarize_payloads(outputs)[settings.model]
+    assert stats["requests"] == 5 and stats["failures"] == 0
+    assert stats["attempts"] == 6 and stats["validation_failures"] == 1
+    # the batch responses report no usage, so their estimate is charged
+    assert budget.spend()["total"]["tokens"] > 15
+
+    # requests past the budget aren't submitted
+    budget = BudgetTracker(max_tokens=70)
+    client = make_client(budget)
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(5)]
+    outputs = client.fetch_responses(payloads, validate_func)
+    exceeded = [res for res in outputs if res.metadata.get("budget_exceeded")]
+    assert 0 < len(exceeded) < 5 and all(res.response is None for res in exceeded)
+    assert 0 < budget.spend()["total"]["tokens"] <= 70
+
+
+def test_multi_row_prompt_packing(tmp_path):
+    import json
+    from uptrain.operators import ContextRelevance
+
+    def responder(body):
+        prompt = body["messages"][0]["content"]
+        if "Row 1:" not in prompt:
+            return '{"Reasoning": "single row", "Choice": "C"}'
+        num_rows = prompt.count("\nRow ")
+        if "broken" in prompt:
+            return "[{]"
+        return json.dumps(
+            [{"Row": num, "Reasoning": "packed", "Choice": "A"} for num in range(1, num_rows + 1)]
+        )
+
+    settings = Settings(
+        openai_api_key="sk-fake", logs_folder=str(tmp_path), rows_per_request=4
+    )
+    aclient = FakeAsyncClient(responder=responder)
+    op = ContextRelevance().setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+
+    data = [{"question": f"question {idx}", "context": f"context {idx}"} for idx in range(6)]
+    data.append({"question": "broken question", "context": "context"})
+    results = op.evaluate_local(data)
+
+    # 2 packed requests, and the 3 rows of the chunk with the unparseable output are
+    # graded one per request
+    prompts = [call["messages"][0]["content"] for call in aclient.completions.calls]
+    assert len(prompts) == 5
+    packed_prompts = [prompt for prompt in prompts if "Row 1:" in prompt]
+    assert len(packed_prompts) == 2
+    assert sum("Row 4:" in prompt for prompt in packed_prompts) == 1
+    assert all(prompt.count("Example Data.") == 1 for prompt in packed_prompts)
+    assert [res["score_context_relevance"] for res in results] == [1.0] * 4 + [0.0] * 3
+
+
+def test_prompt_packing_with_layout_and_samples(tmp_path):
+    import json
+    from uptrain.operators import ContextRelevance
+
+    def responder(body):
+        prompt = body["messages"][-1]["content"]
+        if "Row 1:" not in prompt:
+            return '{"Reasoning": "single row", "Choice": "A"}'
+        rows = range(1, prompt.count("\nRow ") + 1)
+        # the second sample only grades the first row
+        return [
+            json.dumps([{"Row": num, "Reasoning": "", "Choice": "A"} for num in rows]),
+            json.dumps([{"Row": 1, "Reasoning": "", "Choice": "C"}]),
+            json.dumps([{"Row": num, "Reasoning": "", "Choice": "B"} for num in rows]),
+        ]
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        rows_per_request=4,
+        prompt_layout="cacheable",
+        num_samples=3,
+    )
+    aclient = FakeAsyncClient(responder=responder)
+    op = ContextRelevance().setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+
+    data = [{"question": f"question {idx}", "context": f"context {idx}"} for idx in range(4)]
+    results = op.evaluate_local(data)
+
+    # one packed request, with the instructions in the system message and 3 samples
+    (call,) = aclient.completions.calls
+    assert [message["role"] for message in call["messages"]] == ["system", "user"]
+    assert "Example Data." in call["messages"][0]["content"]
+    assert "Row 4:" in call["messages"][1]["content"]
+    assert call["n"] == 3
+    # the sample that doesn't cover all the rows is left out of the vote
+    assert [res["score_context_relevance"] for res in results] == [1.0] * 4
+    assert [res["confidence_context_relevance"] for res in results] == [0.5] * 4
+
+    # cascaded grading scores the rows one per request
+    settings.cascade_model = "gpt-4"
+    aclient.completions.calls.clear()
+    op.evaluate_local(
+        [{"question": f"question {idx}", "context": f"context {idx}"} for idx in range(2)]
+    )
+    assert not any("Row 1:" in call["messages"][-1]["content"] for call in aclient.completions.calls)
+
+
+def test_context_window_preflight(tmp_path):
+    from uptrain.operators.language.llm_tokens import HeuristicTokenCounter
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        completion_tokens_reserve=100,
+        model_context_windows={"gpt-3.5-turbo": 1000, "gpt-4-32k": 32_768},
+    )
+    counter = HeuristicTokenCounter()
+    client = LLMMulticlient(settings, aclient=FakeAsyncClient(), token_counter=counter)
+    prompt = "Grade the context.\n\nTask Data.\n[Question]: {question}\n[Context]: {context}\n"
+    long_prompt = prompt.format(question="What is the capital of France?", context="Paris " * 1000)
+
+    # prompts are sent as is unless truncation is turned on
+    payload = client.make_payload(0, long_prompt)
+    assert "truncated" not in payload.metadata
+    assert payload.data["messages"][0]["content"] == long_prompt
+    settings.truncate_long_prompts = True
+
+    payload = client.make_payload(0, prompt.format(question="Why?", context="Because."))
+    assert "truncated" not in payload.metadata
+
+    # the context is cut so the prompt and completion fit in the window
+    payload = client.make_payload(0, long_prompt)
+    assert payload.metadata["truncated"]
+    content = payload.data["messages"][0]["content"]
+    assert "[Question]: What is the capital of France?" in content
+    assert counter.count_messages(payload.data["messages"], "gpt-3.5-turbo") + 100 <= 1000
+
+    # with a long context model configured, the prompt is routed there instead
+    settings.long_context_model = "gpt-4-32k"
+    payload = client.make_payload(0, long_prompt)
+    assert payload.data["model"] == "gpt-4-32k"
+    assert payload.metadata["routed_to_long_context_model"]
+    assert payload.data["messages"][0]["content"] == long_prompt
+
+
+def test_hedged_requests(tmp_path):
+    class StragglerCompletions(FakeCompletions):
+        async def create(self, **kwargs):
+            if "straggler" in kwargs["messages"][0]["content"] and not any(
+                "straggler" in call["messages"][0]["content"] for call in self.calls
+            ):
+                self.calls.append(kwargs)
+                await asyncio.sleep(5)
+            return await super().create(**kwargs)
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        hedge_requests=True,
+        hedge_min_delay=0.1,
+    )
+    aclient = FakeAsyncClient()
+    aclient.completions = StragglerCompletions()
+    client = LLMMulticlient(settings, aclient=aclient)
+
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(3)]
+    payloads.append(client.make_payload(3, "straggler prompt"))
+    outputs = client.fetch_responses(payloads)
+    assert all(res.response is not None for res in outputs)
+    assert outputs[3].metadata["hedged"]
+    assert client._hedger.num_hedges_issued == 1
+    assert client._hedger.num_hedges_won == 1
+
+
+def test_client_pool_routing(tmp_path):
+    class FailingCompletions(FakeCompletions):
+        async def create(self, **kwargs):
+            self.calls.append(kwargs)
+            raise RuntimeError("deployment is down")
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        client_pool=[
+            {"api_key": "sk-a", "api_base": "http://a/v1", "weight": 2},
+            {"api_key": "sk-b", "api_base": "http://b/v1", "model": "gpt-35-deployment"},
+            {"api_key": "sk-c", "api_base": "http://c/v1"},
+        ],
+    )
+    client = LLMMulticlient(settings, aclient=FakeAsyncClient())
+    member_a, member_b, member_c = client._pool.members
+    member_a.aclient, member_b.aclient = FakeAsyncClient(), FakeAsyncClient()
+    member_c.aclient = FakeAsyncClient()
+    member_c.aclient.completions = FailingCompletions()
+
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(40)]
+    outputs = client.fetch_responses(payloads)
+    assert all(res.error is None and res.response is not None for res in outputs)
+
+    # the failing member is taken out of rotation, its requests go to the others
+    assert not member_c.is_healthy()
+    assert len(member_c.aclient.completions.calls) == client._pool.failure_threshold
+    calls_a = len(member_a.aclient.completions.calls)
+    calls_b = len(member_b.aclient.completions.calls)
+    assert calls_a + calls_b == 40
+    assert calls_a > calls_b > 0
+    assert all(call["model"] == "gpt-35-deployment" for call in member_b.aclient.completions.calls)
+
+
+def test_client_pool_clients_closed_with_their_loop(tmp_path, monkeypatch):
+    from uptrain.operators.language import llm
+
+    created = []
+
+    class RecordingAsyncClient(FakeAsyncClient):
+        def __init__(self, **kwargs):
+            super().__init__()
+            self.kwargs = kwargs
+            self.closed = False
+            created.append(self)
+
+        async def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(llm, "AsyncOpenAI", RecordingAsyncClient)
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        client_pool=[
+            {"api_key": "sk-a", "api_base": "http://a/v1"},
+            {"api_key": "sk-b", "api_base": "http://b/v1"},
+        ],
+    )
+    client = LLMMulticlient(settings)
+    for _ in range(2):
+        payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(10)]
+        client.fetch_responses(payloads)
+
+    # one client per member and call, closed along with the event loop of the call
+    members = [aclient for aclient in created if aclient.kwargs.get("base_url")]
+    assert len(members) == 2 * 2
+    assert sum(len(aclient.completions.calls) for aclient in members) == 2 * 10
+    assert all(aclient.closed for aclient in members)
+
+
+def test_fake_llm_provider(tmp_path):
+    import json
+    from uptrain.operators import ContextRelevance, PromptInjectionScore
+    from uptrain.operators.language.llm_fake import (
+        FakeAsyncOpenAI,
+        FakeLLMConfig,
+        FakeLLMServer,
+    )
+
+    data = [{"question": f"question {idx}", "context": f"context {idx}", "response": f"response {idx}"} for idx in range(20)]
+
+    # in-process, with throttling and server errors that are retried
+    settings = Settings(openai_api_key="sk-fake", logs_folder=str(tmp_path))
+    aclient = FakeAsyncOpenAI(FakeLLMConfig(rate_limit_rate=0.15, error_rate=0.05, retry_after=0))
+    op = ContextRelevance().setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+    results = op.evaluate_local([dict(row) for row in data])
+    assert all(res["score_context_relevance"] in (0.0, 0.5, 1.0) for res in results)
+    num_failed = aclient.provider.num_rate_limited + aclient.provider.num_errors
+    assert num_failed > 0
+    assert aclient.provider.num_requests == 20 + num_failed
+    # the outputs are reproducible
+    aclient_2 = FakeAsyncOpenAI(FakeLLMConfig(rate_limit_rate=0.15, error_rate=0.05, retry_after=0))
+    op._api_client = LLMMulticlient(settings, aclient=aclient_2)
+    assert op.evaluate_local([dict(row) for row in data]) == results
+
+    # over HTTP, with packed prompts
+    with FakeLLMServer(FakeLLMConfig(latency_mean=0.01, latency_distribution="exponential")) as server:
+        settings = Settings(
+            openai_api_key="sk-fake",
+            logs_folder=str(tmp_path),
+            rows_per_request=5,
+            client_pool=[{"api_key": "sk-fake", "api_base": server.base_url}],
+        )
+        op = PromptInjectionScore().setup(settings)
+        results = op.evaluate_local([dict(row) for row in data])
+        assert all(res["score_prompt_injection"] in (0.0, 1.0) for res in results)
+        assert server.provider.num_requests == 4
+
+
+def test_request_telemetry(tmp_path):
+    from uptrain.operators.language.llm_fake import FakeAsyncOpenAI, FakeLLMConfig
+    from uptrain.operators.language.llm_metrics import (
+        MetricsRegistry,
+        operator_context,
+        register_metrics_hook,
+        unregister_metrics_hook,
+    )
+
+    settings = Settings(
+        openai_api_key="sk-fake", logs_folder=str(tmp_path), coalesce_requests=True
+    )
+    aclient = FakeAsyncOpenAI(
+        FakeLLMConfig(latency_mean=0.02, rate_limit_rate=0.3, retry_after=0)
+    )
+    client = LLMMulticlient(settings, aclient=aclient)
+    registry = MetricsRegistry()
+    register_metrics_hook(registry)
+    try:
+        with operator_context("MyCheck"):
+            payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(10)]
+        payloads.append(client.make_payload(10, "prompt 0"))  # coalesced with the first
+        outputs, summary = client.fetch_responses(payloads, return_summary=True)
+    finally:
+        unregister_metrics_hook(registry)
+
+    # either of the identical requests can be the one sent upstream
+    leader, follower = sorted([outputs[0], outputs[10]], key=lambda res: res.telemetry.coalesced)
+    assert follower.telemetry.coalesced and follower.telemetry.attempts == 0
+    telemetry = leader.telemetry
+    assert telemetry.success and telemetry.attempts == 1 + telemetry.throttles
+    assert telemetry.prompt_tokens > 0 and telemetry.total_time >= telemetry.latency > 0
+    assert outputs[1].telemetry.operator == "MyCheck" and outputs[10].telemetry.operator is None
+
+    stats = summary[f"{settings.model}/MyCheck"]
+    assert stats["requests"] == 10 and stats["failures"] == 0
+    assert stats["coalesced"] + summary[settings.model]["coalesced"] == 1
+    assert stats["throttles"] + summary[settings.model]["throttles"] == aclient.provider.num_rate_limited
+    assert stats["attempts"] + summary[settings.model]["attempts"] == aclient.provider.num_requests
+    assert stats["total_seconds"]["count"] == 10
+    assert summary["wall_time"] > 0
+    assert registry.summary() == {k: v for k, v in summary.items() if k != "wall_time"}
+
+    exposition = registry.to_prometheus()
+    assert f'uptrain_llm_requests_total{{model="{settings.model}",operator="MyCheck"}} 10' in exposition
+    assert "# TYPE uptrain_llm_latency_seconds histogram" in exposition
+    assert 'operator="MyCheck",le="+Inf"} 10' in exposition
+
+
+def test_histogram_quantiles_within_observations():
+    from uptrain.operators.language.llm_metrics import Histogram
+
+    # sub-millisecond latencies all fall in the first bucket, up to 0.05s
+    histogram = Histogram()
+    for value in (0.0002, 0.0004, 0.0006, 0.0008):
+        histogram.observe(value)
+    summary = histogram.summary()
+    assert summary["max"] == 0.0008
+    assert all(0 < summary[name] <= 0.0008 for name in ("p50", "p95", "p99"))
+
+    # values interpolated within a bucket stay ordered and in range
+    histogram = Histogram()
+    for value in (0.3, 0.3, 0.3, 0.7):
+        histogram.observe(value)
+    assert 0.25 <= histogram.quantile(0.5) <= 0.5
+    assert histogram.quantile(0.5) <= histogram.quantile(0.99) <= 0.7
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_budget_enforcement(tmp_path):
+    from uptrain.operators.language.llm_budget import (
+        BudgetTracker,
+        budget_context,
+        compute_cost,
+    )
+    from uptrain.operators.language.llm_metrics import operator_context
+
+    assert compute_cost("gpt-4-0613", 1_000_000, 0) == 30.0
+    assert compute_cost("azure/gpt-4o-mini", 0, 1_000_000) == 0.6
+    assert compute_cost("my-model", 1000, 1000) == 0.0
+
+    # spend is tracked from the usage of the responses, per operator and model
+    budget = BudgetTracker()
+    with budget_context(budget):
+        client, completions = make_client(tmp_path)
+    with operator_context("MyCheck"):
+        payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(4)]
+    client.fetch_responses(payloads)
+    spend = budget.spend()
+    assert spend["total"]["tokens"] == 4 * 15
+    assert spend["by_operator"]["MyCheck"]["prompt_tokens"] == 4 * 10
+    assert spend["by_model"]["gpt-3.5-turbo"]["cost"] == compute_cost("gpt-3.5-turbo", 40, 20)
+
+    # once the run budget is used up, the remaining requests aren't sent, and the
+    # responses already paid for are returned with the rest
+    client, completions = make_client(tmp_path, max_run_tokens=100, completion_tokens_reserve=5)
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(20)]
+    outputs = client.fetch_responses(payloads)
+    assert 0 < len(completions.calls) < 20
+    assert client._budget.spend()["total"]["tokens"] <= 100
+    assert sorted(res.metadata["index"] for res in outputs) == list(range(20))
+    sent = [res for res in outputs if not res.metadata.get("budget_exceeded")]
+    assert len(sent) == len(completions.calls)
+    assert all(res.response is not None and res.error is None for res in sent)
+    dropped = [res for res in outputs if res.metadata.get("budget_exceeded")]
+    assert all(res.response is None and "budget" in res.error for res in dropped)
+
+    # per operator budgets, with a cheaper model past the threshold
+    client, completions = make_client(
+        tmp_path,
+        model="gpt-4",
+        operator_budgets={"MyCheck": {"max_cost": 0.01}},
+        budget_fallback_model="gpt-4o-mini",
+        budget_degrade_at=0.01,
+    )
+    with operator_context("MyCheck"):
+        payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(3)]
+    outputs = client.fetch_responses(payloads)
+    assert all(res.metadata.get("budget_degraded") for res in outputs)
+    assert {call["model"] for call in completions.calls} == {"gpt-4o-mini"}
+    assert client._budget.num_degraded == 3
+
+
+def test_parse_once(tmp_path):
+    from uptrain.operators.language.llm import load_json
+
+    assert load_json('{"Choice": "A"}') == {"Choice": "A"}
+    # lenient syntax falls back to json5
+    assert load_json("{'Choice': 'A', /* note */ 'Score': 1,}") == {"Choice": "A", "Score": 1}
+
+    client, completions = make_client(tmp_path)
+    completions.content = 'Sure, here you go: {"Choice": "B", "Explanation": "..."}'
+    payloads = [client.make_payload(idx, f"prompt {idx}") for idx in range(2)]
+    outputs = client.fetch_responses(payloads, lambda output: output["Choice"] in "ABC")
+    # the object parsed for validation is the one handed to the scoring
+    parsed = outputs[0]._parsed[1][0]
+    assert outputs[0].parsed_output() is parsed
+    assert parsed == {"Choice": "B", "Explanation": "..."}
+
+
+def test_priority_scheduler():
+    from uptrain.operators.language.llm_scheduler import RequestScheduler
+
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1)
+        order = []
+
+        async def request(priority, run):
+            async with scheduler.slot(priority, run):
+                order.append(run)
+                await asyncio.sleep(0.001)
+
+        await scheduler.acquire("bulk", "warmup")
+        tasks = [asyncio.ensure_future(request("bulk", "A")) for _ in range(3)]
+        tasks += [asyncio.ensure_future(request("bulk", "B")) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(request("interactive", "C")))
+        await asyncio.sleep(0)
+        assert scheduler.num_waiting == 7
+        scheduler.release("warmup")
+        await asyncio.gather(*tasks)
+        return order
+
+    # the interactive run jumps the queue, the bulk runs take turns
+    assert asyncio.run(run()) == ["C", "A", "B", "A", "B", "A", "B"]
+
+
+def test_self_consistency_sampling(tmp_path):
+    from uptrain.operators import ContextRelevance
+    from uptrain.operators.language.llm import majority_vote
+
+    assert majority_vote(["A", "B", "A"]) == ("A", 2 / 3)
+    assert majority_vote(["B", "A"]) == ("B", 0.5)
+
+    # the samples come from a single request, and are reduced to a majority vote
+    choices = iter([["A", "C", "A"], ["B", "B", "B"]])
+
+    def responder(kwargs):
+        return [f'{{"Reasoning": "...", "Choice": "{choice}"}}' for choice in next(choices)]
+
+    settings = Settings(openai_api_key="sk-fake", logs_folder=str(tmp_path), num_samples=3)
+    aclient = FakeAsyncClient(responder=responder)
+    op = ContextRelevance().setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+    data = [{"question": "question", "context": "context"}]
+    results = op.evaluate_local([dict(row) for row in data * 2])
+    assert len(aclient.completions.calls) == 2
+    assert all(call["n"] == 3 and call["temperature"] == 0.7 for call in aclient.completions.calls)
+    assert sorted(
+        (res["score_context_relevance"], res["confidence_context_relevance"]) for res in results
+    ) == [(0.5, 1.0), (1.0, 2 / 3)]
+
+
+def test_cacheable_prompt_layout(tmp_path):
+    from uptrain.operators import ContextRelevance
+    from uptrain.operators.language.llm_fake import FakeAsyncOpenAI, FakeLLMConfig
+    from uptrain.operators.language.prompts.classic import CONTEXT_RELEVANCE_PROMPT_TEMPLATE
+    from uptrain.operators.language.prompts.layout import render_prompt
+
+    kwargs = {
+        "question": "question 0",
+        "context": "context 0",
+        "few_shot_examples": "[Examples]",
+        "output_format": "[Output format]",
+        "prompting_instructions": "[Instructions]",
+    }
+    # the classic layout is the template as it always was
+    assert render_prompt(CONTEXT_RELEVANCE_PROMPT_TEMPLATE, kwargs, "About {question}") == (
+        None,
+        CONTEXT_RELEVANCE_PROMPT_TEMPLATE.replace("{scenario_description}", "About {question}").format(**kwargs),
+    )
+    # the cacheable layout keeps everything that depends on the row out of the system prompt
+    system_prompt, prompt = render_prompt(
+        CONTEXT_RELEVANCE_PROMPT_TEMPLATE, kwargs, "About {question}", "cacheable"
+    )
+    assert "[Examples]" in system_prompt and "question 0" not in system_prompt
+    assert prompt.startswith("About question 0\n\nTask Data.")
+
+    data = [{"question": f"question {idx}", "context": f"context {idx}"} for idx in range(10)]
+    cached_tokens = {}
+    for layout in ["classic", "cacheable"]:
+        settings = Settings(
+            openai_api_key="sk-fake", logs_folder=str(tmp_path), prompt_layout=layout, rpm_limit=10_000
+        )
+        aclient = FakeAsyncOpenAI(FakeLLMConfig(prompt_caching=True, cache_min_tokens=128))
+        op = ContextRelevance(scenario_description="Questions like {{question}}").setup(settings)
+        op._api_client = LLMMulticlient(settings, aclient=aclient)
+        results = op.evaluate_local([dict(row) for row in data])
+        assert all(res["score_context_relevance"] in (0.0, 0.5, 1.0) for res in results)
+        cached_tokens[layout] = aclient.provider.num_cached_tokens
+    # the row dependent scenario description breaks the shared prefix of the classic prompts
+    assert cached_tokens["classic"] == 0
+    assert cached_tokens["cacheable"] > 0
+
+
+def test_cascaded_grading(tmp_path):
+    from uptrain.operators import ContextRelevance
+    from uptrain.operators.language.llm_cascade import cascade_stats_context
+
+    def responder(kwargs):
+        prompt = kwargs["messages"][-1]["content"]
+        if kwargs["model"] == "gpt-4":
+            return '{"Reasoning": "...", "Choice": "C"}'
+        if "hard question" in prompt:
+            return '{"Reasoning": "...", "Choice": "B"}'
+        if "broken question" in prompt:
+            return "not json"
+        return '{"Reasoning": "...", "Choice": "A"}'
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        model="gpt-4",
+        cascade_model="gpt-3.5-turbo",
+        rpm_limit=10_000,
+    )
+    aclient = FakeAsyncClient(responder=responder)
+    op = ContextRelevance().setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+    questions = ["easy question"] * 6 + ["hard question", "broken question"]
+    data = [{"question": f"{question} {idx}", "context": "context"} for idx, question in enumerate(questions)]
+    with cascade_stats_context() as run_stats:
+        results = op.evaluate_local([dict(row) for row in data])
+
+    # clear-cut rows keep the grade of the cheap judge, the others are re-graded
+    assert [res["score_context_relevance"] for res in results] == [1.0] * 6 + [0.0, 0.0]
+    strong_calls = [call for call in aclient.completions.calls if call["model"] == "gpt-4"]
+    assert len(strong_calls) == 2
+    stats = op._api_client.cascade_stats.summary()
+    assert stats["escalated"] == 2 and stats["escalation_rate"] == 0.25
+    assert stats["reasons"] == {"uncertain": 1, "invalid": 1}
+    # the evaluation run adds up the cascades of its checks
+    assert run_stats.summary() == stats
+
+
+def test_evaluation_memo(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    import contextvars
+
+    import polars as pl
+
+    from uptrain.operators import ContextRelevance
+    from uptrain.operators.language.llm_memo import evaluation_memo, run_memoized
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        response_cache=False,
+        rpm_limit=10_000,
+    )
+    aclient = FakeAsyncClient(content='{"Reasoning": "...", "Choice": "A"}')
+    data = pl.DataFrame(
+        [{"question": f"question {idx % 3}", "context": "context"} for idx in range(4)]
+    )
+
+    def setup(op):
+        op = op.setup(settings)
+        op._api_client = LLMMulticlient(settings, aclient=aclient)
+        return op
+
+    def evaluate(op):
+        output = run_memoized(setup(op), data)["output"]
+        return output[output.columns[-2:]].to_dicts()
+
+    # the column names don't matter, the operators see the rows already renamed
+    ops = [ContextRelevance(), ContextRelevance(col_out="relevance")]
+    with evaluation_memo() as memo:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, evaluate, op) for op in ops
+            ]
+            results = [future.result() for future in futures]
+        results.append(evaluate(ContextRelevance()))
+        # only the evaluators run through `run_memoized` share their rows
+        setup(ContextRelevance()).run(data)
+        assert len(aclient.completions.calls) == 7
+
+    # each distinct row is graded once, whichever check gets to it first
+    assert [list(row.values()) for row in results[0]] == [
+        list(row.values()) for row in results[1]
+    ]
+    assert results[0] == results[2]
+    assert memo.summary() == {"hits": 9, "misses": 3}
+
+    # outside of the block the rows are graded again
+    evaluate(ContextRelevance())
+    assert len(aclient.completions.calls) == 11
+
+
+def test_checkpointed_evaluation(tmp_path):
+    import polars as pl
+
+    from uptrain.operators import ContextRelevance
+    from uptrain.framework.checkpoint import (
+        CheckpointStore,
+        check_key,
+        evaluate_checkpointed,
+    )
+
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path),
+        response_cache=False,
+        rpm_limit=10_000,
+    )
+    aclient = FakeAsyncClient(content='{"Reasoning": "...", "Choice": "A"}')
+    op = ContextRelevance().setup(settings)
+    op._api_client = LLMMulticlient(settings, aclient=aclient)
+    data = pl.DataFrame(
+        {"question": [f"question {idx}" for idx in range(10)], "context": ["context"] * 10}
+    )
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"))
+    key = check_key({"check_name": "ContextRelevance"}, settings)
+
+    def crash_after_first_chunk(chunk):
+        if len(aclient.completions.calls) >= 4:
+            raise KeyboardInterrupt
+        return op.run(chunk)["output"]
+
+    try:
+        evaluate_checkpointed(store, key, data, crash_after_first_chunk, 4)
+    except KeyboardInterrupt:
+        pass
+    assert store.num_saved == 4
+
+    # the rows of the first chunk aren't graded again
+    results = evaluate_checkpointed(
+        store, key, data, lambda chunk: op.run(chunk)["output"], 4, resume=True
+    )
+    assert len(aclient.completions.calls) == 10
+    assert results.columns == ["score_context_relevance", "explanation_context_relevance"]
+    assert results["score_context_relevance"].to_list() == [1.0] * 10
+
+    # resuming a completed run evaluates nothing, and gives the same results
+    again = evaluate_checkpointed(
+        store, key, data, lambda chunk: op.run(chunk)["output"], 4, resume=True
+    )
+    assert len(aclient.completions.calls) == 10
+    assert again.equals(results)
+
+
+def test_checkset_resume(tmp_path, monkeypatch):
+    import polars as pl
+
+    from uptrain.framework import Check, CheckSet
+    from uptrain.operators import ContextRelevance, JsonReader
+    from uptrain.operators.language import llm
+
+    aclient = FakeAsyncClient(content='{"Reasoning": "...", "Choice": "A"}')
+    monkeypatch.setattr(llm, "AsyncOpenAI", lambda **kwargs: aclient)
+    settings = Settings(
+        openai_api_key="sk-fake",
+        logs_folder=str(tmp_path / "logs"),
+        response_cache=False,
+        rpm_limit=10_000,
+        checkpoint=True,
+        checkpoint_rows=4,
+    )
+    fpath = str(tmp_path / "data.jsonl")
+    rows = [{"question": f"question {idx}", "context": "context"} for idx in range(10)]
+
+    def run_checkset(num_rows, resume):
+        pl.DataFrame(rows[:num_rows]).write_ndjson(fpath)
+        check = Check(name="relevance", operators=[ContextRelevance()])
+        CheckSet(source=JsonReader(fpath=fpath), checks=[check]).setup(settings).run(
+            resume=resume
+        )
+        return pl.read_ndjson(os.path.join(settings.logs_folder, "relevance.jsonl"))
+
+    run_checkset(6, resume=False)
+    assert len(aclient.completions.calls) == 6
+
+    # setting up the check-set again clears its logs, but not the checkpoints, so only
+    # the rows added since are graded
+    results = run_checkset(10, resume=True)
+    assert len(aclient.completions.calls) == 10
+    assert results["question"].to_list() == [row["question"] for row in rows]
+    assert results["score_context_relevance"].to_list() == [1.0] * 10
+
+    # without resuming, every row is graded again
+    run_checkset(10, resume=False)
+    assert len(aclient.completions.calls) == 20
+
+
+def test_checkset_run_budget(tmp_path, monkeypatch):
+    import polars as pl
+
+    from uptrain.framework import Check, CheckSet
+    from uptrain.operators import ContextRelevance, JsonReader
+    from uptrain.operators.language import llm
+
+    class CostlyCompletions(FakeCompletions):
+        async def create(self, **kwargs):
+            res = await super().create(**kwargs)
+            res.usage.prompt_tokens = res.usage.total_tokens = 1_000_000
+            res.usage.completion_tokens = 0
+            return res
+
+    aclient = FakeAsyncClient(content='{"Reasoning": "...", "Choice": "A"}')
+    aclient.completions = CostlyCompletions(content=aclient.completions.content)
+    monkeypatch.setattr(llm, "AsyncOpenAI", lambda **kwargs: aclient)
+    # a key of its own, the usage reported would drain the rate limits shared by the key
+    settings = Settings(
+        openai_api_key="sk-costly",
+        logs_folder=str(tmp_path / "logs"),
+        response_cache=False,
+        rpm_limit=10_000,
+        tpm_limit=10**9,
+        max_run_tokens=10 * 1_000_000,
+    )
+    fpath = str(tmp_path / "data.jsonl")
+    pl.DataFrame(
+        [{"question": f"question {idx}", "context": "context"} for idx in range(10)]
+    ).write_ndjson(fpath)
+    checks = [
+        Check(name="first", operators=[ContextRelevance()]),
+        Check(name="second", operators=[ContextRelevance()]),
+    ]
+    checkset = CheckSet(source=JsonReader(fpath=fpath), checks=checks).setup(settings)
+    checkset.run()
+
+    # the first check uses up the budget of the run, so the second sends no requests
+    assert len(aclient.completions.calls) == 10
+    assert checkset._budget.spend()["total"]["tokens"] == 10 * 1_000_000
+    scores = {
+        check.name: pl.read_ndjson(
+            os.path.join(settings.logs_folder, f"{check.name}.jsonl")
+        )["score_context_relevance"].to_list()
+        for check in checks
+    }
+    assert scores == {"first": [1.0] * 10, "second": [None] * 10}
+
+
+def test_checkset_operator_budget(tmp_path, monkeypatch):
+    import polars as pl
+
+    from uptrain.framework import Check, CheckSet
+    from uptrain.operators import ContextRelevance, JsonReader
+    from uptrain.operators.language import llm
+
+    class CostlyCompletions(FakeCompletions):
+        async def create(self, **kwargs):
+            res = await super().create(**kwargs)
+            res.usage.prompt_tokens = res.usage.total_tokens = 1_000_000
+            res.usage.completion_tokens = 0
+            return res
+
+    aclient = FakeAsyncClient(content='{"Reasoning": "...", "Choice": "A"}')
+    aclient.completions = CostlyCompletions(content=aclient.completions.content)
+    monkeypatch.setattr(llm, "AsyncOpenAI", lambda **kwargs: aclient)
+    # a key of its own, the usage reported would drain the rate limits shared by the key
+    settings = Settings(
+        openai_api_key="sk-costly",
+        logs_folder=str(tmp_path / "logs"),
+        response_cache=False,
+        rpm_limit=10_000,
+        tpm_limit=10**9,
+        operator_budgets={"ContextRelevance": {"max_tokens": 10 * 1_000_000}},
+    )
+    fpath = str(tmp_path / "data.jsonl")
+    pl.DataFrame(
+        [{"question": f"question {idx}", "context": "context"} for idx in range(10)]
+    ).write_ndjson(fpath)
+    checks = [
+        Check(name="first", operators=[ContextRelevance()]),
+        Check(name="second", operators=[ContextRelevance()]),
+    ]
+    checkset = CheckSet(source=JsonReader(fpath=fpath), checks=checks).setup(settings)
+    checkset.run()
+
+    # the requests of both checks are charged to their operator, the first check uses
+    # up its budget so the second sends no requests
+    assert len(aclient.completions.calls) == 10
+    spend = checkset._budget.spend()
+    assert spend["by_operator"] == {"ContextRelevance": spend["total"]}
+    assert spend["total"]["tokens"] == 10 * 1_000_000
+    scores = {
+        check.name: pl.read_ndjson(
+            os.path.join(settings.logs_folder, f"{check.name}.jsonl")
+        )["score_context_relevance"].to_list()
+        for check in checks
+    }
+    assert scores == {"first": [1.0] * 10, "second": [None] * 10}
+
+
+def test_clear_directory_keep(tmp_path):
+    from uptrain.utilities import clear_directory
+
+    for fname in ["results.jsonl", "checkpoints.sqlite", "checkpoints.sqlite-wal"]:
+        (tmp_path / fname).write_text("")
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "checkpoints.sqlite").write_text("")
+
+    # the paths to keep are compared once made absolute
+    keep = [
+        str(tmp_path / "checkpoints.sqlite"),
+        os.path.relpath(tmp_path / "checkpoints.sqlite-wal"),
+    ]
+    clear_directory(str(tmp_path), keep=keep)
+    assert sorted(os.listdir(tmp_path)) == ["checkpoints.sqlite", "checkpoints.sqlite-wal"]
+
+    clear_directory(str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+def test_lazy_load_missing_dep():
+    import pytest
+
+    from uptrain.utilities import lazy_load_dep
+
+    # a submodule of a missing package only fails once used
+    scorer = lazy_load_dep("uptrain_missing_package.scorer", "uptrain-missing-package")
+    with pytest.raises(ModuleNotFoundError):
+        scorer.Scorer
+
+
+def test_checkpoint_store_replaced(tmp_path):
+    import sqlite3
+
+    from uptrain.framework.checkpoint import check_key, get_checkpoint_store
+
+    settings = Settings(openai_api_key="sk-fake", logs_folder=str(tmp_path))
+    store = get_checkpoint_store(settings)
+    store.save("key", {"row": {"score": 1.0}})
+    assert get_checkpoint_store(settings) is store
+
+    # a store whose file was removed is closed, and replaced by one on a new file
+    for fpath in os.listdir(tmp_path):
+        os.remove(tmp_path / fpath)
+    new_store = get_checkpoint_store(settings)
+    assert new_store is not store
+    assert new_store.load("key", ["row"]) == {}
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.load("key", ["row"])
+
+    # the outputs saved are only reused with the same grading settings
+    key = check_key({"check_name": "ContextRelevance"}, settings)
+    assert key == check_key({"check_name": "ContextRelevance"}, settings.model_copy())
+    for name, value in [("truncate_long_prompts", True), ("long_context_model", "gpt-4o")]:
+        changed = settings.model_copy(update={name: value})
+        assert check_key({"check_name": "ContextRelevance"}, changed) != key
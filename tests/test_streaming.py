@@ -0,0 +1,124 @@
+"""
+Test the helpers to evaluate datasets a chunk of rows at a time.
+"""
+
+import polars as pl
+import pytest
+
+from uptrain.framework.streaming import ChunkWriter, iter_chunks, read_rows
+
+
+ROWS = [{"question": f"question {idx}", "score": idx / 10} for idx in range(7)]
+
+
+def test_iter_chunks():
+    frame = pl.DataFrame(ROWS)
+    inputs = {
+        "frame": frame,
+        "lazy frame": frame.lazy(),
+        "iterator": iter(ROWS),
+    }
+    for name, data in inputs.items():
+        chunks = list(iter_chunks(data, 3))
+        # the last chunk holds the rows left over
+        assert [chunk.height for chunk in chunks] == [3, 3, 1], name
+        assert pl.concat(chunks).to_dicts() == ROWS, name
+
+    # no empty chunk when the rows split evenly
+    assert [chunk.height for chunk in iter_chunks(frame.head(6).lazy(), 3)] == [3, 3]
+    assert [chunk.height for chunk in iter_chunks(iter(ROWS[:6]), 3)] == [3, 3]
+    assert list(iter_chunks(iter([]), 3)) == []
+
+    # rows of an iterator with different keys share a chunk
+    (chunk,) = iter_chunks(iter([{"a": 1}, {"b": "x"}]), 3)
+    assert chunk.to_dicts() == [{"a": 1, "b": None}, {"a": None, "b": "x"}]
+
+    with pytest.raises(ValueError):
+        next(iter_chunks(frame, 0))
+
+
+def test_iter_chunks_lazy_frame(monkeypatch):
+    from uptrain.framework.streaming import _rebatch
+
+    frame = pl.DataFrame(ROWS)
+    # the batches streamed out of the query are regrouped into chunks of the size asked
+    batches = [frame.slice(0, 2), frame.slice(2, 4), frame.slice(6, 1)]
+    chunks = list(_rebatch(batches, 3))
+    assert [chunk.height for chunk in chunks] == [3, 3, 1]
+    assert pl.concat(chunks).to_dicts() == ROWS
+    assert list(_rebatch([], 3)) == []
+
+    # without streaming, the query is collected once and sliced
+    monkeypatch.delattr(pl.LazyFrame, "collect_batches", raising=False)
+    chunks = list(iter_chunks(frame.lazy(), 3))
+    assert [chunk.height for chunk in chunks] == [3, 3, 1]
+    assert pl.concat(chunks).to_dicts() == ROWS
+
+
+def test_jsonl_round_trip(tmp_path):
+    fpath = str(tmp_path / "results" / "rows.jsonl")
+    with ChunkWriter(fpath) as writer:
+        for chunk in iter_chunks(iter(ROWS), 3):
+            writer.write(chunk)
+    assert writer.num_rows == 7
+    assert list(read_rows(fpath)) == ROWS
+
+    # appended to, rather than overwritten, when asked to
+    with ChunkWriter(fpath, append=True) as writer:
+        writer.write(pl.DataFrame(ROWS[:2]))
+    assert list(read_rows(fpath)) == ROWS + ROWS[:2]
+    with ChunkWriter(fpath) as writer:
+        writer.write(pl.DataFrame(ROWS[:2]))
+    assert list(read_rows(fpath)) == ROWS[:2]
+
+    with pytest.raises(ValueError):
+        ChunkWriter(str(tmp_path / "rows.csv"))
+    with pytest.raises(ValueError):
+        read_rows(str(tmp_path / "rows.csv"))
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+
+    fpath = str(tmp_path / "rows.parquet")
+    with ChunkWriter(fpath) as writer:
+        for chunk in iter_chunks(iter(ROWS), 3):
+            writer.write(chunk)
+    assert writer.num_rows == 7
+    rows = read_rows(fpath)
+    assert isinstance(rows, pl.LazyFrame)
+    assert rows.collect().to_dicts() == ROWS
+    assert [chunk.height for chunk in iter_chunks(rows, 3)] == [3, 3, 1]
+
+
+def test_parquet_schema_drift(tmp_path):
+    pytest.importorskip("pyarrow")
+
+    fpath = str(tmp_path / "rows.parquet")
+    with ChunkWriter(fpath) as writer:
+        # the columns all null in the first chunk are typed from their names
+        writer.write(
+            pl.DataFrame(
+                {"question": ["a"], "score_x": [None], "explanation_x": [None]}
+            )
+        )
+        # a chunk missing a column gets nulls for it, and columns are reordered
+        writer.write(pl.DataFrame({"score_x": [0.5], "question": ["b"]}))
+        writer.write(
+            pl.DataFrame({"question": ["c"], "score_x": [1.0], "explanation_x": ["ok"]})
+        )
+        # columns that weren't in the first chunk can't be added
+        with pytest.raises(ValueError):
+            writer.write(pl.DataFrame({"question": ["d"], "score_y": [1.0]}))
+
+    frame = pl.read_parquet(fpath)
+    assert frame.schema == {
+        "question": pl.Utf8,
+        "score_x": pl.Float64,
+        "explanation_x": pl.Utf8,
+    }
+    assert frame.to_dicts() == [
+        {"question": "a", "score_x": None, "explanation_x": None},
+        {"question": "b", "score_x": 0.5, "explanation_x": None},
+        {"question": "c", "score_x": 1.0, "explanation_x": "ok"},
+    ]
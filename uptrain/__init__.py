@@ -1,4 +1,12 @@
+import importlib.metadata
+
 import lazy_loader as lazy
 
 # this assumes there is a `.pyi` file adjacent to this module
 __getattr__, __dir__, __all__ = lazy.attach_stub(__name__, __file__)
+
+try:
+    __version__ = importlib.metadata.version(__name__)
+except importlib.metadata.PackageNotFoundError:
+    # running from a source tree that isn't installed
+    __version__ = "unknown"
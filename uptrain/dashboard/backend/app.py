@@ -37,6 +37,7 @@ from fastapi import (
     Security,
     Request,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security.api_key import APIKeyHeader
 
@@ -754,11 +755,13 @@ async def create_project(
         )
         metadata = {'dataset_name': dataset_name}
         if exp_column is None:
-            results = user_client.evaluate(
+            results = await run_in_threadpool(
+                user_client.evaluate,
                 data=data, checks=checks_1, project_name=project_name, evaluation_name=evaluation_name, metadata=metadata
             )
         else:
-            results = user_client.evaluate_experiments(
+            results = await run_in_threadpool(
+                user_client.evaluate_experiments,
                 data=data, checks=checks_1, project_name=project_name, evaluation_name=evaluation_name, exp_columns=[exp_column], metadata=metadata
             )
         return {"message": f"Evaluation has been queued up"}
@@ -814,6 +817,9 @@ async def new_run(
     settings_data["model"] = model
     settings_data["uptrain_local_url"] = os.environ["UPTRAIN_LOCAL_URL"]
     settings_data.update(metadata[model])
+    # runs started from the dashboard get the rate limits shared with the other runs of
+    # the server (the evaluations run on threads of their own) ahead of them
+    settings_data["request_priority"] = "interactive"
 
     if "exp_column" in metadata:
         exp_column = metadata["exp_column"]
@@ -832,11 +838,13 @@ async def new_run(
         )
         metadata = {'dataset_name': dataset_name}
         if exp_column is None:
-            results = user_client.evaluate(
+            results = await run_in_threadpool(
+                user_client.evaluate,
                 data=data, checks=checks_1, project_name=existing_project.name, evaluation_name=evaluation_name, metadata=metadata
             )
         else:
-            results = user_client.evaluate_experiments(
+            results = await run_in_threadpool(
+                user_client.evaluate_experiments,
                 data=data, checks=checks_1, project_name=existing_project.name, evaluation_name=evaluation_name, exp_columns=[exp_column], metadata=metadata
             )
         return {"message": f"Evaluation has been queued up"}
@@ -915,11 +923,13 @@ async def add_default_run(
         )
         metadata = {'dataset_name': dataset_name, 'dataset_id': dataset_id}
         if exp_column is None:
-            results = user_client.evaluate(
+            results = await run_in_threadpool(
+                user_client.evaluate,
                 data=data, checks=checks_1, project_name=existing_project.name, evaluation_name=eval_args.evaluation_name, metadata=metadata
             )
         else:
-            results = user_client.evaluate_experiments(
+            results = await run_in_threadpool(
+                user_client.evaluate_experiments,
                 data=data, checks=checks_1, project_name=existing_project.name, evaluation_name=eval_args.evaluation_name, exp_columns=[exp_column], metadata=metadata
             )
         return {"message": f"Evaluation has been queued up"}
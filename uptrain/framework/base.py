@@ -34,10 +34,86 @@ class Settings(BaseSettings):
         response_format: Response format for evaluations.
         evaluate_locally: Flag for local evaluation.
         eval_type: Type of evaluation.
+        rows_per_request: Number of rows graded in a single LLM request by evaluators that support
+            packing (ContextRelevance, ValidResponseScore, PromptInjectionScore). 1 disables packing.
+        num_samples: Number of completions sampled in one request by evaluators that support self-consistency
+            (ContextRelevance, ResponseFactualScore). The score is their majority vote, with the fraction of
+            samples agreeing as its confidence. 1 disables sampling.
+        sampling_temperature: Temperature used when sampling several completions.
+        max_concurrent_checks: Number of checks of an `EvalLLM.evaluate` call run at once when evaluating
+            locally. Their LLM requests are then all sent on the background event loop (as with
+            `persistent_event_loop`), under the same rate limits and `max_concurrency`; with
+            `adaptive_concurrency`, each check adapts its own number of requests in flight. 1 runs the
+            checks one after another.
+        cascade_model: Cheap model that grades every row first in cascade mode, with only the rows it is
+            unsure about re-graded by `model`. None disables the cascade.
+        cascade_uncertainty_band: Range of scores (inclusive) of the cheap model that are re-graded.
+        cascade_min_agreement: Fraction of the sampled choices of the cheap model that must agree
+            (see `num_samples`) for its grade to stand.
+        prompt_layout: How grading prompts are laid out in chat messages. "classic" sends a single user
+            message, "cacheable" sends the instructions and few-shot examples as a system message shared by
+            every row, so providers that cache repeated prompt prefixes bill it at the discounted rate.
 
         # Rate limits
         rpm_limit: "Requests Per Minute" limit for the API.
         tpm_limit: "Tokens Per Minute" limit for the API.
+        completion_tokens_reserve: Completion tokens to budget per request if `max_tokens` isn't set.
+        max_concurrency: Maximum number of LLM requests in flight at once. None, the default, leaves it to
+            the rate limits.
+        adaptive_concurrency: Flag to adapt the number of requests in flight to throttling by the API.
+        rate_limiter_backend: Where rate limits are tracked. "process" shares them between all clients in the
+            process with the same provider and API key, "sqlite" also shares them across local worker processes.
+        rate_limiter_path: Path of the database for the "sqlite" backend. Defaults to a file under logs_folder.
+        execution_mode: "online" sends LLM requests as they are made, "batch" submits them through the
+            provider's batch API and waits for the results (cheaper, but can take hours).
+        batch_poll_interval: Seconds between checks on the status of a submitted batch.
+        client_pool: Clients to spread LLM requests across - API keys, Azure deployments or OpenAI
+            compatible endpoints, each with its own rate limits. See `ClientPoolMember` for the fields.
+        persistent_event_loop: Flag to run LLM requests on a long-lived background event loop, reusing
+            connections across calls, instead of starting a new event loop per call.
+        request_priority: Priority class of the LLM requests - "interactive", "default" or "bulk". Requests
+            of a higher class get the rate limits (and `max_concurrency`) first when runs of the process share
+            the same provider and API key.
+
+        # Request hedging
+        hedge_requests: Flag to send a duplicate of requests that are slower than usual, and use
+            whichever response arrives first.
+        hedge_percentile: Percentile of recent request latencies after which a request is hedged.
+        hedge_min_delay: Minimum seconds to wait before hedging a request.
+        hedge_api_base: Base URL of a second OpenAI compatible endpoint to send hedged requests to.
+        hedge_api_key: API key for `hedge_api_base`. Defaults to the key of the primary endpoint.
+
+        # Context length
+        long_context_model: Model to send prompts to when they don't fit the context window of `model`.
+        truncate_long_prompts: Flag to shorten the longest variable of prompts that don't fit the context
+            window (of `long_context_model` too, if set), instead of sending them as is. Off by default,
+            as the row is then graded on part of its data; truncated requests are logged.
+        model_context_windows: Context window (in tokens) of models, overriding the built-in table.
+
+        # Budgets
+        max_run_tokens: Tokens an evaluation run may use, across all its LLM requests. None for no limit.
+            A run is a call of `EvalLLM.evaluate` (or `evaluate_stream`, `evaluate_prompts`), or a
+            `CheckSet` from its setup on; operators set up on their own each get a budget of their own.
+        max_run_cost: Cost (in USD) an evaluation run may incur. None for no limit.
+        operator_budgets: Budgets per operator, e.g. {"ResponseFactualScore": {"max_tokens": 100_000,
+            "max_cost": 1.0}}. Requests past a budget aren't sent, and their rows get no score.
+        budget_fallback_model: Cheaper model to send requests to once `budget_degrade_at` of a budget is used.
+        budget_degrade_at: Fraction of a budget after which requests go to `budget_fallback_model`.
+        model_prices: USD per million (prompt, completion) tokens of models, overriding the built-in table.
+
+        # Response cache
+        response_cache: Flag to cache LLM responses on disk and reuse them across runs.
+        response_cache_path: Path of the cache database. Defaults to a file under logs_folder.
+        response_cache_ttl: Seconds after which cached responses expire. None disables expiry.
+        response_cache_max_entries: Maximum number of cached responses to keep.
+        coalesce_requests: Flag to send identical concurrent LLM requests only once and share the response.
+            Requests sampling several choices (`num_samples` > 1) are always sent on their own.
+
+        # Checkpoints
+        checkpoint: Flag to save the outputs of the checks of `EvalLLM.evaluate` and `CheckSet.run` as the
+            rows are evaluated, so an interrupted run can be resumed with `resume=True`.
+        checkpoint_path: Path of the checkpoint database. Defaults to a file under logs_folder.
+        checkpoint_rows: Number of rows evaluated between two checkpoints.
 
         # UpTrain managed service
         uptrain_access_token: Access token for Uptrain API.
@@ -87,10 +163,60 @@ class Settings(BaseSettings):
     # cot -> We will use chain of thought prompting to evaluate and get the grade
     # basic -> We will simply prompt the LLM to return the grade without any reasoning
     eval_type: t.Literal["basic", "cot"] = "cot"
+    rows_per_request: int = 1
+    num_samples: int = 1
+    sampling_temperature: float = 0.7
+    max_concurrent_checks: int = 8
+    cascade_model: t.Optional[str] = None
+    cascade_uncertainty_band: tuple[float, float] = (0.25, 0.75)
+    cascade_min_agreement: float = 1.0
+    prompt_layout: t.Literal["classic", "cacheable"] = "classic"
 
     # Rate limits
     rpm_limit: int = 100
     tpm_limit: int = 90_000
+    completion_tokens_reserve: int = 500
+    max_concurrency: t.Optional[int] = None
+    adaptive_concurrency: bool = False
+    rate_limiter_backend: t.Literal["process", "sqlite"] = "process"
+    rate_limiter_path: t.Optional[str] = None
+    client_pool: list[dict] = []
+    persistent_event_loop: bool = False
+    request_priority: t.Literal["interactive", "default", "bulk"] = "default"
+    execution_mode: t.Literal["online", "batch"] = "online"
+    batch_poll_interval: int = 60
+
+    # Request hedging
+    hedge_requests: bool = False
+    hedge_percentile: float = 95
+    hedge_min_delay: float = 1.0
+    hedge_api_base: t.Optional[str] = None
+    hedge_api_key: t.Optional[str] = None
+
+    # Context length
+    long_context_model: t.Optional[str] = None
+    truncate_long_prompts: bool = False
+    model_context_windows: dict = {}
+
+    # Budgets
+    max_run_tokens: t.Optional[int] = None
+    max_run_cost: t.Optional[float] = None
+    operator_budgets: dict = {}
+    budget_fallback_model: t.Optional[str] = None
+    budget_degrade_at: float = 0.8
+    model_prices: dict = {}
+
+    # Response cache
+    response_cache: bool = False
+    response_cache_path: t.Optional[str] = None
+    response_cache_ttl: t.Optional[int] = 7 * 24 * 60 * 60
+    response_cache_max_entries: t.Optional[int] = 100_000
+    coalesce_requests: bool = False
+
+    # Checkpoints
+    checkpoint: bool = False
+    checkpoint_path: t.Optional[str] = None
+    checkpoint_rows: int = 1000
 
     # UpTrain managed service
     uptrain_access_token: t.Optional[str] = Field(
@@ -286,6 +412,7 @@ class OperatorDAG:
                 from the upstream operators is used as input.
             node_outputs: A list of operator names, whose output should be returned.
         """
+        from uptrain.operators.language.llm_metrics import operator_context
 
         # dict to hold the output of each node
         node_to_output = {}
@@ -313,8 +440,9 @@ class OperatorDAG:
                             f"Cannot find output/provided value for dependency: {dep} of node: {node_name}"
                         )
 
-            # run the operator and store the output
-            res = node.run(*inputs_from_deps)
+            # run the operator and store the output, with its LLM calls attributed to it
+            with operator_context(type(node).__name__):
+                res = node.run(*inputs_from_deps)
             node_to_output[node_name] = res["output"]
 
             # decrease dependents count for each dependency so we don't old onto memory
@@ -0,0 +1,239 @@
+"""
+Checkpoints of evaluation runs. The outputs of a check are saved for each row as the
+rows are evaluated, in a SQLite database (by default under `Settings.logs_folder`), keyed
+by the check and the content of the row. A run interrupted half way can then be resumed
+with `resume=True`, and only grades the (row, check) pairs that weren't saved yet.
+"""
+
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import typing as t
+
+import polars as pl
+
+import uptrain
+
+if t.TYPE_CHECKING:
+    from uptrain.framework import Settings
+
+__all__ = [
+    "CheckpointStore",
+    "get_checkpoint_store",
+    "checkpoint_files",
+    "check_key",
+    "row_keys",
+    "evaluate_checkpointed",
+]
+
+
+# Settings that change the outputs of a check, so are part of its key
+GRADING_SETTINGS = (
+    "model",
+    "seed",
+    "response_format",
+    "eval_type",
+    "rows_per_request",
+    "num_samples",
+    "sampling_temperature",
+    "cascade_model",
+    "cascade_uncertainty_band",
+    "cascade_min_agreement",
+    "prompt_layout",
+    "truncate_long_prompts",
+    "long_context_model",
+    "model_context_windows",
+)
+
+
+def _canonical(value: t.Any) -> str:
+    return json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+
+
+def _hash(value: t.Any) -> str:
+    return hashlib.sha256(_canonical(value).encode("utf-8")).hexdigest()
+
+
+def check_key(check: dict, settings: Settings) -> str:
+    """Key of a serialized check, with the settings it grades with and the version of
+    uptrain, whose prompts and parsing the outputs depend on."""
+    return _hash(
+        [
+            check,
+            {name: getattr(settings, name) for name in GRADING_SETTINGS},
+            uptrain.__version__,
+        ]
+    )
+
+
+def row_keys(data: pl.DataFrame) -> list[str]:
+    """Keys of the rows of the frame, by their content."""
+    return [_hash(row) for row in data.iter_rows(named=True)]
+
+
+class CheckpointStore:
+    """
+    Outputs of the checks for the rows evaluated so far, backed by SQLite.
+
+    Attributes:
+        fpath (str): Path of the SQLite database file.
+        num_restored (int): Number of (row, check) outputs read back for resumed runs.
+        num_saved (int): Number of (row, check) outputs saved.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self.num_restored = 0
+        self.num_saved = 0
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(fpath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(fpath, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                "check_key TEXT NOT NULL, row_key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (check_key, row_key))"
+            )
+
+    def load(self, check_key: str, row_keys: t.Sequence[str]) -> dict[str, dict]:
+        """Return the saved outputs of the check for the rows that have one."""
+        outputs = {}
+        unique_keys = list(dict.fromkeys(row_keys))
+        with self._lock:
+            # in batches, under the limit of SQLite on the number of parameters
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start : start + 500]
+                cursor = self._conn.execute(
+                    "SELECT row_key, value FROM outputs WHERE check_key = ? AND row_key IN "
+                    f"({', '.join('?' * len(batch))})",
+                    (check_key, *batch),
+                )
+                for row_key, value in cursor:
+                    outputs[row_key] = json.loads(value)
+            self.num_restored += len(outputs)
+        return outputs
+
+    def save(self, check_key: str, outputs: dict[str, dict]) -> None:
+        """Save the outputs of the check for the rows. Saving them again is a no-op."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO outputs (check_key, row_key, value) VALUES (?, ?, ?)",
+                [
+                    (check_key, row_key, json.dumps(output, default=str))
+                    for row_key, output in outputs.items()
+                ],
+            )
+            self.num_saved += len(outputs)
+
+    def clear(self) -> None:
+        """Remove all the saved outputs."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM outputs")
+
+    def summary(self) -> dict:
+        return {"restored": self.num_restored, "saved": self.num_saved}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_CHECKPOINT_STORES: dict[str, CheckpointStore] = {}
+_CHECKPOINT_STORES_LOCK = threading.Lock()
+
+
+def _checkpoint_path(settings: Settings) -> str:
+    if settings.checkpoint_path is not None:
+        return settings.checkpoint_path
+    return os.path.join(settings.logs_folder, "evaluation_checkpoints.sqlite")
+
+
+def checkpoint_files(settings: Settings) -> list[str]:
+    """Paths of the files of the checkpoint database, including the SQLite journals."""
+    fpath = _checkpoint_path(settings)
+    return [fpath, fpath + "-wal", fpath + "-shm"]
+
+
+def get_checkpoint_store(settings: Settings) -> CheckpointStore:
+    """Return the checkpoint store configured in the settings, shared by all the runs
+    using the same database file."""
+    fpath = _checkpoint_path(settings)
+    with _CHECKPOINT_STORES_LOCK:
+        store = _CHECKPOINT_STORES.get(fpath)
+        if store is None or not os.path.exists(fpath):
+            # the file was removed, the connection to it is of no more use
+            if store is not None:
+                store.close()
+            store = _CHECKPOINT_STORES[fpath] = CheckpointStore(fpath)
+    return store
+
+
+def _is_scored(output: dict) -> bool:
+    """Whether the output of a check is worth keeping - rows whose grading failed, with
+    no score, are graded again when resuming."""
+    scores = [value for key, value in output.items() if key.startswith("score")]
+    return not scores or any(score is not None for score in scores)
+
+
+def evaluate_checkpointed(
+    store: CheckpointStore,
+    check_key: str,
+    data: pl.DataFrame,
+    evaluate: t.Callable[[pl.DataFrame], pl.DataFrame],
+    chunk_size: int,
+    resume: bool = False,
+) -> pl.DataFrame:
+    """
+    Run a check on the rows a chunk at a time, saving the columns it adds for each row
+    after every chunk.
+
+    Args:
+        store (CheckpointStore): Store to save the outputs to.
+        check_key (str): Key of the check, see `check_key`.
+        data (pl.DataFrame): Rows to evaluate.
+        evaluate (Callable): Runs the check on a frame, returning it with the columns added.
+        chunk_size (int): Number of rows evaluated between two checkpoints.
+        resume (bool): Whether to reuse the outputs already saved for the rows, instead
+            of evaluating them again.
+
+    Returns:
+        The columns added by the check, and the input columns whose values it changed,
+        for all the rows.
+    """
+    outputs = []
+    for chunk in data.iter_slices(max(chunk_size, 1)):
+        keys = row_keys(chunk)
+        done = store.load(check_key, keys) if resume else {}
+        todo = [position for position, key in enumerate(keys) if key not in done]
+        if todo:
+            rows = chunk[todo] if len(todo) < chunk.height else chunk
+            res = evaluate(rows)
+            added = [
+                column
+                for column in res.columns
+                if column not in chunk.columns or not res[column].equals(rows[column])
+            ]
+            computed = dict(
+                zip([keys[position] for position in todo], res.select(added).to_dicts())
+            )
+            store.save(
+                check_key,
+                {key: output for key, output in computed.items() if _is_scored(output)},
+            )
+            done.update(computed)
+        outputs.extend(done[key] for key in keys)
+    changed = sorted({name for output in outputs for name in output if name in data.columns})
+    if changed:
+        # rows whose input values the check left as they were keep them
+        inputs = data.select(changed).to_dicts()
+        outputs = [{**row, **output} for row, output in zip(inputs, outputs)]
+    return pl.from_dicts(outputs, infer_schema_length=None) if outputs else pl.DataFrame()
@@ -128,14 +128,17 @@ class CheckSet:
 
     def setup(self, settings: Settings):
         """Create the logs directory, or clear it if it already exists. Also, persist the
-        evaluation config.
+        evaluation config. The checkpoints of earlier runs are kept, to resume them.
         """
+        from uptrain.framework.checkpoint import checkpoint_files
+        from uptrain.operators.language.llm_budget import BudgetTracker, budget_context
+
         self._settings = settings
         logs_dir = self._settings.logs_folder
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
         else:
-            clear_directory(logs_dir)
+            clear_directory(logs_dir, keep=checkpoint_files(self._settings))
 
         logger.info(f"Uptrain Logs directory: {logs_dir}")
 
@@ -143,22 +146,49 @@ class CheckSet:
         self.serialize(os.path.join(logs_dir, "config.json"))
         self._settings.serialize(os.path.join(logs_dir, "settings.json"))
 
-        self.source.setup(self._settings)
-        for preprocessor in self.preprocessors:
-            preprocessor.setup(self._settings)
-        for check in self.checks:
-            check.setup(self._settings)
-        for postprocessor in self.postprocessors:
-            postprocessor.setup(self._settings)
+        # the LLM clients of the operators are created as they are set up, and are all
+        # charged to the budget of the run
+        self._budget = BudgetTracker.from_settings(self._settings)
+        with budget_context(self._budget):
+            self.source.setup(self._settings)
+            for preprocessor in self.preprocessors:
+                preprocessor.setup(self._settings)
+            for check in self.checks:
+                check.setup(self._settings)
+            for postprocessor in self.postprocessors:
+                postprocessor.setup(self._settings)
         return self
 
-    def run(self):
-        """Run all checks in this set."""
+    def run(self, resume: bool = False):
+        """Run all checks in this set.
+
+        Args:
+            resume (bool): Whether to reuse the outputs saved by an earlier, interrupted run of the
+                checks on the same rows (see `Settings.checkpoint`), and only evaluate the rest.
+                Outputs are saved as the rows are evaluated whenever this is set.
+
+        The token and cost budgets in the settings (`max_run_tokens`, `max_run_cost`,
+        `operator_budgets`) apply to all the operators of the check set together.
+        """
+        from uptrain.operators.language.llm_budget import budget_context
+
+        with budget_context(self._budget):
+            self._run(resume)
+        logger.info(f"LLM spend for the check set: {self._budget.spend()['total']}")
+
+    def _run(self, resume: bool):
         from uptrain.operators import JsonWriter
+        from uptrain.framework.checkpoint import (
+            check_key,
+            evaluate_checkpointed,
+            get_checkpoint_store,
+        )
+        from uptrain.operators.language.llm_metrics import operator_context
 
         logger.info("CheckSet Status: Starting checkset")
 
-        source_output = self.source.run()["output"]
+        with operator_context(type(self.source).__name__):
+            source_output = self.source.run()["output"]
         if source_output is None:
             raise RuntimeError("Dataset read from the source is: None")
         if len(source_output) == 0:
@@ -167,7 +197,8 @@ class CheckSet:
 
         if len(self.preprocessors) > 0:
             for preprocessor in self.preprocessors:
-                source_output = preprocessor.run(source_output)["output"]
+                with operator_context(type(preprocessor).__name__):
+                    source_output = preprocessor.run(source_output)["output"]
                 assert source_output is not None, "Output of preprocessor is None"
 
             # persist the preprocessed input for debugging
@@ -179,10 +210,29 @@ class CheckSet:
 
         logger.info("CheckSet Status: Preprocessing Done")
 
+        checkpoint = None
+        if self._settings.checkpoint or resume:
+            checkpoint = get_checkpoint_store(self._settings)
+
         consolidated_output = {}
         for check in self.checks:
             logger.info(f"CheckSet Status: Check {check.name} Started")
-            check_output = check.run(source_output)
+            # only checks that grade each row on its own can be run a chunk at a time
+            if checkpoint is not None and all(
+                hasattr(op, "evaluate_local") for op in check.operators
+            ):
+                check_output = source_output.with_columns(
+                    evaluate_checkpointed(
+                        checkpoint,
+                        check_key(check.dict(), self._settings),
+                        source_output,
+                        check.run,
+                        self._settings.checkpoint_rows,
+                        resume,
+                    ).get_columns()
+                )
+            else:
+                check_output = check.run(source_output)
             assert check_output is not None, f"Output of check {check.name} is None"
             self._get_sink_for_check(self._settings, check).run(check_output)
             logger.info(f"CheckSet Status: Check {check.name} Completed")
@@ -197,7 +247,8 @@ class CheckSet:
         if len(self.postprocessors):
             consolidated_output = pl.DataFrame(consolidated_output)
             for postprocessor in self.postprocessors:
-                consolidated_output = postprocessor.run(consolidated_output)["output"]
+                with operator_context(type(postprocessor).__name__):
+                    consolidated_output = postprocessor.run(consolidated_output)["output"]
                 assert (
                     consolidated_output is not None
                 ), "Output of postprocessor is None"
@@ -3,7 +3,10 @@ This module implements a simple LLM wrapper that can be used to evaluate perform
 of LLM applications. 
 """
 
+import contextvars
+import functools
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from loguru import logger
 import httpx
@@ -14,10 +17,31 @@ import copy
 import os
 import httpx
 from uptrain.operators.base import ColumnOp
+from uptrain.operators.language.llm_budget import (
+    BudgetTracker,
+    budget_context,
+    get_current_budget,
+)
+from uptrain.operators.language.llm_cascade import CascadeStats, cascade_stats_context
+from uptrain.operators.language.llm_memo import evaluation_memo, run_memoized
+from uptrain.operators.language.llm_metrics import operator_context
+from uptrain.operators.language.llm_scheduler import run_context
 from uptrain.utilities.utils import parse_prompt, check_openai_api_key
 from uptrain.framework.remote import APIClientWithoutAuth, DataSchema
 from uptrain.framework.base import Settings
 from uptrain.framework.checks import Check
+from uptrain.framework.checkpoint import (
+    CheckpointStore,
+    check_key,
+    evaluate_checkpointed,
+    get_checkpoint_store,
+)
+from uptrain.framework.streaming import (
+    TYPE_STREAM_INPUT,
+    ChunkWriter,
+    iter_chunks,
+    read_rows,
+)
 from uptrain.framework.evals import (
     Evals,
     JailbreakDetection,
@@ -95,6 +119,23 @@ PARAMETRIC_EVAL_TO_OPERATOR_MAPPING = {
 }
 
 
+def _evaluate_with_checkpoints(
+    checkpoint: CheckpointStore,
+    key: str,
+    data: pl.DataFrame,
+    evaluate: t.Callable[[pl.DataFrame], pl.DataFrame],
+    chunk_size: int,
+    resume: bool,
+) -> pl.DataFrame:
+    """`evaluate_checkpointed`, returning the rows with the outputs of the check like
+    running it directly does."""
+    return data.with_columns(
+        evaluate_checkpointed(
+            checkpoint, key, data, evaluate, chunk_size, resume
+        ).get_columns()
+    )
+
+
 def get_uuid():
     import uuid
     return str(uuid.uuid4().hex)
@@ -176,9 +217,10 @@ class EvalLLM:
                     if not isinstance(scenario_description, list)
                     else scenario_description[idx]
                 )
-                res = (
-                    op.setup(self.settings).run(pl.DataFrame(data))["output"].to_dicts()
-                )
+                with operator_context(type(op).__name__):
+                    res = (
+                        op.setup(self.settings).run(pl.DataFrame(data))["output"].to_dicts()
+                    )
             else:
                 res = self.evaluate_on_server(data, [ser_template], schema)
             for idx, row in enumerate(res):
@@ -196,6 +238,9 @@ class EvalLLM:
         scenario_description: t.Optional[str] = None,
         schema: t.Union[DataSchema, dict[str, str], None] = None,
         metadata: t.Optional[dict[str, str]] = None,
+        return_spend: bool = False,
+        return_format: t.Literal["dicts", "polars"] = "dicts",
+        resume: bool = False,
     ):
         """Run an evaluation on the UpTrain server using user's openai keys.
         NOTE: This api doesn't log any data.
@@ -206,15 +251,33 @@ class EvalLLM:
             checks: List of checks to evaluate on.
             schema: Schema of the data. Only required if the data attributes aren't typical (question, response, context).
             metadata: Attributes to attach to this dataset. Useful for filtering and grouping in the UI.
+            return_spend: Whether to also return the tokens and cost spent on LLM calls when evaluating locally.
+            return_format: "dicts" to return a list of dicts, "polars" to return a Polars DataFrame.
+            resume: Whether to reuse the outputs saved by an earlier, interrupted run of the checks on the
+                same rows (see `Settings.checkpoint`), and only evaluate the rest. Outputs are saved as
+                the rows are evaluated whenever this is set.
         Returns:
-            results: List of dictionaries with each data point and corresponding evaluation results.
+            results: List of dictionaries with each data point and corresponding evaluation results,
+                or a Polars DataFrame if `return_format` is "polars".
+            spend: Tokens and cost spent, in total and per check and model. With a `cascade_model`, also
+                the rows graded by the cascade and those escalated, under "cascade". Only if `return_spend`
+                is set.
+
+        The token and cost budgets in the settings (`max_run_tokens`, `max_run_cost`,
+        `operator_budgets`) apply to the whole run, or to the enclosing `budget_context` if
+        one is open. Once they are exhausted, the remaining LLM requests aren't sent and their
+        rows get no score.
         """
         if evaluation_name is None:
             evaluation_name = "Eval - " + str(datetime.utcnow())
-        
-        if isinstance(data, pl.DataFrame):
-            data = data.to_dicts()
-        elif isinstance(data, pd.DataFrame):
+        if return_format not in ("dicts", "polars"):
+            raise ValueError(
+                f"Unknown return format {return_format}, expected one of ('dicts', 'polars')"
+            )
+
+        # a Polars frame is evaluated as is, and only converted to dicts to be returned
+        frame = data if isinstance(data, pl.DataFrame) else None
+        if isinstance(data, pd.DataFrame):
             data = data.to_dict(orient="records")
 
         if schema is None:
@@ -225,6 +288,227 @@ class EvalLLM:
         if metadata is None:
             metadata = {}
 
+        checks, req_attrs, ser_checks = self._prepare_checks(
+            checks, schema, scenario_description
+        )
+
+        if frame is not None:
+            if not req_attrs.issubset(frame.columns):
+                raise ValueError(
+                    f"Data is missing required all required attributes for evaluation: {req_attrs}"
+                )
+        else:
+            for idx, row in enumerate(data):
+                if not req_attrs.issubset(row.keys()):
+                    raise ValueError(
+                        f"Row {idx} is missing required all required attributes for evaluation: {req_attrs}"
+                    )
+        server_checks = copy.deepcopy(ser_checks)
+        # part of a larger run (e.g. `evaluate_prompts`) when a budget is already open
+        budget = get_current_budget() or BudgetTracker.from_settings(self.settings)
+        cascade_stats = CascadeStats()
+        if self.settings.evaluate_locally:
+            if frame is None:
+                frame = pl.DataFrame(data)
+            checkpoint = self._get_checkpoint(resume)
+            # checks built out of the same sub-evaluators grade each row with them once
+            with budget_context(budget), run_context(), evaluation_memo() as memo, cascade_stats_context(
+                cascade_stats
+            ):
+                scores = self._evaluate_checks_locally(
+                    frame,
+                    checks,
+                    ser_checks,
+                    schema,
+                    scenario_description,
+                    checkpoint=checkpoint,
+                    resume=resume,
+                )
+            logger.info(f"LLM spend for the evaluation: {budget.spend()['total']}")
+            if cascade_stats.num_payloads:
+                logger.info(f"Cascaded grading of the evaluation: {cascade_stats.summary()}")
+            if memo.hits:
+                logger.info(f"Row evaluations shared between checks: {memo.summary()}")
+            if checkpoint is not None:
+                logger.info(f"Checkpoints of the evaluation: {checkpoint.summary()}")
+            if return_format == "polars" or isinstance(data, pl.DataFrame):
+                results = frame.with_columns(scores.get_columns())
+                if return_format == "dicts":
+                    results = results.to_dicts()
+            else:
+                # the rows as given, with the score columns of the checks added
+                score_rows = scores.to_dicts() if scores.width else [{}] * len(data)
+                results = [{**row, **score} for row, score in zip(data, score_rows)]
+        else:
+            if frame is not None:
+                data = frame.to_dicts()
+            results = self.evaluate_on_server(data, ser_checks, schema)
+            if return_format == "polars":
+                results = pl.DataFrame(results)
+        ## local server calls
+        try:
+            client = httpx.Client(
+                headers={"uptrain-access-token": "default_key"},
+                timeout=httpx.Timeout(7200, connect=5),
+            )
+            # serializing the rows for the dashboard is costly on large datasets, so
+            # only do it when the local server is up
+            client.get(self.settings.uptrain_local_url)
+
+            # the rows are only added to, a shallow copy keeps the results untouched
+            sink_data = [
+                dict(row)
+                for row in (
+                    results.to_dicts() if isinstance(results, pl.DataFrame) else results
+                )
+            ]
+            for idx, data_point in enumerate(sink_data):
+                row_uuid= get_uuid()
+                data_point["row_uuid"] = row_uuid
+                for key_dict in list(data_point.keys()):
+                    if "confidence" in key_dict:
+                        data_point['score_confidence' + '_' + key_dict.split("confidence_")[-1]] = data_point[key_dict]
+                    if key_dict.startswith("score") and "confidence" not in key_dict:
+                        data_point["status_" + key_dict] = "not updated"
+
+            url = self.settings.uptrain_local_url + "/api/public/add_project_data"
+            response = client.post(
+                url,
+                json={
+                    "data": data.to_dicts() if isinstance(data, pl.DataFrame) else data,
+                    "sink_data": sink_data,
+                    "checks": server_checks,
+                    "metadata": metadata,
+                    "schema_dict": schema.model_dump(),
+                    "project": project_name,
+                    "evaluation": evaluation_name,
+                    "exp_column": None if metadata.get("uptrain_experiment_columns", None) is None else metadata.get("uptrain_experiment_columns", None)[0]
+                },
+            )
+        except Exception:
+            #user_id = "default_key"
+            logger.info("Local server not running, start the server to log data and visualize in the dashboard!")
+        if return_spend:
+            spend = budget.spend()
+            if cascade_stats.num_payloads:
+                spend["cascade"] = cascade_stats.summary()
+            return results, spend
+        return results
+
+    def evaluate_stream(
+        self,
+        data: TYPE_STREAM_INPUT,
+        checks: list[t.Union[str, Evals, ParametricEval]],
+        scenario_description: t.Optional[str] = None,
+        schema: t.Union[DataSchema, dict[str, str], None] = None,
+        chunk_size: int = 1000,
+        resume: bool = False,
+    ) -> t.Iterator[pl.DataFrame]:
+        """Evaluate a dataset too large to hold in memory, a chunk of rows at a time.
+        NOTE: This api doesn't log any data.
+
+        Args:
+            data: Data to evaluate on. An iterable of dicts, a Polars DataFrame or a Polars LazyFrame.
+            checks: List of checks to evaluate on.
+            schema: Schema of the data. Only required if the data attributes aren't typical (question, response, context).
+            chunk_size: Number of rows evaluated at a time. The LLM calls of a chunk are all
+                sent together, so it bounds both memory and the requests in flight.
+            resume: Whether to reuse the outputs saved by an earlier, interrupted run (see `evaluate`).
+        Yields:
+            Polars DataFrames with the rows of each chunk and their evaluation results, in order.
+
+        The token and cost budgets in the settings apply to the whole stream.
+        """
+        if schema is None:
+            schema = DataSchema()
+        elif isinstance(schema, dict):
+            schema = DataSchema(**schema)
+        checks, req_attrs, ser_checks = self._prepare_checks(
+            checks, schema, scenario_description
+        )
+
+        budget = BudgetTracker.from_settings(self.settings)
+        cascade_stats = CascadeStats()
+        checkpoint = self._get_checkpoint(resume) if self.settings.evaluate_locally else None
+        run_id = f"stream-{get_uuid()}"
+        num_rows = 0
+        for chunk in iter_chunks(data, chunk_size):
+            if not req_attrs.issubset(chunk.columns):
+                raise ValueError(
+                    f"Rows {num_rows} to {num_rows + chunk.height - 1} are missing required attributes for evaluation: {req_attrs}"
+                )
+            if self.settings.evaluate_locally:
+                # the contexts are entered per chunk, as the caller runs between chunks
+                with budget_context(budget), run_context(run_id), evaluation_memo(), cascade_stats_context(
+                    cascade_stats
+                ):
+                    scores = self._evaluate_checks_locally(
+                        chunk,
+                        checks,
+                        ser_checks,
+                        schema,
+                        scenario_description,
+                        checkpoint=checkpoint,
+                        resume=resume,
+                    )
+                chunk = chunk.with_columns(scores.get_columns())
+            else:
+                chunk = pl.DataFrame(
+                    self.evaluate_on_server(chunk.to_dicts(), ser_checks, schema)
+                )
+            num_rows += chunk.height
+            logger.info(f"Evaluated {num_rows} rows")
+            yield chunk
+        if self.settings.evaluate_locally:
+            logger.info(f"LLM spend for the evaluation: {budget.spend()['total']}")
+            if cascade_stats.num_payloads:
+                logger.info(f"Cascaded grading of the evaluation: {cascade_stats.summary()}")
+
+    def evaluate_file(
+        self,
+        input_path: str,
+        output_path: str,
+        checks: list[t.Union[str, Evals, ParametricEval]],
+        scenario_description: t.Optional[str] = None,
+        schema: t.Union[DataSchema, dict[str, str], None] = None,
+        chunk_size: int = 1000,
+        resume: bool = False,
+    ) -> int:
+        """Evaluate a JSONL or Parquet file a chunk of rows at a time, and write the rows
+        with their evaluation results to a JSONL or Parquet file as they come.
+        NOTE: This api doesn't log any data.
+
+        Args:
+            input_path: Path of the JSONL or Parquet file to evaluate.
+            output_path: Path of the JSONL or Parquet file to write the results to. Overwritten if it exists.
+            checks: List of checks to evaluate on.
+            schema: Schema of the data. Only required if the data attributes aren't typical (question, response, context).
+            chunk_size: Number of rows evaluated at a time.
+            resume: Whether to reuse the outputs saved by an earlier, interrupted run (see `evaluate`).
+                The output file is written again in full.
+        Returns:
+            num_rows: Number of rows evaluated.
+        """
+        with ChunkWriter(output_path) as writer:
+            for chunk in self.evaluate_stream(
+                read_rows(input_path),
+                checks,
+                scenario_description=scenario_description,
+                schema=schema,
+                chunk_size=chunk_size,
+                resume=resume,
+            ):
+                writer.write(chunk)
+        return writer.num_rows
+
+    def _get_checkpoint(self, resume: bool) -> t.Optional[CheckpointStore]:
+        if self.settings.checkpoint or resume:
+            return get_checkpoint_store(self.settings)
+        return None
+
+    def _prepare_checks(self, checks, schema, scenario_description):
+        """Return the checks, the attributes the rows need for them, and the checks
+        serialized for the server."""
         checks = [Evals(m) if isinstance(m, str) else m for m in checks]
         for m in checks:
             assert isinstance(m, (Evals, ParametricEval, ColumnOp, list))
@@ -295,95 +579,112 @@ class EvalLLM:
                 ser_checks.append({"check_name": "dummy_list_ops"})
             else:
                 raise ValueError(f"Invalid metric: {m}")
+        return checks, req_attrs, ser_checks
 
-        for idx, row in enumerate(data):
-            if not req_attrs.issubset(row.keys()):
-                raise ValueError(
-                    f"Row {idx} is missing required all required attributes for evaluation: {req_attrs}"
-                )
-        server_checks = copy.deepcopy(ser_checks)
-        if self.settings.evaluate_locally:
-            results = copy.deepcopy(data)
-            for idx, check in enumerate(checks):
-                if (
-                    isinstance(check, ParametricEval)
-                    and ser_checks[idx]["check_name"]
-                    in PARAMETRIC_EVAL_TO_OPERATOR_MAPPING
-                ):
-                    # Use the check_name field to get the operator and remove it from ser_checks
-                    op = PARAMETRIC_EVAL_TO_OPERATOR_MAPPING[
-                        ser_checks[idx].pop("check_name")
-                    ](**ser_checks[idx])
-                    res = (
-                        op.setup(self.settings)
-                        .run(pl.DataFrame(data))["output"]
-                        .to_dicts()
-                    )
-                elif isinstance(check, Evals) and check in EVAL_TO_OPERATOR_MAPPING:
-                    op = EVAL_TO_OPERATOR_MAPPING[check]
-                    op.scenario_description = (
-                        scenario_description
-                        if not isinstance(scenario_description, list)
-                        else scenario_description[idx]
-                    )
-                    res = (
-                        op.setup(self.settings)
-                        .run(pl.DataFrame(data))["output"]
-                        .to_dicts()
+    def _evaluate_checks_locally(
+        self,
+        data,
+        checks,
+        ser_checks,
+        schema,
+        scenario_description,
+        checkpoint: t.Optional[CheckpointStore] = None,
+        resume: bool = False,
+    ) -> pl.DataFrame:
+        """Run the checks on the frame, and return the columns they add to it. With a
+        checkpoint store, the outputs of the checks graded row by row are saved as the
+        rows are evaluated, and with `resume` the saved ones are reused."""
+        max_workers = min(self.settings.max_concurrent_checks, len(checks))
+        settings = self.settings
+        if max_workers > 1:
+            # the LLM requests of the checks are all sent on the background event loop,
+            # where they share the scheduler capping the requests in flight and the
+            # connections, along with the rate limits
+            settings = settings.model_copy(update={"persistent_event_loop": True})
+        tasks = []
+        for idx, check in enumerate(checks):
+            evaluate = functools.partial(
+                self._evaluate_check_locally,
+                check=check,
+                ser_check=ser_checks[idx],
+                schema=schema,
+                scenario_description=scenario_description
+                if not isinstance(scenario_description, list)
+                else scenario_description[idx],
+                settings=settings,
+            )
+            if checkpoint is not None and isinstance(check, (Evals, ParametricEval)):
+                tasks.append(
+                    functools.partial(
+                        _evaluate_with_checkpoints,
+                        checkpoint,
+                        check_key(ser_checks[idx], self.settings),
+                        data,
+                        evaluate,
+                        self.settings.checkpoint_rows,
+                        resume,
                     )
-                elif isinstance(check, ColumnOp):
-                    op = Check(name = "dummy", operators = [check])
-                    res = (
-                        op.setup(self.settings)
-                        .run(pl.DataFrame(data))
-                    ).to_dicts()
-                elif isinstance(check, list):
-                    op = Check(name = "dummy", operators = check)
-                    res = (
-                        op.setup(self.settings)
-                        .run(pl.DataFrame(data))
-                    ).to_dicts()
-                else:
-                    res = self.evaluate_on_server(data, [ser_checks[idx]], schema)
-                for idx, row in enumerate(res):
-                    results[idx].update(row)
+                )
+            else:
+                tasks.append(functools.partial(evaluate, data))
+        if max_workers > 1:
+            # the checks are independent, so their LLM requests are sent together instead
+            # of check by check
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, task)
+                    for task in tasks
+                ]
+                check_results = [future.result() for future in futures]
         else:
-            results = self.evaluate_on_server(data, ser_checks, schema)
-        ## local server calls
-        try:
-            client = httpx.Client(
-                headers={"uptrain-access-token": "default_key"},
-                timeout=httpx.Timeout(7200, connect=5),
-            )
-
-            sink_data = copy.deepcopy(results)
-            for idx, data_point in enumerate(sink_data):
-                row_uuid= get_uuid()
-                data_point["row_uuid"] = row_uuid
-                for key_dict in list(data_point.keys()):
-                    if "confidence" in key_dict:
-                        data_point['score_confidence' + '_' + key_dict.split("confidence_")[-1]] = data_point[key_dict]
-                    if key_dict.startswith("score") and "confidence" not in key_dict:
-                        data_point["status_" + key_dict] = "not updated"
+            check_results = [task() for task in tasks]
+        # the output rows of the checks update the input rows in turn, so a column is
+        # the one of the last check returning it - input columns included
+        columns = {}
+        for res in check_results:
+            for column in res.get_columns():
+                columns[column.name] = column
+        return pl.DataFrame(
+            [
+                column
+                for name, column in columns.items()
+                if name not in data.columns or not column.equals(data[name])
+            ]
+        )
 
-            url = self.settings.uptrain_local_url + "/api/public/add_project_data"
-            response = client.post(
-                url,
-                json={
-                    "data": data,
-                    "sink_data": sink_data,
-                    "checks": server_checks,
-                    "metadata": metadata,
-                    "schema_dict": schema.model_dump(),
-                    "project": project_name,
-                    "evaluation": evaluation_name,
-                    "exp_column": None if metadata.get("uptrain_experiment_columns", None) is None else metadata.get("uptrain_experiment_columns", None)[0]
-                },
+    def _evaluate_check_locally(
+        self, data, check, ser_check, schema, scenario_description, settings=None
+    ) -> pl.DataFrame:
+        if settings is None:
+            settings = self.settings
+        if (
+            isinstance(check, ParametricEval)
+            and ser_check["check_name"] in PARAMETRIC_EVAL_TO_OPERATOR_MAPPING
+        ):
+            # Use the check_name field to get the operator and remove it from ser_check
+            ser_check = dict(ser_check)
+            op = PARAMETRIC_EVAL_TO_OPERATOR_MAPPING[ser_check.pop("check_name")](
+                **ser_check
+            )
+            with operator_context(type(op).__name__):
+                return op.setup(settings).run(data)["output"]
+        elif isinstance(check, Evals) and check in EVAL_TO_OPERATOR_MAPPING:
+            # a copy, the same check may run concurrently with another scenario description
+            op = EVAL_TO_OPERATOR_MAPPING[check].model_copy()
+            op.scenario_description = scenario_description
+            # the rows graded by the evaluator are shared with the other checks
+            with operator_context(type(op).__name__):
+                return run_memoized(op.setup(settings), data)["output"]
+        elif isinstance(check, ColumnOp):
+            op = Check(name = "dummy", operators = [check])
+            return op.setup(settings).run(data)
+        elif isinstance(check, list):
+            op = Check(name = "dummy", operators = check)
+            return op.setup(settings).run(data)
+        else:
+            return pl.DataFrame(
+                self.evaluate_on_server(data.to_dicts(), [ser_check], schema)
             )
-        except Exception:
-            #user_id = "default_key"
-            logger.info("Local server not running, start the server to log data and visualize in the dashboard!")
-        return results
 
     def evaluate_on_server(self, data, ser_checks, schema):
         # send in chunks of 50, so the connection doesn't time out waiting for the server
@@ -516,29 +817,32 @@ class EvalLLM:
 
         from uptrain.operators import TextCompletion
 
-        dataset = (
-            TextCompletion(
-                col_in_prompt="prompt",
-                col_in_model="model",
-                col_out_completion="response",
-                temperature=0.0,
-            )
-            .setup(self.settings)
-            .run(dataset)["output"]
-        )
-
-        dataset = dataset.to_dicts()
-
         if schema is None:
             schema = DataSchema()
         elif isinstance(schema, dict):
             schema = DataSchema(**schema)
 
-        results = self.evaluate(
-            project_name=project_name,
-            data=dataset,
-            checks=checks,
-            schema=schema,
-            metadata=metadata,
-        )
+        # the responses are generated and evaluated within the budget of the same run
+        with budget_context(BudgetTracker.from_settings(self.settings)):
+            with operator_context(TextCompletion.__name__):
+                dataset = (
+                    TextCompletion(
+                        col_in_prompt="prompt",
+                        col_in_model="model",
+                        col_out_completion="response",
+                        temperature=0.0,
+                    )
+                    .setup(self.settings)
+                    .run(dataset)["output"]
+                )
+
+            dataset = dataset.to_dicts()
+
+            results = self.evaluate(
+                project_name=project_name,
+                data=dataset,
+                checks=checks,
+                schema=schema,
+                metadata=metadata,
+            )
         return results
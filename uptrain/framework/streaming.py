@@ -0,0 +1,163 @@
+"""
+Helpers to evaluate datasets larger than memory - reading them a chunk of rows at a
+time, and appending the results to a file as they come.
+"""
+
+from __future__ import annotations
+import itertools
+import json
+import os
+import typing as t
+
+import polars as pl
+
+from uptrain.utilities import lazy_load_dep
+
+__all__ = [
+    "TYPE_STREAM_INPUT",
+    "iter_chunks",
+    "read_rows",
+    "ChunkWriter",
+]
+
+
+TYPE_STREAM_INPUT = t.Union[t.Iterable[dict], pl.DataFrame, pl.LazyFrame]
+
+JSONL_EXTENSIONS = (".jsonl", ".ndjson", ".json")
+PARQUET_EXTENSIONS = (".parquet",)
+
+
+def iter_chunks(data: TYPE_STREAM_INPUT, chunk_size: int) -> t.Iterator[pl.DataFrame]:
+    """Split the data into frames of at most `chunk_size` rows, only holding one of
+    them in memory at a time - for a lazy frame, with versions of polars that can
+    stream its rows (`LazyFrame.collect_batches`)."""
+    if chunk_size < 1:
+        raise ValueError(f"The chunk size must be positive, got {chunk_size}")
+    if isinstance(data, pl.DataFrame):
+        yield from data.iter_slices(chunk_size)
+    elif isinstance(data, pl.LazyFrame):
+        # the query is run once - collecting a slice of it per chunk would scan the
+        # rows before each chunk again
+        if hasattr(data, "collect_batches"):
+            yield from _rebatch(data.collect_batches(chunk_size=chunk_size), chunk_size)
+        else:
+            # older versions of polars can't stream the rows of a query out
+            yield from data.collect().iter_slices(chunk_size)
+    else:
+        rows = iter(data)
+        while True:
+            batch = list(itertools.islice(rows, chunk_size))
+            if not batch:
+                return
+            # the rows of an iterator needn't share a schema, look at all of them
+            yield pl.DataFrame(batch, infer_schema_length=None)
+
+
+def _rebatch(frames: t.Iterable[pl.DataFrame], chunk_size: int) -> t.Iterator[pl.DataFrame]:
+    """Regroup the rows of the frames into frames of `chunk_size` rows, but the last."""
+    pending = None
+    for frame in frames:
+        pending = frame if pending is None else pl.concat([pending, frame])
+        while pending.height >= chunk_size:
+            yield pending.slice(0, chunk_size)
+            pending = pending.slice(chunk_size)
+    if pending is not None and pending.height > 0:
+        yield pending
+
+
+def read_rows(fpath: str) -> t.Union[t.Iterator[dict], pl.LazyFrame]:
+    """Read a JSONL or Parquet file lazily."""
+    if fpath.endswith(PARQUET_EXTENSIONS):
+        return pl.scan_parquet(fpath)
+    if fpath.endswith(JSONL_EXTENSIONS):
+        return _read_jsonl(fpath)
+    raise ValueError(
+        f"Unsupported file format for {fpath}, expected one of {JSONL_EXTENSIONS + PARQUET_EXTENSIONS}"
+    )
+
+
+def _read_jsonl(fpath: str) -> t.Iterator[dict]:
+    with open(fpath) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ChunkWriter:
+    """
+    Appends frames to a JSONL or Parquet file.
+
+    Attributes:
+        fpath (str): Path of the file.
+        append (bool): Whether to add to an existing JSONL file rather than overwrite it.
+            Parquet files can't be appended to, and are always overwritten.
+        num_rows (int): Number of rows written.
+    """
+
+    def __init__(self, fpath: str, append: bool = False):
+        if not fpath.endswith(JSONL_EXTENSIONS + PARQUET_EXTENSIONS):
+            raise ValueError(
+                f"Unsupported file format for {fpath}, expected one of {JSONL_EXTENSIONS + PARQUET_EXTENSIONS}"
+            )
+        self.fpath = fpath
+        self.append = append
+        self.num_rows = 0
+        self._file: t.Optional[t.TextIO] = None
+        self._parquet_writer: t.Any = None
+        dirname = os.path.dirname(fpath)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def write(self, chunk: pl.DataFrame) -> None:
+        if self.fpath.endswith(PARQUET_EXTENSIONS):
+            self._write_parquet(chunk)
+        else:
+            if self._file is None:
+                self._file = open(self.fpath, "a" if self.append else "w")
+            self._file.write(chunk.write_ndjson())
+            # flushed per chunk, so what's written survives a crash
+            self._file.flush()
+        self.num_rows += chunk.height
+
+    def _write_parquet(self, chunk: pl.DataFrame) -> None:
+        pq = lazy_load_dep("pyarrow.parquet", "pyarrow>=10.0.0")
+        if self._parquet_writer is None:
+            # the schema of the file is that of the first chunk, so give a type to the
+            # columns that are all null in it
+            chunk = chunk.with_columns(
+                [
+                    pl.col(name).cast(
+                        pl.Float64 if name.startswith("score") else pl.Utf8
+                    )
+                    for name, dtype in chunk.schema.items()
+                    if dtype == pl.Null
+                ]
+            )
+            table = chunk.to_arrow()
+            self._parquet_writer = pq.ParquetWriter(self.fpath, table.schema)
+        else:
+            schema = self._parquet_writer.schema
+            extra = set(chunk.columns) - set(schema.names)
+            if extra:
+                raise ValueError(
+                    f"Columns {sorted(extra)} aren't in the first chunk written to {self.fpath}"
+                )
+            chunk = chunk.with_columns(
+                [pl.lit(None).alias(name) for name in schema.names if name not in chunk.columns]
+            ).select(schema.names)
+            table = chunk.to_arrow().cast(schema)
+        self._parquet_writer.write_table(table)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def __enter__(self) -> ChunkWriter:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -3,15 +3,16 @@ Implement operator to detect code in a response.
 """
 
 from __future__ import annotations
-import json
 import typing as t
 
 from loguru import logger
 import polars as pl
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
 from uptrain.operators.language.prompts.classic import (
     CODE_HALLUCINATION_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     CODE_HALLUCINATION_FEW_SHOT__CLASSIFY,
     CODE_HALLUCINATION_FEW_SHOT__COT,
@@ -146,18 +147,25 @@ class CodeHallucinationScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = CODE_HALLUCINATION_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    CODE_HALLUCINATION_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -170,9 +178,9 @@ class CodeHallucinationScore(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
-                snippet = json.loads(res.response.choices[0].message.content).get(
+                snippet = res.parsed_output().get(
                     "Snippet", None
                 )
                 output["score_code_hallucination"] = float(score)
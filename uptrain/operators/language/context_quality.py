@@ -4,7 +4,6 @@ Implement operators to evaluate retrieval quality i.e. quality of the extracted
 
 from __future__ import annotations
 import typing as t
-import json
 
 from loguru import logger
 import polars as pl
@@ -15,7 +14,16 @@ if t.TYPE_CHECKING:
     from uptrain.framework import Settings
 from uptrain.operators.base import register_op, ColumnOp, TYPE_TABLE_OUTPUT
 from uptrain.utilities import polars_to_json_serializable_dict
-from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm import (
+    LLMMulticlient,
+    get_sampling_kwargs,
+    majority_vote,
+)
+from uptrain.operators.language.llm_cascade import mapped_score
+from uptrain.operators.language.llm_packing import (
+    fetch_packed_responses,
+    use_packed_requests,
+)
 
 from uptrain.operators.language.prompts.classic import (
     CONTEXT_CONCISENESS_PROMPT_TEMPLATE,
@@ -23,6 +31,7 @@ from uptrain.operators.language.prompts.classic import (
     CONTEXT_RERANKING_PROMPT_TEMPLATE,
     RESPONSE_COMPLETENESS_WRT_CONTEXT_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 
 from uptrain.operators.language.prompts.few_shots import (
     CONTEXT_CONCISENESS_FEW_SHOT__CLASSIFY,
@@ -151,29 +160,52 @@ class ContextRelevance(ColumnOp):
                 f"Invalid eval_type: {self.settings.eval_type}. Must be either 'basic' or 'cot'"
             )
 
-        for idx, row in enumerate(data):
-            kwargs = row
-            kwargs.update(
-                {
-                    "output_format": output_format,
-                    "prompting_instructions": prompting_instructions,
-                    "few_shot_examples": few_shot_examples,
-                }
-            )
-            try:
-                grading_prompt_template = CONTEXT_RELEVANCE_PROMPT_TEMPLATE.replace(
+        prompt_kwargs = {
+            "output_format": output_format,
+            "prompting_instructions": prompting_instructions,
+            "few_shot_examples": few_shot_examples,
+        }
+        if use_packed_requests(self.settings, scenario_vars):
+            output_payloads = fetch_packed_responses(
+                self._api_client,
+                CONTEXT_RELEVANCE_PROMPT_TEMPLATE.replace(
                     "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
-            except KeyError as e:
-                raise KeyError(
-                    f"Missing required attribute(s) for scenario description: {e}"
+                ),
+                data,
+                prompt_kwargs,
+                validation_func,
+                rows_per_request=self.settings.rows_per_request,
+                prompt_layout=self.settings.prompt_layout,
+                sampling_kwargs=get_sampling_kwargs(self.settings),
+            )
+        else:
+            for idx, row in enumerate(data):
+                kwargs = row
+                kwargs.update(prompt_kwargs)
+                try:
+                    system_prompt, grading_prompt_template = render_prompt(
+                        CONTEXT_RELEVANCE_PROMPT_TEMPLATE,
+                        kwargs,
+                        self.scenario_description,
+                        self.settings.prompt_layout,
+                    )
+                except KeyError as e:
+                    raise KeyError(
+                        f"Missing required attribute(s) for scenario description: {e}"
+                    )
+                input_payloads.append(
+                    self._api_client.make_payload(
+                        idx,
+                        grading_prompt_template,
+                        system_prompt=system_prompt,
+                        **get_sampling_kwargs(self.settings),
+                    )
                 )
-            input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+            output_payloads = self._api_client.fetch_responses(
+                input_payloads,
+                validation_func,
+                score_func=mapped_score(self.score_mapping),
             )
-        output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
-        )
 
         results = []
         for res in output_payloads:
@@ -183,13 +215,20 @@ class ContextRelevance(ColumnOp):
                 "explanation_context_relevance": None,
             }
             try:
-                score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                # majority vote over the sampled choices, if several were sampled
+                votes = [
+                    (output_json.get("Choice"), choice_idx)
+                    for choice_idx, output_json in enumerate(res.parsed_outputs())
+                    if output_json.get("Choice") in self.score_mapping
                 ]
-                output["score_context_relevance"] = float(score)
+                choice, confidence = majority_vote([vote for vote, _ in votes])
+                choice_idx = next(i for vote, i in votes if vote == choice)
+                output["score_context_relevance"] = float(self.score_mapping[choice])
                 output["explanation_context_relevance"] = res.response.choices[
-                    0
+                    choice_idx
                 ].message.content
+                if len(res.response.choices) > 1:
+                    output["confidence_context_relevance"] = confidence
             except Exception:
                 logger.error(
                     f"Error when processing payload at index {idx}: {res.error}"
@@ -322,20 +361,25 @@ class ResponseCompletenessWrtContext(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = (
-                    RESPONSE_COMPLETENESS_WRT_CONTEXT_PROMPT_TEMPLATE.replace(
-                        "{scenario_description}", self.scenario_description
-                    ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    RESPONSE_COMPLETENESS_WRT_CONTEXT_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
                 )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -347,7 +391,7 @@ class ResponseCompletenessWrtContext(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_response_completeness_wrt_context"] = float(score)
                 output["explanation_response_completeness_wrt_context"] = (
@@ -478,18 +522,25 @@ class ContextReranking(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = CONTEXT_RERANKING_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    CONTEXT_RERANKING_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -501,7 +552,7 @@ class ContextReranking(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_context_reranking"] = float(score)
                 output["explanation_context_reranking"] = res.response.choices[
@@ -634,18 +685,25 @@ class ContextConciseness(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = CONTEXT_CONCISENESS_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    CONTEXT_CONCISENESS_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -657,7 +715,7 @@ class ContextConciseness(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_context_conciseness"] = float(score)
                 output["explanation_context_conciseness"] = res.response.choices[
@@ -4,19 +4,20 @@ LLM-powered agent pipeline.
 """
 
 from __future__ import annotations
-import json
 import typing as t
 
 from loguru import logger
 import polars as pl
 
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
 from uptrain.operators.language.prompts.classic import (
     CONVERSATION_SATISFACTION_PROMPT_TEMPLATE,
     QUERY_RESOLUTION_PROMPT_TEMPLATE,
     CONVERSATION_NUMBER_OF_TURNS_PROMPT_TEMPLATE,
     CONVERSATION_GUIDELINE_ADHERENCE_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     CONVERSATION_SATISFACTION_FEW_SHOT__CLASSIFY,
     CONVERSATION_SATISFACTION_FEW_SHOT__COT,
@@ -175,20 +176,25 @@ class ConversationSatisfactionScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = (
-                    CONVERSATION_SATISFACTION_PROMPT_TEMPLATE.replace(
-                        "{scenario_description}", self.scenario_description
-                    ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    CONVERSATION_SATISFACTION_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
                 )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -200,7 +206,7 @@ class ConversationSatisfactionScore(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_conversation_satisfaction"] = float(score)
                 output["explanation_conversation_satisfaction"] = res.response.choices[
@@ -332,20 +338,25 @@ class QueryResolutionScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = (
-                    QUERY_RESOLUTION_PROMPT_TEMPLATE.replace(
-                        "{scenario_description}", self.scenario_description
-                    ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    QUERY_RESOLUTION_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
                 )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -357,7 +368,7 @@ class QueryResolutionScore(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_query_resolution"] = float(score)
                 output["explanation_query_resolution"] = res.response.choices[
@@ -480,11 +491,15 @@ class ConversationNumberOfTurnsScore(ColumnOp):
                     "few_shot_examples": few_shot_examples,
                 }
             )
-            grading_prompt_template = (
-                CONVERSATION_NUMBER_OF_TURNS_PROMPT_TEMPLATE.format(**kwargs)
+            system_prompt, grading_prompt_template = render_prompt(
+                CONVERSATION_NUMBER_OF_TURNS_PROMPT_TEMPLATE,
+                kwargs,
+                layout=self.settings.prompt_layout,
             )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
             input_payloads, validation_func
@@ -499,7 +514,7 @@ class ConversationNumberOfTurnsScore(ColumnOp):
                 "conversation_length": len(data[idx]["conversation"]),
             }
             try:
-                resp_content = json.loads(res.response.choices[0].message.content)
+                resp_content = res.parsed_output()
                 output["score_conversation_number_of_turns"] = resp_content["Turns"]
                 output["explanation_conversation_number_of_turns"] = resp_content
             except Exception:
@@ -624,11 +639,15 @@ class ConversationGuidelineAdherenceScore(ColumnOp):
                     "guideline_name": self.guideline_name,
                 }
             )
-            grading_prompt_template = (
-                CONVERSATION_GUIDELINE_ADHERENCE_PROMPT_TEMPLATE.format(**kwargs)
+            system_prompt, grading_prompt_template = render_prompt(
+                CONVERSATION_GUIDELINE_ADHERENCE_PROMPT_TEMPLATE,
+                kwargs,
+                layout=self.settings.prompt_layout,
             )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
 
         output_payloads = self._api_client.fetch_responses(
@@ -644,7 +663,7 @@ class ConversationGuidelineAdherenceScore(ColumnOp):
                 "explanation_conversation_guideline_adherence": None,
             }
             try:
-                score = 0.0 if json.loads(res.response.choices[0].message.content)["Choice"] == "A" else 1.0
+                score = 0.0 if res.parsed_output()["Choice"] == "A" else 1.0
                 output["score_conversation_guideline_adherence"] = float(score)
                 output["explanation_conversation_guideline_adherence"] = res.response.choices[
                     0
@@ -137,7 +137,7 @@ class CustomPromptEvalScore(ColumnOp):
                 # score_mapping is a mapping from choices to choice_scores
                 score_mapping = dict(zip(self.choices, self.choice_scores))
                 score = score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_custom_prompt"] = float(score)
             except Exception:
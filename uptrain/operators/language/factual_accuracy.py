@@ -19,12 +19,17 @@ from uptrain.operators.base import (
     TYPE_TABLE_OUTPUT,
 )
 from uptrain.utilities import polars_to_json_serializable_dict
-from uptrain.operators.language.llm import LLMMulticlient, parse_json
+from uptrain.operators.language.llm import (
+    LLMMulticlient,
+    get_sampling_kwargs,
+    majority_vote,
+)
 
 from uptrain.operators.language.prompts.classic import (
     FACT_EVAL_PROMPT_TEMPLATE,
     FACT_GENERATE_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     FACT_EVAL_FEW_SHOT__CLASSIFY,
     FACT_EVAL_FEW_SHOT__COT,
@@ -133,6 +138,12 @@ class ResponseFactualScore(ColumnOp):
             is_correct = is_correct and min([x in row for x in ["Reasoning"]]) > 0
         return is_correct
 
+    def fact_eval_score_func(self, llm_output):
+        judgements = [row["Judgement"].lower() for row in llm_output["Result"]]
+        if not judgements:
+            return None
+        return float(np.mean([self.score_mapping[x] for x in judgements]))
+
     def evaluate_local(self, data):
         """
         Our methodology is based on https://arxiv.org/abs/2305.14251
@@ -155,15 +166,20 @@ class ResponseFactualScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = FACT_GENERATE_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    FACT_GENERATE_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
             input_payloads, self.fact_generate_validate_func
@@ -173,7 +189,7 @@ class ResponseFactualScore(ColumnOp):
         for res in output_payloads:
             idx = res.metadata["index"]
             try:
-                facts = parse_json(res.response.choices[0].message.content)
+                facts = res.parsed_output()
                 fact_results.append((idx, facts))
             except Exception:
                 logger.error(
@@ -208,18 +224,28 @@ class ResponseFactualScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = FACT_EVAL_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    FACT_EVAL_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx,
+                    grading_prompt_template,
+                    system_prompt=system_prompt,
+                    **get_sampling_kwargs(self.settings),
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=self.fact_eval_score_func,
         )
 
         results = []
@@ -230,10 +256,32 @@ class ResponseFactualScore(ColumnOp):
                 "explanation_factual_accuracy": None,
             }
             try:
-                judgements = [x["Judgement"] for x in parse_json(res.response.choices[0].message.content)["Result"]]
-                score = np.mean([self.score_mapping[x.lower()] for x in judgements])
+                samples = []
+                for choice_idx, output_json in enumerate(res.parsed_outputs()):
+                    try:
+                        judgements = [
+                            x["Judgement"].lower() for x in output_json["Result"]
+                        ]
+                    except Exception:
+                        continue
+                    if all(x in self.score_mapping for x in judgements):
+                        samples.append((choice_idx, judgements))
+                # majority vote per fact, over the samples that judged all the facts
+                num_facts, _ = majority_vote([len(x) for _, x in samples])
+                samples = [(i, x) for i, x in samples if len(x) == num_facts]
+                votes = [
+                    majority_vote([x[fact_idx] for _, x in samples])
+                    for fact_idx in range(num_facts)
+                ]
+                score = np.mean([self.score_mapping[vote] for vote, _ in votes])
                 output["score_factual_accuracy"] = float(score)
-                output["explanation_factual_accuracy"] = res.response.choices[0].message.content
+                output["explanation_factual_accuracy"] = res.response.choices[
+                    samples[0][0]
+                ].message.content
+                if len(res.response.choices) > 1:
+                    output["confidence_factual_accuracy"] = float(
+                        np.mean([agreement for _, agreement in votes])
+                    )
             except Exception:
                 logger.error(
                     f"Error when processing payload at index {idx}: {res.error}"
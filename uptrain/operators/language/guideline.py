@@ -6,14 +6,15 @@ LLM-powered agent pipeline.
 from __future__ import annotations
 from loguru import logger
 
-import json
 import polars as pl
 import typing as t
 
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
 from uptrain.operators.language.prompts.classic import (
     GUIDELINE_ADHERENCE_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     GUIDELINE_ADHERENCE_FEW_SHOT__CLASSIFY,
     GUIDELINE_ADHERENCE_FEW_SHOT__COT,
@@ -160,18 +161,25 @@ class GuidelineAdherenceScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = GUIDELINE_ADHERENCE_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    GUIDELINE_ADHERENCE_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -184,7 +192,7 @@ class GuidelineAdherenceScore(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output[f"score_{self.guideline_name}_adherence"] = float(score)
                 output[f"explanation_{self.guideline_name}_adherence"] = res.response.choices[
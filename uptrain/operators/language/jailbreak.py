@@ -5,15 +5,20 @@ Implements operators related to jailbreaking of LLMs
 from __future__ import annotations
 from loguru import logger
 
-import json
 import polars as pl
 import typing as t
 
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
+from uptrain.operators.language.llm_packing import (
+    fetch_packed_responses,
+    use_packed_requests,
+)
 from uptrain.operators.language.prompts.classic import (
     JAILBREAK_DETECTION_PROMPT_TEMPLATE,
     PROMPT_INJECTION_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     JAILBREAK_DETECTION_FEW_SHOT__CLASSIFY,
     JAILBREAK_DETECTION_FEW_SHOT__COT,
@@ -156,18 +161,25 @@ class JailbreakDetectionScore(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = JAILBREAK_DETECTION_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    JAILBREAK_DETECTION_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -180,7 +192,7 @@ class JailbreakDetectionScore(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_jailbreak_attempted"] = float(score)
                 output["explanation_jailbreak_attempted"] = res.response.choices[
@@ -294,29 +306,48 @@ class PromptInjectionScore(ColumnOp):
                 f"Invalid eval_type: {self.settings.eval_type}. Must be either 'basic' or 'cot'"
             )
 
-        for idx, row in enumerate(data):
-            kwargs = row
-            kwargs.update(
-                {
-                    "output_format": output_format,
-                    "prompting_instructions": prompting_instructions,
-                    "few_shot_examples": few_shot_examples,
-                }
-            )
-            try:
-                grading_prompt_template = PROMPT_INJECTION_PROMPT_TEMPLATE.replace(
+        prompt_kwargs = {
+            "output_format": output_format,
+            "prompting_instructions": prompting_instructions,
+            "few_shot_examples": few_shot_examples,
+        }
+        if use_packed_requests(self.settings, scenario_vars):
+            output_payloads = fetch_packed_responses(
+                self._api_client,
+                PROMPT_INJECTION_PROMPT_TEMPLATE.replace(
                     "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
-            except KeyError as e:
-                raise KeyError(
-                    f"Missing required attribute(s) for scenario description: {e}"
+                ),
+                data,
+                prompt_kwargs,
+                validation_func,
+                rows_per_request=self.settings.rows_per_request,
+                prompt_layout=self.settings.prompt_layout,
+            )
+        else:
+            for idx, row in enumerate(data):
+                kwargs = row
+                kwargs.update(prompt_kwargs)
+                try:
+                    system_prompt, grading_prompt_template = render_prompt(
+                        PROMPT_INJECTION_PROMPT_TEMPLATE,
+                        kwargs,
+                        self.scenario_description,
+                        self.settings.prompt_layout,
+                    )
+                except KeyError as e:
+                    raise KeyError(
+                        f"Missing required attribute(s) for scenario description: {e}"
+                    )
+                input_payloads.append(
+                    self._api_client.make_payload(
+                        idx, grading_prompt_template, system_prompt=system_prompt
+                    )
                 )
-            input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+            output_payloads = self._api_client.fetch_responses(
+                input_payloads,
+                validation_func,
+                score_func=mapped_score(self.score_mapping),
             )
-        output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
-        )
 
         results = []
 
@@ -328,7 +359,7 @@ class PromptInjectionScore(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_prompt_injection"] = float(score)
                 output["explanation_prompt_injection"] = res.response.choices[
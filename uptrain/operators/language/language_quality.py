@@ -7,13 +7,13 @@ aspects on a scale of 0 to 1, along with an explanation for the score.
 """
 
 from __future__ import annotations
-import json5
 import typing as t
 
 from loguru import logger
 import polars as pl
 
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
 from uptrain.operators.language.prompts.classic import (
     LANGUAGE_COHERENCE_PROMPT_TEMPLATE,
     LANGUAGE_CRITIQUE_FLUENCY_PROMPT_TEMPLATE,
@@ -21,6 +21,7 @@ from uptrain.operators.language.prompts.classic import (
     LANGUAGE_CRITIQUE_GRAMMAR_PROMPT_TEMPLATE,
     LANGUAGE_CRITIQUE_POLITENESS_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     LANGUAGE_CRITIQUE_FLUENCY_FEW_SHOT__CLASSIFY,
     LANGUAGE_CRITIQUE_FLUENCY_FEW_SHOT__COT,
@@ -167,18 +168,25 @@ class LanguageCritique(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = LANGUAGE_CRITIQUE_FLUENCY_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    LANGUAGE_CRITIQUE_FLUENCY_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping, "Score"),
         )
 
         results = []
@@ -190,12 +198,10 @@ class LanguageCritique(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json5.loads(res.response.choices[0].message.content)["Score"]
+                    res.parsed_output()["Score"]
                 ]
                 output["score_fluency"] = float(score)
-                output["explanation_fluency"] = json5.loads(res.response.choices[
-                    0
-                ].message.content)["Reasoning"]
+                output["explanation_fluency"] = res.parsed_output()["Reasoning"]
             except Exception:
                 logger.error(
                     f"Error when processing payload at index {idx}: {res.error}"
@@ -229,18 +235,25 @@ class LanguageCritique(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = LANGUAGE_CRITIQUE_COHERENCE_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    LANGUAGE_CRITIQUE_COHERENCE_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping, "Score"),
         )
 
         for res in output_payloads:
@@ -251,12 +264,10 @@ class LanguageCritique(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json5.loads(res.response.choices[0].message.content)["Score"]
+                    res.parsed_output()["Score"]
                 ]
                 output["score_coherence"] = float(score)
-                output["explanation_coherence"] = json5.loads(res.response.choices[
-                    0
-                ].message.content)["Reasoning"]
+                output["explanation_coherence"] = res.parsed_output()["Reasoning"]
             except Exception:
                 logger.error(
                     f"Error when processing payload at index {idx}: {res.error}"
@@ -290,18 +301,25 @@ class LanguageCritique(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = LANGUAGE_CRITIQUE_GRAMMAR_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    LANGUAGE_CRITIQUE_GRAMMAR_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping, "Score"),
         )
 
         for res in output_payloads:
@@ -312,12 +330,10 @@ class LanguageCritique(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json5.loads(res.response.choices[0].message.content)["Score"]
+                    res.parsed_output()["Score"]
                 ]
                 output["score_grammar"] = float(score)
-                output["explanation_grammar"] = json5.loads(res.response.choices[
-                    0
-                ].message.content)["Reasoning"]
+                output["explanation_grammar"] = res.parsed_output()["Reasoning"]
             except Exception:
                 logger.error(
                     f"Error when processing payload at index {idx}: {res.error}"
@@ -351,18 +367,25 @@ class LanguageCritique(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = LANGUAGE_CRITIQUE_POLITENESS_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    LANGUAGE_CRITIQUE_POLITENESS_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping, "Score"),
         )
 
         for res in output_payloads:
@@ -373,12 +396,10 @@ class LanguageCritique(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json5.loads(res.response.choices[0].message.content)["Score"]
+                    res.parsed_output()["Score"]
                 ]
                 output["score_politeness"] = float(score)
-                output["explanation_politeness"] = json5.loads(res.response.choices[
-                    0
-                ].message.content)["Reasoning"]
+                output["explanation_politeness"] = res.parsed_output()["Reasoning"]
             except Exception:
                 logger.error(
                     f"Error when processing payload at index {idx}: {res.error}"
@@ -498,18 +519,25 @@ class ResponseCoherence(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = LANGUAGE_COHERENCE_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    LANGUAGE_COHERENCE_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -521,7 +549,7 @@ class ResponseCoherence(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json5.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_response_coherence"] = float(score)
                 output["explanation_response_coherence"] = res.response.choices[
@@ -4,17 +4,70 @@ Implement checks to test language quality.
 
 from __future__ import annotations
 import asyncio
+import collections
+import json
+import os
 from concurrent.futures import ThreadPoolExecutor
-import random
+import threading
+import time
 import typing as t
+import weakref
 import json5
 
 from loguru import logger
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 if t.TYPE_CHECKING:
     from uptrain.framework import Settings
-from uptrain.utilities import lazy_load_dep
+from uptrain.utilities import lazy_load_dep, get_background_loop
+from uptrain.operators.language.llm_cache import (
+    ResponseCache,
+    get_response_cache,
+    payload_cache_key,
+)
+from uptrain.operators.language.llm_batch import (
+    BatchProvider,
+    OpenAIBatchProvider,
+    run_batch,
+)
+from uptrain.operators.language.llm_budget import (
+    BudgetExceededError,
+    BudgetReservation,
+    BudgetTracker,
+    get_current_budget,
+)
+from uptrain.operators.language.llm_hedging import RequestHedger
+from uptrain.operators.language.llm_scheduler import (
+    RequestScheduler,
+    get_current_run,
+    get_shared_scheduler,
+)
+from uptrain.operators.language.llm_metrics import (
+    RequestTelemetry,
+    get_current_operator,
+    record_telemetry,
+    summarize_payloads,
+)
+from uptrain.operators.language.llm_pool import ClientPool
+from uptrain.operators.language.llm_tokens import (
+    TokenCounter,
+    get_context_window,
+    get_token_counter,
+    truncate_prompt,
+)
+from uptrain.operators.language.llm_ratelimit import (
+    AdaptiveConcurrencyController,
+    TokenBucketLimiter,
+    backoff_delay,
+    get_shared_limiters,
+    get_response_headers,
+    parse_retry_after,
+)
 
 openai = lazy_load_dep("openai", "openai")
 aiolimiter = lazy_load_dep("aiolimiter", "aiolimiter>=1.1")
@@ -43,6 +96,36 @@ class Payload(BaseModel):
     metadata: dict = Field(default_factory=dict)
     response: t.Any = None
     error: t.Optional[str] = None
+    telemetry: t.Optional[RequestTelemetry] = None
+    # (response, JSON object of each choice) of the last response parsed
+    _parsed: t.Optional[tuple[t.Any, list[dict]]] = PrivateAttr(default=None)
+
+    def parsed_outputs(self) -> list[dict]:
+        """The JSON objects in the content of each choice of the response, parsed once
+        and reused by the validation and the scoring. Empty for choices without a valid
+        JSON object."""
+        if self._parsed is None or self._parsed[0] is not self.response:
+            self._parsed = (
+                self.response,
+                [parse_json(choice.message.content) for choice in self.response.choices],
+            )
+        return self._parsed[1]
+
+    def parsed_output(self) -> dict:
+        """The JSON object in the content of the first choice of the response."""
+        return self.parsed_outputs()[0]
+
+
+def load_json(json_str: str) -> t.Any:
+    """Parse with orjson (or the stdlib parser) first, and fall back to the much
+    slower json5 only for the lenient syntax LLMs sometimes emit - single quotes,
+    trailing commas, comments, etc."""
+    try:
+        if orjson is not None:
+            return orjson.loads(json_str)
+        return json.loads(json_str)
+    except ValueError:
+        return json5.loads(json_str)
 
 
 def parse_json(json_str: str) -> dict:
@@ -50,57 +133,215 @@ def parse_json(json_str: str) -> dict:
     last_brace_index = json_str.rfind('}')
     json_str = json_str[first_brace_index:last_brace_index + 1]
     try:
-        return json5.loads(json_str)
+        return load_json(json_str)
     except Exception as e:
         logger.error(f"Error when parsing JSON: {e}")
         return {}
 
-def run_validation(llm_output, validation_func):
-    llm_output = parse_json(llm_output)
+def validate_output(llm_output: dict, validation_func: t.Callable) -> bool:
     try:
         return validation_func(llm_output)
     except Exception as e:
         logger.error(f"Error when running validation function: {e}")
         return False
 
+def run_validation(llm_output, validation_func):
+    return validate_output(parse_json(llm_output), validation_func)
+
+def validate_payload(payload: Payload, validation_func: t.Callable) -> bool:
+    """Validate the response of the payload, keeping the parsed output for scoring.
+    With several sampled choices, the response is valid if any of them is."""
+    return any(
+        validate_output(output, validation_func) for output in payload.parsed_outputs()
+    )
+
+
+def get_sampling_kwargs(settings: Settings) -> dict:
+    """`make_payload` arguments to sample `settings.num_samples` choices per request."""
+    if settings.num_samples <= 1:
+        return {}
+    return {"n": settings.num_samples, "temperature": settings.sampling_temperature}
+
+
+def majority_vote(votes: t.Sequence[t.Any]) -> tuple[t.Any, float]:
+    """The most common of the votes (the earliest on ties), and the fraction of the
+    votes that agree with it."""
+    if not len(votes):
+        raise ValueError("No votes to aggregate")
+    counts = collections.Counter(votes)
+    winner, count = counts.most_common(1)[0]
+    return winner, count / len(votes)
+
+
+async def acquire_limiter(
+    limiter: t.Union[AsyncLimiter, TokenBucketLimiter], amount: float, priority: str
+) -> None:
+    """Acquire `amount` of capacity from the limiter, after the waiting requests of higher
+    priority classes. `aiolimiter.AsyncLimiter` serves its waiters in arrival order."""
+    if isinstance(limiter, TokenBucketLimiter):
+        await limiter.acquire(amount, priority)
+    else:
+        await limiter.acquire(amount)
+
+
+async def adjust_limiter(
+    limiter: t.Union[AsyncLimiter, TokenBucketLimiter], amount: float
+) -> None:
+    """Return `amount` of capacity to the limiter, or consume it without waiting
+    if negative. Used to settle a reservation once the actual usage is known.
+    `aiolimiter.AsyncLimiter` has no public way to do so, its reservations stand.
+    """
+    if isinstance(limiter, TokenBucketLimiter):
+        await limiter.aadjust(amount)
+
+
+async def send_request(
+    payload: Payload, aclient: t.Any, with_headers: bool = False
+) -> tuple[t.Any, t.Mapping[str, str]]:
+    """Send the payload upstream, returning the response and the response headers (if
+    asked for and the client exposes them).
+    """
+    if aclient is None:
+        litellm = lazy_load_dep("litellm", "litellm")
+        response = await litellm.acompletion(**payload.data)
+        return response, {}
+
+    raw_completions = (
+        getattr(aclient.chat.completions, "with_raw_response", None)
+        if with_headers
+        else None
+    )
+    if raw_completions is not None:
+        raw_response = await raw_completions.create(**payload.data, timeout=180)
+        return raw_response.parse(), raw_response.headers
+    response = await aclient.chat.completions.create(**payload.data, timeout=180)
+    return response, {}
+
+
+async def send_hedged_request(
+    payload: Payload,
+    aclient: t.Any,
+    hedger: t.Optional[RequestHedger] = None,
+    hedge_aclient: t.Any = None,
+    with_headers: bool = False,
+) -> tuple[t.Any, t.Mapping[str, str], bool]:
+    """Send the payload, hedged with a duplicate request if it is slow. Returns the
+    response, the response headers and whether a duplicate request was sent.
+    """
+    if hedger is None:
+        response, headers = await send_request(payload, aclient, with_headers=with_headers)
+        return response, headers, False
+    (response, headers), hedged = await hedger.run(
+        lambda client: send_request(payload, client, with_headers=with_headers),
+        aclient,
+        hedge_aclient,
+    )
+    return response, headers, hedged
+
 
 async def async_process_payload(
     payload: Payload,
-    rpm_limiter: AsyncLimiter,
-    tpm_limiter: AsyncLimiter,
+    rpm_limiter: t.Union[AsyncLimiter, TokenBucketLimiter],
+    tpm_limiter: t.Union[AsyncLimiter, TokenBucketLimiter],
     aclient: t.Any,
     max_retries: int,
     validate_func: t.Callable = None,
+    cache: t.Optional[ResponseCache] = None,
+    token_counter: t.Optional[TokenCounter] = None,
+    completion_tokens_reserve: int = 500,
+    controller: t.Optional[AdaptiveConcurrencyController] = None,
+    hedger: t.Optional[RequestHedger] = None,
+    hedge_aclient: t.Any = None,
 ) -> Payload:
-    messages = payload.data["messages"]
-    total_chars = sum(len(msg["role"]) + len(msg["content"]) for msg in messages)
-    total_tokens = total_chars // 3  # average token length is 3, conservatively
-    await rpm_limiter.acquire(1)
-    # TODO: we should also count the response tokens, but this is a good baseline
-    # since our use-case is evaluations mostly, not generation
-    await tpm_limiter.acquire(total_tokens)
+    if payload.telemetry is None:
+        payload.telemetry = RequestTelemetry(model=payload.data.get("model", "unknown"))
+    telemetry = payload.telemetry
+
+    if cache is not None:
+        cache_key = payload_cache_key(payload.data)
+        cached_response = cache.get_response(cache_key)
+        if cached_response is not None:
+            payload.response = cached_response
+            if validate_func is None or validate_payload(payload, validate_func):
+                payload.metadata["cached"] = True
+                telemetry.cached = True
+                return payload
+            payload.response = None
+
+    # reserve the prompt tokens plus the completion budget up front, and settle
+    # against the reported usage once the call returns
+    model = payload.data["model"]
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    prompt_tokens = token_counter.count_messages(payload.data["messages"], model)
+    completion_tokens = payload.data.get("max_tokens") or completion_tokens_reserve
+    # each sampled choice has its own completion
+    completion_tokens *= payload.data.get("n", 1)
+    reserved_tokens = min(prompt_tokens + completion_tokens, tpm_limiter.max_rate)
+    wait_start = time.perf_counter()
+    priority = payload.metadata.get("priority", "default")
+    await acquire_limiter(rpm_limiter, 1, priority)
+    await acquire_limiter(tpm_limiter, reserved_tokens, priority)
+    telemetry.queue_time += time.perf_counter() - wait_start
+    used_tokens = 0
+    # only responses that passed the validation are worth caching
+    validated = False
 
     for count in range(max_retries):  # failed requests don't count towards rate limit
         try:
-            if aclient is not None:
-                payload.response = await aclient.chat.completions.create(
-                    **payload.data, timeout=180
-                )
+            if controller is not None:
+                wait_start = time.perf_counter()
+                async with controller.slot():
+                    request_start = time.perf_counter()
+                    telemetry.queue_time += request_start - wait_start
+                    telemetry.attempts += 1
+                    try:
+                        payload.response, headers, hedged = await send_hedged_request(
+                            payload, aclient, hedger, hedge_aclient, with_headers=True
+                        )
+                    finally:
+                        telemetry.latency += time.perf_counter() - request_start
+                controller.on_success(headers)
             else:
-                litellm = lazy_load_dep("litellm", "litellm")
-                payload.response = await litellm.acompletion(
-                    **payload.data,
+                request_start = time.perf_counter()
+                telemetry.attempts += 1
+                try:
+                    payload.response, _, hedged = await send_hedged_request(
+                        payload, aclient, hedger, hedge_aclient
+                    )
+                finally:
+                    telemetry.latency += time.perf_counter() - request_start
+            if hedged:
+                payload.metadata["hedged"] = True
+                telemetry.hedged = True
+                # the duplicate request counts towards the rate limits as well
+                await adjust_limiter(rpm_limiter, -1)
+                await adjust_limiter(tpm_limiter, -prompt_tokens)
+            usage = getattr(payload.response, "usage", None)
+            if usage is not None and usage.total_tokens:
+                used_tokens += usage.total_tokens
+                telemetry.prompt_tokens += usage.prompt_tokens or 0
+                telemetry.completion_tokens += usage.completion_tokens or 0
+                details = getattr(usage, "prompt_tokens_details", None)
+                telemetry.cached_prompt_tokens += (
+                    getattr(details, "cached_tokens", None) or 0
                 )
+            else:
+                used_tokens += reserved_tokens
             if validate_func is not None:
-                if not run_validation(
-                    payload.response.choices[0].message.content, validate_func
-                ):
+                if not validate_payload(payload, validate_func):
+                    telemetry.validation_failures += 1
                     raise Exception(
                         f"Response doesn't pass the validation func.\nResponse: {payload.response.choices[0].message.content}"
                     )
+            validated = True
             break
         except Exception as exc:
             logger.error(f"Error when sending request to LLM API: {exc}")
+            if "Response doesn't pass the validation func" not in str(exc):
+                telemetry.errors += 1
+            if isinstance(exc, openai.RateLimitError) or type(exc).__name__ == "RateLimitError":
+                telemetry.throttles += 1
             sleep_and_retry = count < max_retries - 1
             if aclient is not None:
                 if not (
@@ -127,31 +368,33 @@ async def async_process_payload(
                     sleep_and_retry = False
 
             if sleep_and_retry:
+                headers = get_response_headers(exc)
+                # with litellm, we only retry on rate limit errors
+                is_throttled = aclient is None or isinstance(exc, openai.RateLimitError)
+                if controller is not None and is_throttled:
+                    delay = controller.on_throttle(headers, count)
+                elif controller is not None:
+                    delay = controller.backoff_delay(count, parse_retry_after(headers))
+                else:
+                    delay = backoff_delay(
+                        count, parse_retry_after(headers), throttled=is_throttled
+                    )
                 logger.info(
-                    f"Going to sleep before retrying for payload {payload.metadata['index']}"
+                    f"Going to sleep for {delay:.1f}s before retrying for payload {payload.metadata['index']}"
                 )
-                await asyncio.sleep(random.uniform(5, 30) * count + 60)
+                await asyncio.sleep(delay)
             elif (
                 isinstance(exc, openai.BadRequestError)
                 and exc.code is not None
                 and "context_length" in exc.code
                 and count < max_retries - 1
             ):
-                # refer - https://github.com/BerriAI/reliableGPT/
-                # if required to set token limit - https://learn.microsoft.com/en-us/azure/ai-services/openai/how-to/chatgpt?pivots=programming-language-chat-completions#managing-conversations
-
-                fallback = {
-                    "gpt-3.5-turbo": "gpt-3.5-turbo-16k",
-                    "gpt-3.5-turbo-0613": "gpt-3.5-turbo-16k-0613",
-                    "gpt-3.5-turbo-16k": "claude-instant-1.2",
-                    "gpt-3.5-turbo-16k-0613": "claude-instant-1.2",
-                    "gpt-4": "gpt-4-32k",
-                    "gpt-4-0613": "gpt-4-32k-0613",
-                    "gpt-4-32k": "claude-2.0",
-                    "gpt-4-32k-0613": "claude-2.0",
-                }
-                if payload.data["model"] in fallback.keys():
-                    payload.data["model"] = fallback[payload.data["model"]]
+                # the pre-flight check in `make_payload` keeps this rare, it only
+                # happens for models missing from the context window table
+                fallback_model = payload.metadata.pop("long_context_model", None)
+                if fallback_model is not None and fallback_model != payload.data["model"]:
+                    payload.data["model"] = fallback_model
+                    payload.metadata["routed_to_long_context_model"] = True
                     logger.info(
                         f"Switching to larger context model for payload {payload.metadata['index']}"
                     )
@@ -164,33 +407,111 @@ async def async_process_payload(
                 payload.error = str(exc)
                 break
 
+    if used_tokens:
+        await adjust_limiter(tpm_limiter, reserved_tokens - used_tokens)
+    if cache is not None and validated and payload.error is None:
+        cache.set_response(cache_key, payload.response)
     return payload
 
 
+# Async clients shared by all LLMMulticlients running on an event loop, so they reuse a
+# single connection pool. The connections are bound to the loop, hence one set per loop.
+_SHARED_ACLIENTS: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[tuple, t.Any]
+] = weakref.WeakKeyDictionary()
+_SHARED_ACLIENTS_LOCK = threading.Lock()
+
+
+def get_shared_aclient(client_cls: type, **kwargs) -> t.Any:
+    """Return the async client of the given class, created with these arguments, shared
+    on the running event loop."""
+    key = (client_cls, tuple(sorted(kwargs.items())))
+    loop = asyncio.get_running_loop()
+    with _SHARED_ACLIENTS_LOCK:
+        aclients = _SHARED_ACLIENTS.setdefault(loop, {})
+        if key not in aclients:
+            aclients[key] = client_cls(**kwargs)
+        return aclients[key]
+
+
+async def close_shared_aclients() -> None:
+    """Close the async clients shared on the running event loop. Call it before closing
+    a loop that `LLMMulticlient` coroutines were awaited on."""
+    with _SHARED_ACLIENTS_LOCK:
+        aclients = _SHARED_ACLIENTS.pop(asyncio.get_running_loop(), {})
+    for aclient in aclients.values():
+        close = getattr(aclient, "close", None)
+        if close is not None:
+            await close()
+
+
+get_background_loop().on_shutdown(close_shared_aclients)
+
+
 class LLMMulticlient:
     """Uses asyncio to send requests to LLM APIs concurrently."""
 
-    def __init__(self, settings: t.Optional[Settings] = None, aclient: t.Any = None):
+    def __init__(
+        self,
+        settings: t.Optional[Settings] = None,
+        aclient: t.Any = None,
+        token_counter: t.Optional[TokenCounter] = None,
+        batch_provider: t.Optional[BatchProvider] = None,
+    ):
         self._max_tries = 4
         # TODO: consult for accurate limits - https://platform.openai.com/account/rate-limits
         self._rpm_limit = 200
         self._tpm_limit = 90_000
         self.aclient = aclient
         self.settings = settings
+        # None picks a counter based on the model of each payload
+        self._token_counter = token_counter
+        self._completion_tokens_reserve = 500
+        self._controller = AdaptiveConcurrencyController(
+            max_concurrency=None, adaptive=False
+        )
+        self._cache = None
+        self._coalesce_requests = False
+        # requests currently in flight, keyed by a hash of the request body
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.num_coalesced_requests = 0
+        self._persistent_loop = False
+        self._execution_mode = "online"
+        self._batch_provider = batch_provider
+        self._batch_poll_interval = 60
+        # how the async client was built, to build a private one off the background loop
+        self._aclient_factory: t.Optional[tuple[type, dict]] = None
+        self._hedger: t.Optional[RequestHedger] = None
+        self._pool: t.Optional[ClientPool] = None
+        self._hedge_aclient_kwargs: t.Optional[dict] = None
+        self._priority = "default"
+        # escalations of the cascades run through the client, see `llm_cascade`
+        self.cascade_stats = None
+        # budget of the run the client is created in, if any
+        self._budget: t.Optional[BudgetTracker] = get_current_budget()
         if settings is not None:
+            self._cache = get_response_cache(settings)
+            self._coalesce_requests = settings.coalesce_requests
+            self._persistent_loop = settings.persistent_event_loop
+            self._execution_mode = settings.execution_mode
+            self._batch_poll_interval = settings.batch_poll_interval
+            self._priority = settings.request_priority
             if (
                 settings.model.startswith("gpt")
                 and settings.check_and_get("openai_api_key") is not None
             ):
                 openai.api_key = settings.check_and_get("openai_api_key")  # type: ignore
                 if self.aclient is None:
-                    self.aclient = AsyncOpenAI()
+                    self.aclient = self._make_aclient(
+                        AsyncOpenAI, api_key=settings.openai_api_key
+                    )
 
             if (
                 settings.model.startswith("azure")
                 and settings.check_and_get("azure_api_key") is not None
             ):
-                self.aclient = AsyncAzureOpenAI(
+                self.aclient = self._make_aclient(
+                    AsyncAzureOpenAI,
                     api_key=settings.azure_api_key,
                     api_version=settings.azure_api_version,
                     azure_endpoint=settings.azure_api_base,
@@ -200,7 +521,8 @@ class LLMMulticlient:
                 settings.model.startswith("anyscale")
                 and settings.check_and_get("anyscale_api_key") is not None
             ):
-                self.aclient = AsyncOpenAI(
+                self.aclient = self._make_aclient(
+                    AsyncOpenAI,
                     api_key=settings.anyscale_api_key,
                     base_url="https://api.endpoints.anyscale.com/v1",
                 )
@@ -208,7 +530,8 @@ class LLMMulticlient:
                 settings.model.startswith("together")
                 and settings.check_and_get("together_api_key") is not None
             ):
-                self.aclient = AsyncOpenAI(
+                self.aclient = self._make_aclient(
+                    AsyncOpenAI,
                     api_key=settings.together_api_key,
                     base_url="https://api.together.xyz/v1",
                 )
@@ -218,13 +541,97 @@ class LLMMulticlient:
                 self.aclient = None        
             self._rpm_limit = settings.check_and_get("rpm_limit")
             self._tpm_limit = settings.check_and_get("tpm_limit")
+            self._completion_tokens_reserve = settings.completion_tokens_reserve
+            self._controller = AdaptiveConcurrencyController(
+                max_concurrency=settings.max_concurrency,
+                adaptive=settings.adaptive_concurrency,
+            )
+            if settings.client_pool:
+                self._pool = ClientPool.from_settings(settings)
+            if self._budget is None:
+                budget = BudgetTracker.from_settings(settings)
+                if budget.has_limits:
+                    self._budget = budget
+            if settings.hedge_requests:
+                self._hedger = RequestHedger(
+                    percentile=settings.hedge_percentile,
+                    min_delay=settings.hedge_min_delay,
+                )
+                if settings.hedge_api_base is not None:
+                    self._hedge_aclient_kwargs = dict(
+                        api_key=settings.hedge_api_key or self._get_provider_and_key()[1],
+                        base_url=settings.hedge_api_base,
+                    )
+
+    def _make_aclient(self, client_cls: type, **kwargs) -> t.Any:
+        """Build the async client. With a persistent event loop, the client shared on the
+        running loop by every client with the same arguments is used instead."""
+        self._aclient_factory = (client_cls, kwargs)
+        return client_cls(**kwargs)
+
+    def _get_aclient(self) -> t.Any:
+        """The async client to use on the currently running event loop."""
+        if self._persistent_loop and self._aclient_factory is not None:
+            client_cls, kwargs = self._aclient_factory
+            return get_shared_aclient(client_cls, **kwargs)
+        return self.aclient
+
+    def _get_hedge_aclient(self) -> t.Any:
+        """The async client for hedged requests, None to hedge on the primary client."""
+        if self._hedge_aclient_kwargs is None:
+            return None
+        return get_shared_aclient(AsyncOpenAI, **self._hedge_aclient_kwargs)
+
+    def _get_limiters(
+        self,
+    ) -> tuple[TokenBucketLimiter, TokenBucketLimiter]:
+        """The (requests per minute, tokens per minute) limiters for this client."""
+        if self.settings is not None:
+            # limiters are shared by all clients using the same provider and key
+            return get_shared_limiters(self.settings, *self._get_provider_and_key())
+        return (
+            TokenBucketLimiter(self._rpm_limit, time_period=60),
+            TokenBucketLimiter(self._tpm_limit, time_period=60),
+        )
+
+    def _get_scheduler(self) -> t.Optional[RequestScheduler]:
+        """The scheduler admitting the requests of this client on the running event loop."""
+        if self.settings is None:
+            return None
+        return get_shared_scheduler(
+            *self._get_provider_and_key(), self.settings.max_concurrency
+        )
+
+    def _get_provider_and_key(self) -> tuple[str, t.Optional[str]]:
+        """Provider the client talks to, and the API key it uses."""
+        model = self.settings.model
+        for provider in ["azure", "anyscale", "together"]:
+            if model.startswith(provider):
+                return provider, getattr(self.settings, f"{provider}_api_key")
+        if model.startswith("gpt"):
+            return "openai", self.settings.openai_api_key
+        provider = model.split("/")[0] if "/" in model else "litellm"
+        if self.settings.api_base is not None:
+            provider = f"{provider}@{self.settings.api_base}"
+        return provider, None
 
     def make_payload(
         self,
         index: int,
         prompt: str,
         temperature: float = 0.1,
+        variables: t.Optional[t.Sequence[str]] = None,
+        n: int = 1,
+        system_prompt: t.Optional[str] = None,
     ) -> Payload:
+        """
+        Build the payload for a single prompt. `variables` are the values substituted
+        into the prompt, the longest of which is truncated if the prompt doesn't fit in
+        the context window of the model (defaults to the task data fields of the prompt).
+        With `n` > 1, that many choices are sampled in the same request, paying for the
+        prompt tokens only once. `system_prompt` is sent ahead of the prompt as a system
+        message, and is never truncated.
+        """
         model = self.settings.model
         seed = self.settings.seed
         response_format = self.settings.response_format
@@ -233,13 +640,18 @@ class LLMMulticlient:
         custom_llm_provider = self.settings.custom_llm_provider
         api_base = self.settings.api_base
 
-        prefixes = ["anyscale/", "azure/", "together/"]
-        for prefix in prefixes:
-            model = model.replace(prefix, "")
+        model = self._strip_model_prefix(model)
 
+        prompt, model, metadata = self._fit_context_window(
+            prompt, model, variables, system_prompt
+        )
         messages = [{"role": "user", "content": prompt}]
+        if system_prompt is not None:
+            messages.insert(0, {"role": "system", "content": system_prompt})
 
         data = {"model": model, "messages": messages, "temperature": temperature}
+        if n > 1:
+            data["n"] = n
         if seed is not None:
             data["seed"] = seed
         if response_format is not None:
@@ -251,15 +663,157 @@ class LLMMulticlient:
         return Payload(
             endpoint="chat.completions",
             data=data,
-            metadata={"index": index},
+            metadata={
+                "index": index,
+                "priority": self._priority,
+                "run": get_current_run() or f"client-{id(self)}",
+                **metadata,
+            },
+            telemetry=RequestTelemetry(model=model, operator=get_current_operator()),
+        )
+
+    def _strip_model_prefix(self, model: str) -> str:
+        for prefix in ["anyscale/", "azure/", "together/"]:
+            model = model.replace(prefix, "")
+        return model
+
+    def _fit_context_window(
+        self,
+        prompt: str,
+        model: str,
+        variables: t.Optional[t.Sequence[str]] = None,
+        system_prompt: t.Optional[str] = None,
+    ) -> tuple[str, str, dict]:
+        """
+        Pre-flight check of the prompt length against the context window of the model.
+        Prompts that don't fit are routed to the long context model if they fit there,
+        else the longest variable in them is truncated. Returns the prompt and model to
+        use, and metadata recording what was done.
+        """
+        long_context_model = self.settings.long_context_model
+        if long_context_model is not None:
+            long_context_model = self._strip_model_prefix(long_context_model)
+        windows = self.settings.model_context_windows
+        context_window = get_context_window(self.settings.model, windows)
+        if context_window is None:
+            # can't check ahead of the request, switch models if the API rejects it
+            if long_context_model is None:
+                return prompt, model, {}
+            return prompt, model, {"long_context_model": long_context_model}
+
+        counter = self._token_counter or get_token_counter(model)
+        messages = [{"role": "user", "content": prompt}]
+        if system_prompt is not None:
+            messages.insert(0, {"role": "system", "content": system_prompt})
+        prompt_tokens = counter.count_messages(messages, model)
+        # the chat format and the system prompt add to the prompt text
+        overhead = prompt_tokens - counter.count_text(prompt, model)
+        completion_tokens = self._completion_tokens_reserve
+        if prompt_tokens + completion_tokens <= context_window:
+            return prompt, model, {}
+
+        if long_context_model is not None:
+            long_context_window = get_context_window(
+                self.settings.long_context_model, windows
+            )
+            model = long_context_model
+            if (
+                long_context_window is None
+                or prompt_tokens + completion_tokens <= long_context_window
+            ):
+                return prompt, model, {"routed_to_long_context_model": True}
+            context_window = long_context_window
+
+        if not self.settings.truncate_long_prompts:
+            return prompt, model, {}
+        truncated = truncate_prompt(
+            prompt,
+            context_window - completion_tokens - overhead,
+            model,
+            token_counter=counter,
+            variables=variables,
+        )
+        if truncated is None:
+            logger.warning(
+                f"Prompt of {prompt_tokens} tokens doesn't fit in the context window of {model} "
+                f"({context_window} tokens) and can't be truncated, sending it as is"
+            )
+            return prompt, model, {}
+        logger.warning(
+            f"Prompt of {prompt_tokens} tokens doesn't fit in the context window of {model} "
+            f"({context_window} tokens), truncated it so the row is graded on part of its data"
         )
+        return truncated, model, {"truncated": True}
 
     def fetch_responses(
+        self,
+        input_payloads: list[Payload],
+        validate_func: t.Callable = None,
+        return_summary: bool = False,
+        score_func: t.Optional[t.Callable[[dict], t.Optional[float]]] = None,
+    ) -> t.Union[list[Payload], tuple[list[Payload], dict]]:
+        """
+        Send the payloads and wait for all the responses. With `return_summary`, also
+        returns the telemetry of the payloads aggregated per model and operator (see
+        `llm_metrics.summarize_payloads`), plus the wall time of the whole call.
+
+        Grading calls pass the `score_func` of the evaluator, the score of a parsed
+        output. If `Settings.cascade_model` is set, the payloads are then graded by it
+        first, and only the uncertain ones by the model they were made for (see
+        `llm_cascade.fetch_cascaded_responses`).
+        """
+        start = time.perf_counter()
+        cascade_stats = None
+        if self._cascades(input_payloads, score_func):
+            from uptrain.operators.language.llm_cascade import (
+                CascadeStats,
+                fetch_cascaded_responses,
+                get_current_cascade_stats,
+            )
+
+            output_payloads, cascade_stats = fetch_cascaded_responses(
+                self, input_payloads, score_func, validate_func
+            )
+            if self.cascade_stats is None:
+                self.cascade_stats = CascadeStats()
+            self.cascade_stats.update(cascade_stats)
+            # and to the stats of the evaluation run, if any
+            run_stats = get_current_cascade_stats()
+            if run_stats is not None:
+                run_stats.update(cascade_stats)
+        else:
+            output_payloads = self._fetch_responses(input_payloads, validate_func)
+        if not return_summary:
+            return output_payloads
+        summary = summarize_payloads(output_payloads or [])
+        summary["wall_time"] = time.perf_counter() - start
+        if cascade_stats is not None:
+            summary["cascade"] = cascade_stats.summary()
+        return output_payloads, summary
+
+    def _cascades(
+        self, input_payloads: list[Payload], score_func: t.Optional[t.Callable]
+    ) -> bool:
+        """Whether the payloads are graded by the cheap judge first."""
+        if score_func is None or self.settings is None or not input_payloads:
+            return False
+        cascade_model = self.settings.cascade_model
+        if cascade_model is None:
+            return False
+        cascade_model = self._strip_model_prefix(cascade_model)
+        return any(payload.data["model"] != cascade_model for payload in input_payloads)
+
+    def _fetch_responses(
         self, input_payloads: list[Payload], validate_func: t.Callable = None
     ) -> list[Payload]:
+        if self._persistent_loop and not get_background_loop().is_current():
+            # run on the long-lived loop, so connections are reused across calls
+            return get_background_loop().run(
+                self.async_fetch_responses(input_payloads, validate_func=validate_func)
+            )
         try:
             return asyncio.run(
-                self.async_fetch_responses(input_payloads, validate_func=validate_func)
+                self._async_fetch_responses_private(input_payloads, validate_func)
             )
         except Exception as e:
             try:
@@ -271,30 +825,461 @@ class LLMMulticlient:
                     with ThreadPoolExecutor(max_workers=1) as executor:
                         return executor.submit(
                             asyncio.run,
-                            self.async_fetch_responses(
-                                input_payloads, validate_func=validate_func
+                            self._async_fetch_responses_private(
+                                input_payloads, validate_func
                             ),
                         ).result()
             except Exception:
                 logger.error(f"Caught an exception: {e}")
 
+    async def _async_fetch_responses_private(
+        self, input_payloads: list[Payload], validate_func: t.Callable = None
+    ) -> list[Payload]:
+        """`async_fetch_responses` on an event loop of its own, closing the clients bound
+        to the loop once done."""
+        try:
+            return await self.async_fetch_responses(
+                input_payloads, validate_func=validate_func
+            )
+        finally:
+            await close_shared_aclients()
+
+    def iter_responses(
+        self,
+        input_payloads: t.Iterable[Payload],
+        validate_func: t.Callable = None,
+        max_pending: t.Optional[int] = None,
+    ) -> t.Iterator[Payload]:
+        """Synchronous version of `astream_responses`: yields payloads as they complete."""
+        stream = self.astream_responses(
+            input_payloads, validate_func=validate_func, max_pending=max_pending
+        )
+        if self._persistent_loop and not get_background_loop().is_current():
+            run = get_background_loop().run
+            private_loop = None
+        else:
+            private_loop = asyncio.new_event_loop()
+            run = private_loop.run_until_complete
+        try:
+            while True:
+                try:
+                    yield run(stream.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            run(stream.aclose())
+            if private_loop is not None:
+                private_loop.run_until_complete(close_shared_aclients())
+                private_loop.close()
+
+    async def astream_responses(
+        self,
+        input_payloads: t.Iterable[Payload],
+        validate_func: t.Callable = None,
+        max_pending: t.Optional[int] = None,
+    ) -> t.AsyncIterator[Payload]:
+        """Yield payloads in the order they complete, instead of waiting for the whole
+        batch. Use `metadata["index"]` to map them back to the inputs. Input payloads
+        are consumed lazily, with at most `max_pending` requests scheduled at a time
+        (twice the max concurrency, or the requests per minute limit, by default), so
+        memory stays bounded.
+        """
+        rpm_limiter, tpm_limiter = self._get_limiters()
+        aclient = self._get_aclient()
+        hedge_aclient = self._get_hedge_aclient()
+        if max_pending is None:
+            max_pending = 2 * (self._controller.max_concurrency or self._rpm_limit)
+        payloads_iter = iter(input_payloads)
+        pending: set[asyncio.Task] = set()
+
+        def schedule_more():
+            while len(pending) < max_pending:
+                payload = next(payloads_iter, None)
+                if payload is None:
+                    return
+                pending.add(
+                    asyncio.ensure_future(
+                        self._async_process_payload_tracked(
+                            payload,
+                            rpm_limiter,
+                            tpm_limiter,
+                            aclient,
+                            validate_func=validate_func,
+                            hedge_aclient=hedge_aclient,
+                        )
+                    )
+                )
+
+        schedule_more()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                schedule_more()
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
     async def async_fetch_responses(
         self,
         input_payloads: list[Payload],
         validate_func: t.Callable = None,
     ) -> list[Payload]:
-        rpm_limiter = AsyncLimiter(self._rpm_limit, time_period=60)
-        tpm_limiter = AsyncLimiter(self._tpm_limit, time_period=60)
+        if self._execution_mode == "batch":
+            return await self._async_fetch_responses_batch(
+                input_payloads, validate_func=validate_func
+            )
+        return await self._async_fetch_responses_online(
+            input_payloads, validate_func=validate_func
+        )
+
+    async def _async_fetch_responses_online(
+        self,
+        input_payloads: list[Payload],
+        validate_func: t.Callable = None,
+    ) -> list[Payload]:
+        rpm_limiter, tpm_limiter = self._get_limiters()
+        aclient = self._get_aclient()
+        hedge_aclient = self._get_hedge_aclient()
+        num_coalesced_before = self.num_coalesced_requests
         async_outputs = [
-            async_process_payload(
+            self._async_process_payload_tracked(
                 data,
                 rpm_limiter,
                 tpm_limiter,
-                self.aclient,
-                self._max_tries,
+                aclient,
                 validate_func=validate_func,
+                hedge_aclient=hedge_aclient,
             )
             for data in input_payloads
         ]
         output_payloads = await tqdm_asyncio.tqdm_asyncio.gather(*async_outputs)
+        self._log_budget(output_payloads)
+        if self.num_coalesced_requests > num_coalesced_before:
+            logger.info(
+                f"Saved {self.num_coalesced_requests - num_coalesced_before} LLM calls by coalescing identical requests"
+            )
+        if self._cache is not None:
+            logger.info(f"LLM response cache stats: {self._cache.stats()}")
+        if self._pool is not None:
+            logger.info(f"Client pool stats: {self._pool.stats()}")
+        if self._hedger is not None:
+            logger.info(
+                f"Hedged requests: {self._hedger.num_hedges_issued} issued, {self._hedger.num_hedges_won} won"
+            )
         return output_payloads
+
+    def _log_budget(self, output_payloads: list[Payload]) -> None:
+        """Warn about the requests dropped for exceeding the budget. The budget is only
+        enforced when requests are sent, so the responses already paid for are kept and
+        the dropped payloads are returned with their error set."""
+        num_dropped = sum(
+            1 for res in output_payloads if res.metadata.get("budget_exceeded")
+        )
+        if num_dropped:
+            logger.warning(
+                f"{num_dropped} LLM requests weren't sent as they exceed the budget. Spend: {self._budget.spend()}"
+            )
+
+    async def _async_fetch_responses_batch(
+        self,
+        input_payloads: list[Payload],
+        validate_func: t.Callable = None,
+    ) -> list[Payload]:
+        """Send the payloads through the provider's batch API. Requests that fail or
+        don't pass validation in the batch are retried online.
+        """
+        provider = self._batch_provider
+        if provider is None:
+            if self.aclient is None:
+                raise ValueError(
+                    "Batch execution mode requires an OpenAI compatible client or a batch provider."
+                )
+            provider = OpenAIBatchProvider(self._get_aclient())
+
+        pending, reservations = [], []
+        for payload in input_payloads:
+            if payload.telemetry is None:
+                payload.telemetry = RequestTelemetry(
+                    model=payload.data.get("model", "unknown")
+                )
+            if self._cache is not None:
+                cached_response = self._cache.get_response(payload_cache_key(payload.data))
+                if cached_response is not None:
+                    payload.response = cached_response
+                    payload.metadata["cached"] = True
+                    payload.telemetry.cached = payload.telemetry.success = True
+                    record_telemetry(payload.telemetry)
+                    continue
+            admitted, reservation = self._reserve_budget(payload)
+            if not admitted:
+                record_telemetry(payload.telemetry)
+                continue
+            pending.append(payload)
+            reservations.append(reservation)
+        if not len(pending):
+            return input_payloads
+
+        work_dir = os.path.join(self.settings.logs_folder, "batches")
+        start = time.perf_counter()
+        try:
+            await run_batch(pending, provider, work_dir, self._batch_poll_interval)
+        finally:
+            for payload, reservation in zip(pending, reservations):
+                telemetry = payload.telemetry
+                telemetry.attempts += 1
+                prompt_tokens = completion_tokens = 0
+                usage = getattr(payload.response, "usage", None)
+                if usage is not None:
+                    prompt_tokens = usage.prompt_tokens or 0
+                    completion_tokens = usage.completion_tokens or 0
+                    telemetry.prompt_tokens += prompt_tokens
+                    telemetry.completion_tokens += completion_tokens
+                self._charge_budget(
+                    payload,
+                    reservation,
+                    prompt_tokens,
+                    completion_tokens,
+                    attempted=payload.response is not None,
+                )
+
+        retry_payloads = []
+        for payload in pending:
+            if payload.error is None and (
+                validate_func is None or validate_payload(payload, validate_func)
+            ):
+                if self._cache is not None:
+                    self._cache.set_response(payload_cache_key(payload.data), payload.response)
+                payload.telemetry.total_time = time.perf_counter() - start
+                payload.telemetry.success = True
+                record_telemetry(payload.telemetry)
+                continue
+            if payload.error is None:
+                payload.telemetry.validation_failures += 1
+            payload.response, payload.error = None, None
+            retry_payloads.append(payload)
+        if len(retry_payloads):
+            # their telemetry is recorded once the online retry completes
+            logger.info(f"Retrying {len(retry_payloads)} failed batch requests online")
+            await self._async_fetch_responses_online(
+                retry_payloads, validate_func=validate_func
+            )
+        return input_payloads
+
+    async def _process_payload(
+        self,
+        payload: Payload,
+        rpm_limiter: t.Union[AsyncLimiter, TokenBucketLimiter],
+        tpm_limiter: t.Union[AsyncLimiter, TokenBucketLimiter],
+        aclient: t.Any,
+        max_retries: int,
+        **kwargs,
+    ) -> Payload:
+        """Send the payload upstream. With a client pool, the request is routed to a
+        pool member (with its own limiters), and failed requests are retried once on
+        each of the other members.
+        """
+        if self._pool is None:
+            return await async_process_payload(
+                payload, rpm_limiter, tpm_limiter, aclient, max_retries, **kwargs
+            )
+
+        data, tried = payload.data, []
+        for _ in range(len(self._pool.members)):
+            member = self._pool.acquire(exclude=tried)
+            tried.append(member)
+            if member.config.model is not None:
+                payload.data = {**data, "model": member.config.model}
+            payload.error = None
+            try:
+                payload = await async_process_payload(
+                    payload,
+                    member.rpm_limiter,
+                    member.tpm_limiter,
+                    member.get_aclient(),
+                    max_retries,
+                    **{**kwargs, "controller": member.controller},
+                )
+            except BaseException:
+                self._pool.release(member, None)
+                raise
+            self._pool.release(member, payload.error is None)
+            if payload.error is None:
+                break
+            payload.data = data
+            logger.info(
+                f"Request for payload {payload.metadata['index']} failed on {member.name}: {payload.error}"
+            )
+        return payload
+
+    async def _async_process_payload_tracked(
+        self, payload: Payload, *args: t.Any, **kwargs: t.Any
+    ) -> Payload:
+        """Process the payload and hand its telemetry to the metrics hooks."""
+        if payload.telemetry is None:
+            payload.telemetry = RequestTelemetry(
+                model=payload.data.get("model", "unknown")
+            )
+        telemetry = payload.telemetry
+        admitted, reservation = self._reserve_budget(payload)
+        if not admitted:
+            record_telemetry(telemetry)
+            return payload
+
+        # the payload may have been tried through the batch API already, charge only this try
+        usage_before = (telemetry.prompt_tokens, telemetry.completion_tokens, telemetry.attempts)
+        start = time.perf_counter()
+        scheduler = self._get_scheduler()
+        try:
+            if scheduler is not None:
+                async with scheduler.slot(
+                    payload.metadata.get("priority", self._priority),
+                    payload.metadata.get("run", ""),
+                ):
+                    telemetry.queue_time += time.perf_counter() - start
+                    payload = await self._async_process_payload_coalesced(
+                        payload, *args, **kwargs
+                    )
+            else:
+                payload = await self._async_process_payload_coalesced(
+                    payload, *args, **kwargs
+                )
+        finally:
+            self._charge_budget(
+                payload,
+                reservation,
+                telemetry.prompt_tokens - usage_before[0],
+                telemetry.completion_tokens - usage_before[1],
+                attempted=telemetry.attempts > usage_before[2],
+            )
+        payload.telemetry.total_time = time.perf_counter() - start
+        payload.telemetry.success = payload.response is not None and payload.error is None
+        record_telemetry(payload.telemetry)
+        return payload
+
+    def _reserve_budget(
+        self, payload: Payload
+    ) -> tuple[bool, t.Optional[BudgetReservation]]:
+        """Reserve the estimated tokens of the payload against the budget, moving it to
+        the fallback model if need be. Returns whether the payload can be sent, and the
+        reservation to settle with `_charge_budget`. Payloads that don't fit in the
+        budget are marked as failed."""
+        if self._budget is None:
+            return True, None
+        telemetry = payload.telemetry
+        model = payload.data["model"]
+        counter = self._token_counter or get_token_counter(model)
+        try:
+            model, reservation = self._budget.acquire(
+                model,
+                telemetry.operator,
+                counter.count_messages(payload.data["messages"], model),
+                payload.data.get("max_tokens", self._completion_tokens_reserve)
+                * payload.data.get("n", 1),
+            )
+        except BudgetExceededError as exc:
+            payload.error = str(exc)
+            payload.metadata["budget_exceeded"] = True
+            return False, None
+        if model != payload.data["model"]:
+            payload.data["model"] = telemetry.model = model
+            payload.metadata["budget_degraded"] = True
+        return True, reservation
+
+    def _charge_budget(
+        self,
+        payload: Payload,
+        reservation: t.Optional[BudgetReservation],
+        prompt_tokens: int,
+        completion_tokens: int,
+        attempted: bool,
+    ) -> None:
+        """Release the reservation of the payload, charging the tokens it used."""
+        if self._budget is None:
+            return
+        if attempted and not prompt_tokens + completion_tokens:
+            # no usage reported, charge the estimate
+            prompt_tokens = reservation.tokens
+        self._budget.charge(
+            reservation, payload.data["model"], prompt_tokens, completion_tokens
+        )
+
+    async def _async_process_payload_coalesced(
+        self,
+        payload: Payload,
+        rpm_limiter: t.Union[AsyncLimiter, TokenBucketLimiter],
+        tpm_limiter: t.Union[AsyncLimiter, TokenBucketLimiter],
+        aclient: t.Any,
+        validate_func: t.Callable = None,
+        hedge_aclient: t.Any = None,
+    ) -> Payload:
+        """Process the payload, sharing the upstream call with any identical request
+        already in flight on this client (in this batch or a concurrent one).
+        """
+        process_coro_args = (
+            rpm_limiter,
+            tpm_limiter,
+            aclient,
+            self._max_tries,
+        )
+        process_coro_kwargs = dict(
+            validate_func=validate_func,
+            cache=self._cache,
+            token_counter=self._token_counter,
+            completion_tokens_reserve=self._completion_tokens_reserve,
+            controller=self._controller,
+            hedger=self._hedger,
+            hedge_aclient=hedge_aclient,
+        )
+        if not self._coalesce_requests or payload.data.get("n", 1) > 1:
+            # sampled choices must stay independent across identical requests
+            return await self._process_payload(
+                payload, *process_coro_args, **process_coro_kwargs
+            )
+
+        key = payload_cache_key(payload.data)
+        loop = asyncio.get_running_loop()
+        leader = self._inflight.get(key)
+        if leader is not None and leader.get_loop() is loop:
+            try:
+                leader_payload = await asyncio.shield(leader)
+            except asyncio.CancelledError:
+                if not leader.cancelled():
+                    raise
+                leader_payload = None
+            response = leader_payload.response if leader_payload is not None else None
+            if response is not None and leader_payload.error is None and (
+                validate_func is None or validate_payload(leader_payload, validate_func)
+            ):
+                self.num_coalesced_requests += 1
+                payload.response = response
+                payload._parsed = leader_payload._parsed
+                payload.metadata["coalesced"] = True
+                if payload.telemetry is not None:
+                    payload.telemetry.coalesced = True
+                return payload
+            # the shared response doesn't work for this caller, go upstream on our own
+            return await self._process_payload(
+                payload, *process_coro_args, **process_coro_kwargs
+            )
+
+        future = loop.create_future()
+        self._inflight[key] = future
+        try:
+            payload = await self._process_payload(
+                payload, *process_coro_args, **process_coro_kwargs
+            )
+            future.set_result(payload)
+            return payload
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # mark as retrieved, in case nobody else is waiting
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
@@ -0,0 +1,240 @@
+"""
+Offline execution of LLM payloads through a provider batch API. Payloads are written
+to a JSONL file in the OpenAI batch format, submitted, polled until the batch is done,
+and the results are mapped back onto the payloads.
+"""
+
+from __future__ import annotations
+import asyncio
+import json
+import os
+import shutil
+import time
+import typing as t
+import uuid
+
+from loguru import logger
+
+if t.TYPE_CHECKING:
+    from uptrain.operators.language.llm import Payload
+
+__all__ = [
+    "BatchProvider",
+    "OpenAIBatchProvider",
+    "LocalBatchProvider",
+    "write_batch_file",
+    "read_batch_results",
+    "run_batch",
+]
+
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+# Batch states after which polling stops
+TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+# Keys of the payloads only meant for litellm, that the batch API rejects
+LITELLM_ONLY_KEYS = ("custom_llm_provider", "api_base")
+
+
+class BatchProvider(t.Protocol):
+    """A provider that executes a JSONL file of requests offline."""
+
+    async def submit(self, fpath: str) -> str:
+        """Submit the request file, returns the batch id."""
+        ...
+
+    async def status(self, batch_id: str) -> str:
+        """Current state of the batch, one of the OpenAI batch states."""
+        ...
+
+    async def download_results(self, batch_id: str, fpath: str) -> None:
+        """Write the result lines of a finished batch to the given file."""
+        ...
+
+
+class OpenAIBatchProvider:
+    """Batch execution through the OpenAI (or Azure OpenAI) batch API."""
+
+    def __init__(self, aclient: t.Any, completion_window: str = "24h"):
+        self.aclient = aclient
+        self.completion_window = completion_window
+
+    async def submit(self, fpath: str) -> str:
+        with open(fpath, "rb") as f:
+            file_obj = await self.aclient.files.create(file=f, purpose="batch")
+        batch = await self.aclient.batches.create(
+            input_file_id=file_obj.id,
+            endpoint=CHAT_COMPLETIONS_URL,
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    async def status(self, batch_id: str) -> str:
+        batch = await self.aclient.batches.retrieve(batch_id)
+        return batch.status
+
+    async def download_results(self, batch_id: str, fpath: str) -> None:
+        batch = await self.aclient.batches.retrieve(batch_id)
+        with open(fpath, "w") as f:
+            # successful and failed requests are written to separate files
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is None:
+                    continue
+                content = await self.aclient.files.content(file_id)
+                text = content.text
+                f.write(text if text.endswith("\n") or not text else text + "\n")
+
+
+class LocalBatchProvider:
+    """
+    File-based stand-in for a batch API, for tests and local runs. Each request is
+    answered by calling `responder` with the request body, which returns the content
+    of the assistant message.
+
+    Attributes:
+        responder (Callable): Maps a chat completion request body to the response text.
+        root_dir (str): Directory holding the submitted batches and their results.
+    """
+
+    def __init__(self, responder: t.Callable[[dict], str], root_dir: str):
+        self.responder = responder
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _batch_dir(self, batch_id: str) -> str:
+        return os.path.join(self.root_dir, batch_id)
+
+    async def submit(self, fpath: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(self._batch_dir(batch_id))
+        shutil.copy(fpath, os.path.join(self._batch_dir(batch_id), "input.jsonl"))
+        return batch_id
+
+    async def status(self, batch_id: str) -> str:
+        return "completed"
+
+    async def download_results(self, batch_id: str, fpath: str) -> None:
+        with open(os.path.join(self._batch_dir(batch_id), "input.jsonl")) as f_in, open(
+            fpath, "w"
+        ) as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                body = request["body"]
+                try:
+                    response = {
+                        "status_code": 200,
+                        "body": {
+                            "id": f"chatcmpl-{uuid.uuid4().hex}",
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": body["model"],
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "finish_reason": "stop",
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": self.responder(body),
+                                    },
+                                }
+                            ],
+                        },
+                    }
+                    error = None
+                except Exception as e:
+                    response, error = None, {"message": str(e)}
+                f_out.write(
+                    json.dumps(
+                        {"custom_id": request["custom_id"], "response": response, "error": error}
+                    )
+                    + "\n"
+                )
+
+
+def write_batch_file(payloads: list[Payload], fpath: str) -> None:
+    """Serialize the payloads to a batch request file. The position of each payload
+    in the list is used as its custom id.
+    """
+    with open(fpath, "w") as f:
+        for idx, payload in enumerate(payloads):
+            request = {
+                "custom_id": f"request-{idx}",
+                "method": "POST",
+                "url": CHAT_COMPLETIONS_URL,
+                "body": {
+                    key: value
+                    for key, value in payload.data.items()
+                    if key not in LITELLM_ONLY_KEYS
+                },
+            }
+            f.write(json.dumps(request) + "\n")
+
+
+def read_batch_results(payloads: list[Payload], fpath: str) -> None:
+    """Attach the responses (or errors) from a batch result file to the payloads."""
+    from openai.types.chat import ChatCompletion
+
+    seen = set()
+    with open(fpath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            idx = int(result["custom_id"].split("-")[-1])
+            payload = payloads[idx]
+            seen.add(idx)
+            response = result.get("response")
+            if response is not None and response.get("status_code") == 200:
+                try:
+                    payload.response = ChatCompletion.model_validate(response["body"])
+                except Exception as e:
+                    payload.error = f"Unable to parse the batch response: {e}"
+            else:
+                error = result.get("error") or (response or {}).get("body")
+                payload.error = f"Batch request failed: {error}"
+    for idx, payload in enumerate(payloads):
+        if idx not in seen:
+            payload.error = "No result returned for the request in the batch output"
+
+
+async def run_batch(
+    payloads: list[Payload],
+    provider: BatchProvider,
+    work_dir: str,
+    poll_interval: float = 60,
+) -> list[Payload]:
+    """Execute the payloads through the batch provider, and wait for the results."""
+    os.makedirs(work_dir, exist_ok=True)
+    run_id = uuid.uuid4().hex
+    input_fpath = os.path.join(work_dir, f"{run_id}_input.jsonl")
+    output_fpath = os.path.join(work_dir, f"{run_id}_output.jsonl")
+
+    write_batch_file(payloads, input_fpath)
+    batch_id = await provider.submit(input_fpath)
+    logger.info(f"Submitted batch {batch_id} with {len(payloads)} requests")
+
+    status = await provider.status(batch_id)
+    while status not in TERMINAL_STATES:
+        await asyncio.sleep(poll_interval)
+        status = await provider.status(batch_id)
+        logger.info(f"Batch {batch_id} status: {status}")
+
+    if status == "failed":
+        for payload in payloads:
+            payload.error = f"Batch {batch_id} ended with status: {status}"
+    else:
+        # expired and cancelled batches still return the requests completed (and billed)
+        # before they ended, the rest come back with an error
+        await provider.download_results(batch_id, output_fpath)
+        read_batch_results(payloads, output_fpath)
+        if status != "completed":
+            num_missing = sum(payload.error is not None for payload in payloads)
+            logger.warning(
+                f"Batch {batch_id} ended with status: {status}, {num_missing} of its "
+                f"{len(payloads)} requests have no result"
+            )
+    for fpath in [input_fpath, output_fpath]:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+    return payloads
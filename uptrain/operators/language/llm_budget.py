@@ -0,0 +1,291 @@
+"""
+Token and cost budgets for evaluation runs. Spend is tracked from the usage reported
+in the LLM responses and priced with a per-model table. Requests are checked against
+the budgets before they are sent - past a threshold they are moved to a cheaper
+model if one is configured, and once a budget is exhausted no more requests are sent.
+"""
+
+from __future__ import annotations
+import contextlib
+import contextvars
+import threading
+import typing as t
+
+from loguru import logger
+from pydantic import BaseModel
+
+from uptrain.operators.language.llm_tokens import lookup_model_table
+
+if t.TYPE_CHECKING:
+    from uptrain.framework import Settings
+
+__all__ = [
+    "MODEL_PRICES",
+    "get_model_price",
+    "compute_cost",
+    "BudgetExceededError",
+    "BudgetReservation",
+    "BudgetTracker",
+    "budget_context",
+    "get_current_budget",
+]
+
+
+# USD per million (prompt, completion) tokens. Looked up by the longest matching prefix
+# of the model name, like the context windows in `llm_tokens`.
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-3.5-turbo-0613": (1.5, 2.0),
+    "gpt-3.5-turbo-1106": (1.0, 2.0),
+    "gpt-3.5-turbo-instruct": (1.5, 2.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-32k": (60.0, 120.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4-1106": (10.0, 30.0),
+    "gpt-4-0125": (10.0, 30.0),
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "o1": (15.0, 60.0),
+    "o1-mini": (3.0, 12.0),
+    "claude-3-opus": (15.0, 75.0),
+    "claude-3-sonnet": (3.0, 15.0),
+    "claude-3-haiku": (0.25, 1.25),
+    "mistral/mistral-tiny": (0.25, 0.25),
+    "mistral/mistral-small": (2.0, 6.0),
+    "mistral/mistral-medium": (2.7, 8.1),
+    "mistral/mistral-large": (8.0, 24.0),
+}
+
+
+def get_model_price(
+    model: str, overrides: t.Optional[dict[str, t.Sequence[float]]] = None
+) -> t.Optional[tuple[float, float]]:
+    """USD per million (prompt, completion) tokens for the model, None if it isn't known."""
+    price = lookup_model_table({**MODEL_PRICES, **(overrides or {})}, model)
+    return tuple(price) if price is not None else None
+
+
+def compute_cost(
+    model: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    overrides: t.Optional[dict[str, t.Sequence[float]]] = None,
+) -> float:
+    """Cost of the tokens in USD, 0 for models with no known price."""
+    price = get_model_price(model, overrides)
+    if price is None:
+        return 0.0
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+class BudgetExceededError(Exception):
+    """Raised when a request would exceed the token or cost budget."""
+
+
+class BudgetReservation(BaseModel):
+    """Tokens and cost held against the budgets for a request in flight."""
+
+    operator: t.Optional[str] = None
+    tokens: int = 0
+    cost: float = 0.0
+
+
+class _Spend:
+    """Tokens and cost spent, plus what is reserved by requests in flight."""
+
+    def __init__(self, max_tokens: t.Optional[int] = None, max_cost: t.Optional[float] = None):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def usage(self, tokens: int = 0, cost: float = 0.0) -> float:
+        """Fraction of the tightest budget used, counting reservations and the given extra."""
+        fractions = [0.0]
+        if self.max_tokens is not None:
+            used = self.tokens + self.reserved_tokens + tokens
+            fractions.append(used / max(self.max_tokens, 1))
+        if self.max_cost is not None:
+            used = self.cost + self.reserved_cost + cost
+            fractions.append(used / self.max_cost if self.max_cost > 0 else float("inf"))
+        return max(fractions)
+
+    def to_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "tokens": self.tokens,
+            "cost": self.cost,
+        }
+
+
+class BudgetTracker:
+    """
+    Enforces token and cost budgets over the LLM requests of a run, and for each
+    operator in it.
+
+    Attributes:
+        max_tokens (int): Token budget for the run, None for no limit.
+        max_cost (float): Cost budget for the run in USD, None for no limit.
+        operator_budgets (dict): Budgets per operator name, as dicts with optional `max_tokens`
+            and `max_cost` keys.
+        fallback_model (str): Cheaper model to send requests to once `degrade_at` of a budget
+            is used. None to keep using the requested model until the budget is exhausted.
+        degrade_at (float): Fraction of a budget after which requests go to `fallback_model`.
+        prices (dict): Prices per model, overriding `MODEL_PRICES`.
+        num_degraded (int): Number of requests moved to the fallback model.
+    """
+
+    def __init__(
+        self,
+        max_tokens: t.Optional[int] = None,
+        max_cost: t.Optional[float] = None,
+        operator_budgets: t.Optional[dict[str, dict]] = None,
+        fallback_model: t.Optional[str] = None,
+        degrade_at: float = 0.8,
+        prices: t.Optional[dict[str, t.Sequence[float]]] = None,
+    ):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.operator_budgets = operator_budgets or {}
+        self.fallback_model = fallback_model
+        self.degrade_at = degrade_at
+        self.prices = prices or {}
+        self.num_degraded = 0
+        self._run = _Spend(max_tokens, max_cost)
+        self._operators: dict[t.Optional[str], _Spend] = {}
+        self._models: dict[str, _Spend] = {}
+        self._unpriced_models: set[str] = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> BudgetTracker:
+        return cls(
+            max_tokens=settings.max_run_tokens,
+            max_cost=settings.max_run_cost,
+            operator_budgets=settings.operator_budgets,
+            fallback_model=settings.budget_fallback_model,
+            degrade_at=settings.budget_degrade_at,
+            prices=settings.model_prices,
+        )
+
+    @property
+    def has_limits(self) -> bool:
+        return (
+            self.max_tokens is not None
+            or self.max_cost is not None
+            or bool(self.operator_budgets)
+        )
+
+    def _get_operator(self, operator: t.Optional[str]) -> _Spend:
+        if operator not in self._operators:
+            budget = self.operator_budgets.get(operator, {}) if operator else {}
+            self._operators[operator] = _Spend(
+                budget.get("max_tokens"), budget.get("max_cost")
+            )
+        return self._operators[operator]
+
+    def _cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        if get_model_price(model, self.prices) is None and model not in self._unpriced_models:
+            self._unpriced_models.add(model)
+            logger.warning(
+                f"No price known for {model}, only its tokens count towards the budget. Set `model_prices` to price it."
+            )
+        return compute_cost(model, prompt_tokens, completion_tokens, self.prices)
+
+    def acquire(
+        self,
+        model: str,
+        operator: t.Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int,
+    ) -> tuple[str, BudgetReservation]:
+        """
+        Reserve the estimated tokens of a request against the budgets. Returns the model
+        to send the request to - the fallback model once the budget is nearly used up -
+        and the reservation to settle with `charge`. Raises `BudgetExceededError` if the
+        request doesn't fit in the budget.
+        """
+        tokens = prompt_tokens + completion_tokens
+        with self._lock:
+            spends = [self._run, self._get_operator(operator)]
+            cost = self._cost(model, prompt_tokens, completion_tokens)
+            usage = max(spend.usage(tokens, cost) for spend in spends)
+            if (
+                self.fallback_model is not None
+                and model != self.fallback_model
+                and usage >= self.degrade_at
+            ):
+                model = self.fallback_model
+                cost = self._cost(model, prompt_tokens, completion_tokens)
+                usage = max(spend.usage(tokens, cost) for spend in spends)
+                self.num_degraded += 1
+            if usage > 1:
+                scope = "run" if self._run.usage(tokens, cost) > 1 else f"operator {operator}"
+                raise BudgetExceededError(
+                    f"LLM budget of the {scope} is exhausted, spent so far: {self.spend()['total']}"
+                )
+            for spend in spends:
+                spend.reserved_tokens += tokens
+                spend.reserved_cost += cost
+        return model, BudgetReservation(operator=operator, tokens=tokens, cost=cost)
+
+    def charge(
+        self,
+        reservation: t.Optional[BudgetReservation],
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+    ) -> None:
+        """Release the reservation of a request, and record the tokens it actually used."""
+        operator = reservation.operator if reservation is not None else None
+        with self._lock:
+            cost = self._cost(model, prompt_tokens, completion_tokens)
+            if model not in self._models:
+                self._models[model] = _Spend()
+            for spend in [self._run, self._get_operator(operator), self._models[model]]:
+                if reservation is not None:
+                    spend.reserved_tokens = max(spend.reserved_tokens - reservation.tokens, 0)
+                    spend.reserved_cost = max(spend.reserved_cost - reservation.cost, 0.0)
+                spend.prompt_tokens += prompt_tokens
+                spend.completion_tokens += completion_tokens
+                spend.cost += cost
+
+    def spend(self) -> dict:
+        """Tokens and cost spent, in total and by operator and model."""
+        return {
+            "total": self._run.to_dict(),
+            "by_operator": {
+                operator: spend.to_dict()
+                for operator, spend in self._operators.items()
+                if operator is not None and spend.tokens
+            },
+            "by_model": {model: spend.to_dict() for model, spend in self._models.items()},
+            "num_degraded": self.num_degraded,
+        }
+
+
+_CURRENT_BUDGET: contextvars.ContextVar[t.Optional[BudgetTracker]] = contextvars.ContextVar(
+    "uptrain_current_budget", default=None
+)
+
+
+@contextlib.contextmanager
+def budget_context(budget: BudgetTracker):
+    """Charge the LLM clients created within the block to the budget."""
+    token = _CURRENT_BUDGET.set(budget)
+    try:
+        yield budget
+    finally:
+        _CURRENT_BUDGET.reset(token)
+
+
+def get_current_budget() -> t.Optional[BudgetTracker]:
+    return _CURRENT_BUDGET.get()
@@ -0,0 +1,208 @@
+"""
+Persistent, content-addressed cache for LLM responses.
+
+Responses are stored in a SQLite database (by default under `Settings.logs_folder`),
+keyed by a hash of the canonicalized request payload. Repeated evaluation runs over
+the same data hit the cache instead of the LLM API.
+"""
+
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing as t
+
+from loguru import logger
+
+if t.TYPE_CHECKING:
+    from uptrain.framework import Settings
+
+__all__ = ["ResponseCache", "get_response_cache", "payload_cache_key"]
+
+
+# Payload keys that don't influence the completion and must not break cache hits
+IGNORED_PAYLOAD_KEYS = {"trace_id"}
+
+# Run the eviction sweep once every so many writes
+EVICTION_INTERVAL = 100
+
+
+def payload_cache_key(data: dict) -> str:
+    """Canonical hash of the request body of a payload."""
+    canonical = json.dumps(
+        {k: v for k, v in data.items() if k not in IGNORED_PAYLOAD_KEYS},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of chat completion responses backed by SQLite.
+
+    Attributes:
+        fpath (str): Path of the SQLite database file.
+        ttl (int): Entries older than these many seconds are treated as misses. None disables expiry.
+        max_entries (int): Least recently accessed entries are evicted beyond this count. None disables the limit.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that missed the cache.
+        evictions (int): Number of entries removed through expiry or the size limit.
+    """
+
+    def __init__(
+        self,
+        fpath: str,
+        ttl: t.Optional[int] = None,
+        max_entries: t.Optional[int] = None,
+    ):
+        self.fpath = fpath
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._num_writes = 0
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(fpath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(fpath, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)"
+            )
+
+    def get(self, key: str) -> t.Optional[dict]:
+        """Return the cached value for the key, or None if absent or expired."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict) -> None:
+        """Store a JSON serializable value against the key."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._num_writes += 1
+            if self._num_writes % EVICTION_INTERVAL == 0:
+                self._evict(now)
+
+    def get_response(self, key: str) -> t.Any:
+        """Return the cached chat completion for the key, or None."""
+        from openai.types.chat import ChatCompletion
+
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            return ChatCompletion.model_validate(value)
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cache entry {key}: {e}")
+            return None
+
+    def set_response(self, key: str, response: t.Any) -> None:
+        """Store a chat completion response. Responses that can't be serialized are skipped."""
+        try:
+            value = response.model_dump(mode="json")
+        except Exception as e:
+            logger.warning(f"Unable to cache response of type {type(response)}: {e}")
+            return
+        self.set(key, value)
+
+    def evict(self) -> None:
+        """Drop expired entries and enforce the size limit."""
+        with self._lock, self._conn:
+            self._evict(time.time())
+
+    def _evict(self, now: float) -> None:
+        if self.ttl is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            )
+            self.evictions += max(cursor.rowcount, 0)
+        if self.max_entries is not None:
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.evictions += max(cursor.rowcount, 0)
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        """Hit/miss counters for this cache."""
+        with self._lock:
+            num_entries = self._conn.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "entries": num_entries,
+        }
+
+
+_RESPONSE_CACHES: dict[str, ResponseCache] = {}
+_RESPONSE_CACHES_LOCK = threading.Lock()
+
+
+def get_response_cache(settings: Settings) -> t.Optional[ResponseCache]:
+    """Return the response cache configured in the settings, shared by all clients
+    using the same database file. Returns None if caching is disabled.
+    """
+    if not settings.response_cache:
+        return None
+    fpath = settings.response_cache_path
+    if fpath is None:
+        fpath = os.path.join(settings.logs_folder, "llm_response_cache.sqlite")
+    with _RESPONSE_CACHES_LOCK:
+        cache = _RESPONSE_CACHES.get(fpath)
+        if cache is None or not os.path.exists(fpath):
+            cache = ResponseCache(
+                fpath,
+                ttl=settings.response_cache_ttl,
+                max_entries=settings.response_cache_max_entries,
+            )
+            _RESPONSE_CACHES[fpath] = cache
+        # the most recently configured limits win
+        cache.ttl = settings.response_cache_ttl
+        cache.max_entries = settings.response_cache_max_entries
+    return cache
@@ -0,0 +1,199 @@
+"""
+Cascaded grading. Most rows are clear-cut, so a cheap judge (`Settings.cascade_model`)
+grades every row first, and only the rows it is unsure about are re-graded by the
+strong judge (`Settings.model`) - those whose output fails validation, whose score falls
+in the uncertainty band, or whose sampled choices disagree.
+"""
+
+from __future__ import annotations
+import collections
+import contextlib
+import contextvars
+import typing as t
+
+from loguru import logger
+
+from uptrain.operators.language.llm import (
+    Payload,
+    majority_vote,
+    validate_output,
+)
+
+if t.TYPE_CHECKING:
+    from uptrain.operators.language.llm import LLMMulticlient
+
+__all__ = [
+    "CascadeStats",
+    "cascade_stats_context",
+    "get_current_cascade_stats",
+    "mapped_score",
+    "escalation_reason",
+    "fetch_cascaded_responses",
+]
+
+
+class CascadeStats:
+    """
+    Number of payloads graded by a cascade, and of those escalated to the strong judge.
+
+    Attributes:
+        num_payloads (int): Payloads graded by the cheap judge.
+        num_escalated (int): Payloads re-graded by the strong judge.
+        reasons (Counter): Number of escalations per reason - "error", "invalid",
+            "uncertain" or "disagreement".
+    """
+
+    def __init__(self):
+        self.num_payloads = 0
+        self.num_escalated = 0
+        self.reasons: t.Counter[str] = collections.Counter()
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.num_escalated / self.num_payloads if self.num_payloads else 0.0
+
+    def update(self, other: CascadeStats) -> None:
+        self.num_payloads += other.num_payloads
+        self.num_escalated += other.num_escalated
+        self.reasons.update(other.reasons)
+
+    def summary(self) -> dict:
+        return {
+            "payloads": self.num_payloads,
+            "escalated": self.num_escalated,
+            "escalation_rate": self.escalation_rate,
+            "reasons": dict(self.reasons),
+        }
+
+
+_CURRENT_CASCADE_STATS: contextvars.ContextVar[t.Optional[CascadeStats]] = (
+    contextvars.ContextVar("uptrain_current_cascade_stats", default=None)
+)
+
+
+@contextlib.contextmanager
+def cascade_stats_context(stats: t.Optional[CascadeStats] = None):
+    """Add up the cascades of the grading calls made within the block."""
+    stats = stats if stats is not None else CascadeStats()
+    token = _CURRENT_CASCADE_STATS.set(stats)
+    try:
+        yield stats
+    finally:
+        _CURRENT_CASCADE_STATS.reset(token)
+
+
+def get_current_cascade_stats() -> t.Optional[CascadeStats]:
+    return _CURRENT_CASCADE_STATS.get()
+
+
+def mapped_score(
+    score_mapping: dict, key: str = "Choice"
+) -> t.Callable[[dict], t.Optional[float]]:
+    """Score function of an evaluator, mapping the grade under `key` in its output to a
+    score with the evaluator's `score_mapping`."""
+
+    def score_func(output: dict) -> t.Optional[float]:
+        return score_mapping.get(output.get(key))
+
+    return score_func
+
+
+def escalation_reason(
+    payload: Payload,
+    score_func: t.Callable[[dict], t.Optional[float]],
+    validate_func: t.Optional[t.Callable] = None,
+    uncertainty_band: t.Sequence[float] = (0.25, 0.75),
+    min_agreement: float = 1.0,
+) -> t.Optional[str]:
+    """Why the grade of the cheap judge should be re-done by the strong one, None if
+    it stands."""
+    if payload.error is not None or payload.response is None:
+        return "error"
+    outputs = payload.parsed_outputs()
+    if validate_func is not None:
+        outputs = [output for output in outputs if validate_output(output, validate_func)]
+    try:
+        scores = [score_func(output) for output in outputs]
+    except Exception:
+        scores = []
+    if not scores or any(score is None for score in scores):
+        return "invalid"
+    score, agreement = majority_vote(scores)
+    if agreement < min_agreement:
+        return "disagreement"
+    low, high = uncertainty_band
+    if low <= score <= high:
+        return "uncertain"
+    return None
+
+
+def _with_model(payload: Payload, model: str) -> Payload:
+    """Copy of an unsent payload, for another model."""
+    telemetry = payload.telemetry
+    if telemetry is not None:
+        telemetry = telemetry.model_copy(update={"model": model})
+    return Payload(
+        data={**payload.data, "model": model},
+        metadata=dict(payload.metadata),
+        telemetry=telemetry,
+    )
+
+
+def fetch_cascaded_responses(
+    client: LLMMulticlient,
+    input_payloads: list[Payload],
+    score_func: t.Callable[[dict], t.Optional[float]],
+    validate_func: t.Optional[t.Callable] = None,
+) -> tuple[list[Payload], CascadeStats]:
+    """
+    Grade the payloads with the cheap judge of the client's settings, and re-grade the
+    ones it is unsure about with the model they were made for. The payloads returned are
+    in the order of `input_payloads`, with `metadata["escalated"]` set to the reason of
+    the escalation, or None.
+
+    Args:
+        client (LLMMulticlient): Client to send the requests through.
+        input_payloads (list[Payload]): Payloads made for the strong judge.
+        score_func (Callable): Score of a parsed output, None if it can't be scored.
+        validate_func (Callable): Validation function for the parsed outputs.
+    """
+    settings = client.settings
+    cheap_model = client._strip_model_prefix(settings.cascade_model)
+    stats = CascadeStats()
+    # outputs of the cheap judge that fail validation are escalated, not retried
+    first_pass = client._fetch_responses(
+        [_with_model(payload, cheap_model) for payload in input_payloads]
+    )
+    if first_pass is None:
+        return first_pass, stats
+
+    escalated = []
+    for position, res in enumerate(first_pass):
+        reason = escalation_reason(
+            res,
+            score_func,
+            validate_func,
+            uncertainty_band=settings.cascade_uncertainty_band,
+            min_agreement=settings.cascade_min_agreement,
+        )
+        res.metadata["escalated"] = reason
+        if reason is not None:
+            escalated.append(position)
+            stats.reasons[reason] += 1
+    stats.num_payloads = len(first_pass)
+    stats.num_escalated = len(escalated)
+
+    output_payloads = list(first_pass)
+    if escalated:
+        second_pass = client._fetch_responses(
+            [input_payloads[position] for position in escalated], validate_func
+        )
+        for position, res in zip(escalated, second_pass or []):
+            res.metadata["escalated"] = first_pass[position].metadata["escalated"]
+            output_payloads[position] = res
+    logger.info(
+        f"Cascade: {stats.num_escalated} of {stats.num_payloads} payloads escalated from "
+        f"{cheap_model} to {input_payloads[0].data['model']} "
+        f"({stats.escalation_rate:.0%}, {dict(stats.reasons)})"
+    )
+    return output_payloads, stats
@@ -0,0 +1,493 @@
+"""
+Deterministic stand-in for an LLM provider, for load testing `LLMMulticlient` and the
+evaluator operators without network access or API costs.
+
+The fake answers every grading prompt in `prompts/classic.py` with JSON that conforms
+to the output format embedded in the prompt (choices, scores, fact lists, packed
+arrays), and can inject latency, server errors, 429s and malformed outputs. It can also
+simulate provider-side prompt caching, reporting the prompt tokens served from the
+cache in `usage.prompt_tokens_details.cached_tokens`. It can be
+used in-process through `FakeAsyncOpenAI`, or over HTTP through `FakeLLMServer`, which
+speaks the chat completions schema:
+
+    python -m uptrain.operators.language.llm_fake --port 8000 --latency-mean 0.2 --rate-limit-rate 0.05
+
+and then point an OpenAI client (or a `Settings.client_pool` member) at
+`http://localhost:8000/v1`.
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import collections
+import hashlib
+import http.server
+import json
+import math
+import random
+import re
+import threading
+import time
+import typing as t
+import uuid
+
+from loguru import logger
+from pydantic import BaseModel
+
+__all__ = [
+    "FakeLLMConfig",
+    "FakeLLMProvider",
+    "FakeAsyncOpenAI",
+    "FakeLLMServer",
+    "generate_fake_output",
+]
+
+
+class FakeLLMConfig(BaseModel):
+    """
+    Behaviour of the fake provider. Random draws are seeded by the request body and
+    the number of times it has been seen, so a run is reproducible regardless of the
+    order in which concurrent requests arrive.
+
+    Attributes:
+        latency_distribution (str): One of "constant", "uniform", "exponential" or "lognormal".
+        latency_mean (float): Mean latency of a request, in seconds.
+        latency_sigma (float): Shape parameter of the lognormal distribution - larger values give a longer tail.
+        error_rate (float): Fraction of requests that fail with a 500 error.
+        rate_limit_rate (float): Fraction of requests that are rejected with a 429 error.
+        retry_after (float): Seconds sent in the `retry-after` header of 429 responses.
+        malformed_rate (float): Fraction of responses with output that isn't valid JSON.
+        prompt_caching (bool): Simulate prefix caching of prompts. As with OpenAI, prompts of at least
+            `cache_min_tokens` tokens are cached, in increments of `cache_block_tokens`, and the longest
+            cached prefix of a prompt (over the messages, roles included) is reported as cached tokens.
+        cache_min_tokens (int): Shortest prefix that is cached.
+        cache_block_tokens (int): Granularity of the cached prefixes.
+        seed (int): Seed for all random draws.
+    """
+
+    latency_distribution: t.Literal["constant", "uniform", "exponential", "lognormal"] = "constant"
+    latency_mean: float = 0.0
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 0.1
+    malformed_rate: float = 0.0
+    prompt_caching: bool = False
+    cache_min_tokens: int = 1024
+    cache_block_tokens: int = 128
+    seed: int = 0
+
+
+# -----------------------------------------------------------
+# Fake outputs
+# -----------------------------------------------------------
+
+_FORMAT_START = re.compile(r"Do not output anything other than this JSON (object|array):")
+_FORMAT_END = re.compile(r"^Task Data\.?|^Example Data\.|^The task data below", re.IGNORECASE | re.MULTILINE)
+_KEY_LINE = re.compile(r'^\s*"(?P<key>[^"]+)":\s*(?P<value>.*?)\s*(?:#\s*(?P<comment>.*))?$')
+_QUOTED = re.compile(r'"([^"]+)"')
+
+
+def _extract_output_format(prompt: str) -> t.Tuple[t.Optional[str], bool]:
+    """The output format spec embedded in the prompt, and whether it asks for an array."""
+    match = None
+    for match in _FORMAT_START.finditer(prompt):
+        pass
+    if match is None:
+        return None, False
+    spec = prompt[match.end() :]
+    end = _FORMAT_END.search(spec)
+    if end is not None:
+        spec = spec[: end.start()]
+    return spec, match.group(1) == "array"
+
+
+def _fake_scalar(key: str, comment: str, rng: random.Random) -> t.Any:
+    comment = comment or ""
+    if "one of" in comment or "Select one" in comment:
+        options = _QUOTED.findall(comment.split("one of", 1)[-1])
+        if options:
+            return rng.choice(options)
+    score_range = re.search(r"between (\d+(?:\.\d+)?) to (\d+(?:\.\d+)?)", comment)
+    if score_range is not None:
+        low, high = float(score_range.group(1)), float(score_range.group(2))
+        if low.is_integer() and high.is_integer() and high - low > 1:
+            return rng.randint(int(low), int(high))
+        return round(rng.uniform(low, high), 2)
+    if "Number of" in comment or key in ("Turns", "Row"):
+        return rng.randint(1, 5)
+    return f"Fake {key.lower()} {rng.randint(0, 9999)}"
+
+
+def _fake_object(lines: list[str], rng: random.Random) -> t.Tuple[dict, int]:
+    """Fake values for the keys in the spec lines of a JSON object, up to its closing
+    brace. Returns the object and the number of lines consumed."""
+    obj, idx = {}, 0
+    while idx < len(lines):
+        line = lines[idx].strip()
+        idx += 1
+        if line.startswith("}"):
+            break
+        match = _KEY_LINE.match(line)
+        if match is None:
+            continue
+        key, value = match.group("key"), match.group("value")
+        if value.startswith("[") and value.rstrip(",") in ("[", "[ "):
+            # a list of strings or of objects, the items follow on the next lines
+            items, num_consumed = _fake_list(lines[idx:], rng)
+            obj[key] = items
+            idx += num_consumed
+        else:
+            obj[key] = _fake_scalar(key, match.group("comment"), rng)
+    return obj, idx
+
+
+def _fake_list(lines: list[str], rng: random.Random) -> t.Tuple[list, int]:
+    items, idx = [], 0
+    while idx < len(lines):
+        line = lines[idx].strip()
+        idx += 1
+        if line.startswith("]"):
+            break
+        if line.startswith("{"):
+            item, num_consumed = _fake_object(lines[idx:], rng)
+            items.append(item)
+            idx += num_consumed
+        elif line.startswith("[") and not line.startswith("[{"):
+            items.append(f"Fake item {rng.randint(0, 9999)}")
+    return items, idx
+
+
+def generate_fake_output(prompt: str, rng: t.Optional[random.Random] = None) -> str:
+    """
+    JSON output conforming to the output format in the prompt. Prompts without one
+    get a plain text answer.
+    """
+    rng = rng or random.Random(prompt)
+    spec, is_array = _extract_output_format(prompt)
+    if spec is None:
+        return f"Fake response {rng.randint(0, 9999)}"
+
+    lines = spec.strip().split("\n")
+    if is_array:
+        # packed prompts, one object per numbered row
+        num_rows = len(re.findall(r"^Row \d+:", prompt, flags=re.MULTILINE)) or 1
+        start = next(idx for idx, line in enumerate(lines) if line.strip().startswith("{"))
+        outputs = []
+        for num in range(1, num_rows + 1):
+            output, _ = _fake_object(lines[start + 1 :], rng)
+            output["Row"] = num
+            outputs.append(output)
+        return json.dumps(outputs)
+
+    start = next((idx for idx, line in enumerate(lines) if line.strip().startswith("{")), None)
+    if start is None:
+        return f"Fake response {rng.randint(0, 9999)}"
+    output, _ = _fake_object(lines[start + 1 :], rng)
+    return json.dumps(output)
+
+
+# -----------------------------------------------------------
+# Provider
+# -----------------------------------------------------------
+
+# Bound on the prefixes kept by the simulated prompt cache
+_MAX_CACHED_PREFIXES = 100_000
+
+
+class FakeLLMProvider:
+    """
+    Decides the outcome of each chat completion request per the config.
+
+    Attributes:
+        config (FakeLLMConfig): Behaviour of the provider.
+        num_requests (int): Number of requests received.
+        num_errors (int): Number of requests failed with a server error.
+        num_rate_limited (int): Number of requests rejected with a 429.
+        num_prompt_tokens (int): Prompt tokens of the successful requests.
+        num_cached_tokens (int): Prompt tokens served from the simulated prompt cache.
+    """
+
+    def __init__(self, config: t.Optional[FakeLLMConfig] = None):
+        self.config = config or FakeLLMConfig()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_rate_limited = 0
+        self.num_prompt_tokens = 0
+        self.num_cached_tokens = 0
+        self._attempts: t.Counter[str] = collections.Counter()
+        # hashes of the cached prompt prefixes, least recently used first
+        self._prefix_cache: t.OrderedDict[str, None] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rng(self, body: dict) -> random.Random:
+        key = hashlib.sha256(
+            json.dumps(body, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        with self._lock:
+            self.num_requests += 1
+            attempt = self._attempts[key]
+            self._attempts[key] += 1
+        return random.Random(f"{self.config.seed}:{key}:{attempt}")
+
+    def _latency(self, rng: random.Random) -> float:
+        mean, distribution = self.config.latency_mean, self.config.latency_distribution
+        if mean <= 0 or distribution == "constant":
+            return max(mean, 0)
+        if distribution == "uniform":
+            return rng.uniform(0, 2 * mean)
+        if distribution == "exponential":
+            return rng.expovariate(1 / mean)
+        # lognormal with the given mean
+        sigma = self.config.latency_sigma
+        return rng.lognormvariate(math.log(mean) - sigma**2 / 2, sigma)
+
+    def _cached_tokens(self, body: dict) -> int:
+        """Length of the longest cached prefix of the prompt in tokens, and cache all of
+        its prefixes."""
+        text = "".join(
+            f"<|{msg.get('role')}|>{msg.get('content') or ''}" for msg in body.get("messages", [])
+        )
+        block, min_tokens = max(self.config.cache_block_tokens, 1), self.config.cache_min_tokens
+        digest = hashlib.sha256(str(body.get("model")).encode("utf-8"))
+        prefixes, num_tokens = [], 0
+        while (num_tokens + block) * 4 <= len(text):
+            digest.update(text[num_tokens * 4 : (num_tokens + block) * 4].encode("utf-8"))
+            num_tokens += block
+            if num_tokens >= min_tokens:
+                prefixes.append((num_tokens, digest.hexdigest()))
+        cached_tokens = 0
+        with self._lock:
+            for num_tokens, key in prefixes:
+                if key in self._prefix_cache:
+                    cached_tokens = num_tokens
+                    self._prefix_cache.move_to_end(key)
+                else:
+                    self._prefix_cache[key] = None
+            while len(self._prefix_cache) > _MAX_CACHED_PREFIXES:
+                self._prefix_cache.popitem(last=False)
+        return cached_tokens
+
+    def complete(self, body: dict) -> t.Tuple[float, int, dict, dict]:
+        """
+        Outcome of a request - the latency to simulate, the status code, the response
+        headers and the response body.
+        """
+        rng = self._rng(body)
+        latency = self._latency(rng)
+        draw = rng.random()
+        if draw < self.config.rate_limit_rate:
+            with self._lock:
+                self.num_rate_limited += 1
+            return (
+                latency,
+                429,
+                {"retry-after": str(self.config.retry_after)},
+                {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+            )
+        if draw < self.config.rate_limit_rate + self.config.error_rate:
+            with self._lock:
+                self.num_errors += 1
+            return (
+                latency,
+                500,
+                {},
+                {"error": {"message": "The server had an error (fake)", "type": "server_error", "code": None}},
+            )
+
+        prompt = "\n".join(
+            msg.get("content") or "" for msg in body.get("messages", []) if isinstance(msg.get("content"), str)
+        )
+        # every sampled choice is drawn independently
+        contents = []
+        for _ in range(body.get("n") or 1):
+            content = generate_fake_output(prompt, rng)
+            if rng.random() < self.config.malformed_rate:
+                content = content[: len(content) // 2]
+            contents.append(content)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = sum(len(content) // 4 for content in contents)
+        cached_tokens = min(self._cached_tokens(body), prompt_tokens) if self.config.prompt_caching else 0
+        with self._lock:
+            self.num_prompt_tokens += prompt_tokens
+            self.num_cached_tokens += cached_tokens
+        response = {
+            "id": f"chatcmpl-fake-{uuid.UUID(int=rng.getrandbits(128)).hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [
+                {
+                    "index": idx,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+                for idx, content in enumerate(contents)
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+        return latency, 200, {}, response
+
+
+# -----------------------------------------------------------
+# In-process client
+# -----------------------------------------------------------
+
+
+class _FakeCompletions:
+    def __init__(self, provider: FakeLLMProvider):
+        self.provider = provider
+
+    async def create(self, **kwargs):
+        import httpx
+        import openai
+        from openai.types.chat import ChatCompletion
+
+        kwargs.pop("timeout", None)
+        latency, status, headers, body = self.provider.complete(kwargs)
+        if latency:
+            await asyncio.sleep(latency)
+        if status == 200:
+            return ChatCompletion.model_validate(body)
+
+        response = httpx.Response(
+            status,
+            headers=headers,
+            json=body,
+            request=httpx.Request("POST", "http://fake-llm/v1/chat/completions"),
+        )
+        error_cls = openai.RateLimitError if status == 429 else openai.InternalServerError
+        raise error_cls(body["error"]["message"], response=response, body=body["error"])
+
+
+class FakeAsyncOpenAI:
+    """In-process stand-in for `openai.AsyncOpenAI`, pass it as the `aclient` of an
+    `LLMMulticlient`."""
+
+    def __init__(
+        self,
+        config: t.Optional[FakeLLMConfig] = None,
+        provider: t.Optional[FakeLLMProvider] = None,
+    ):
+        self.provider = provider or FakeLLMProvider(config)
+        self.chat = self
+        self.completions = _FakeCompletions(self.provider)
+
+
+# -----------------------------------------------------------
+# HTTP server
+# -----------------------------------------------------------
+
+
+class _FakeLLMRequestHandler(http.server.BaseHTTPRequestHandler):
+    provider: FakeLLMProvider
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {}, {"error": {"message": f"Unknown path: {self.path}"}})
+            return
+        length = int(self.headers.get("content-length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send(400, {}, {"error": {"message": "Invalid JSON body"}})
+            return
+        latency, status, headers, response = self.provider.complete(body)
+        if latency:
+            time.sleep(latency)
+        self._send(status, headers, response)
+
+    def _send(self, status: int, headers: dict, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Fake LLM server: {format % args}")
+
+
+class FakeLLMServer:
+    """
+    The fake provider behind an HTTP server speaking the chat completions schema,
+    served from a background thread.
+
+    Attributes:
+        provider (FakeLLMProvider): Provider answering the requests.
+        host (str): Host to bind to.
+        port (int): Port to bind to, 0 picks a free port.
+    """
+
+    def __init__(
+        self,
+        config: t.Optional[FakeLLMConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.provider = FakeLLMProvider(config)
+        handler = type(
+            "FakeLLMRequestHandler", (_FakeLLMRequestHandler,), {"provider": self.provider}
+        )
+        self._server = http.server.ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread: t.Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        """Base URL to configure OpenAI clients with."""
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self) -> FakeLLMServer:
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-llm-server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> FakeLLMServer:
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    for name, field in FakeLLMConfig.model_fields.items():
+        if isinstance(field.default, bool):
+            parser.add_argument(f"--{name.replace('_', '-')}", action="store_true")
+            continue
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=type(field.default), default=field.default
+        )
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+    server = FakeLLMServer(FakeLLMConfig(**args), host=host, port=port)
+    logger.info(f"Fake LLM server listening on {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
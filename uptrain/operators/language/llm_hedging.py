@@ -0,0 +1,128 @@
+"""
+Request hedging for LLM calls. A request that is still pending after a delay (a high
+percentile of recently observed latencies) is duplicated, possibly to a second
+endpoint, and whichever copy returns first is used while the other is cancelled. This
+trades a few extra requests for a much shorter tail latency.
+"""
+
+from __future__ import annotations
+import asyncio
+import collections
+import threading
+import time
+import typing as t
+
+from loguru import logger
+
+__all__ = ["LatencyTracker", "RequestHedger"]
+
+
+class LatencyTracker:
+    """Sliding window of recent request latencies, in seconds."""
+
+    def __init__(self, window: int = 500):
+        self._latencies: t.Deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, pct: float) -> t.Optional[float]:
+        """The `pct`-th percentile (0-100) of the recorded latencies, None if empty."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        rank = min(int(round(pct / 100 * (len(latencies) - 1))), len(latencies) - 1)
+        return latencies[max(rank, 0)]
+
+
+class RequestHedger:
+    """
+    Sends a duplicate of slow requests and takes the first response.
+
+    Attributes:
+        percentile (float): Latency percentile after which a request is hedged.
+        min_delay (float): Lower bound on the hedging delay, in seconds. Also used as the delay
+            until `min_samples` latencies have been observed.
+        min_samples (int): Number of observed latencies needed before the percentile is used.
+        num_hedges_issued (int): Number of duplicate requests sent.
+        num_hedges_won (int): Number of times the duplicate request returned first.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        min_delay: float = 1.0,
+        min_samples: int = 20,
+        window: int = 500,
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker(window)
+        self.num_hedges_issued = 0
+        self.num_hedges_won = 0
+
+    def delay(self) -> float:
+        """Seconds to wait for the primary request before sending the hedge."""
+        if len(self.latencies) < self.min_samples:
+            return self.min_delay
+        return max(self.latencies.percentile(self.percentile), self.min_delay)
+
+    async def run(
+        self,
+        send: t.Callable[[t.Any], t.Awaitable[t.Any]],
+        aclient: t.Any,
+        hedge_aclient: t.Any = None,
+    ) -> tuple[t.Any, bool]:
+        """
+        Run `send(aclient)`, hedged with `send(hedge_aclient)` (the same client if not
+        given) if it is slow. Returns the first successful result, and whether a hedge
+        was issued. If both requests fail, the error of the primary one is raised.
+        """
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(send(aclient))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.delay())
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            result = primary.result()
+            self.latencies.record(time.perf_counter() - start)
+            return result, False
+
+        self.num_hedges_issued += 1
+        hedge_start = time.perf_counter()
+        hedge = asyncio.ensure_future(
+            send(hedge_aclient if hedge_aclient is not None else aclient)
+        )
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.cancelled() or task.exception() is not None:
+                        continue
+                    for other in pending:
+                        other.cancel()
+                    if task is hedge:
+                        self.num_hedges_won += 1
+                        self.latencies.record(time.perf_counter() - hedge_start)
+                    else:
+                        self.latencies.record(time.perf_counter() - start)
+                    return task.result(), True
+        except asyncio.CancelledError:
+            primary.cancel()
+            hedge.cancel()
+            raise
+        if hedge.exception() is not None and not primary.cancelled():
+            logger.info(f"Hedged request failed as well: {hedge.exception()}")
+        return primary.result(), True
@@ -0,0 +1,173 @@
+"""
+Memoization of evaluations within an evaluation run. Some evaluators are built out of
+others - e.g. `ResponseRelevance` runs `ResponseCompleteness` and `ResponseConciseness`
+- so requesting them together grades every row with the sub-evaluators twice. Within
+an `evaluation_memo` block, the output of an evaluator run with `run_memoized` for a
+row is computed once, keyed by the evaluator, its parameters and settings and the
+content of the row, and shared with every other check asking for it, including the
+ones running concurrently. Evaluators run any other way aren't memoized.
+"""
+
+from __future__ import annotations
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import threading
+import typing as t
+
+__all__ = [
+    "EvaluationMemo",
+    "evaluation_memo",
+    "get_current_memo",
+    "evaluate_memoized",
+    "run_memoized",
+]
+
+
+def _canonical(value: t.Any) -> str:
+    return json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+
+
+class EvaluationMemo:
+    """
+    Outputs of the evaluators for the rows evaluated so far in a run.
+
+    Attributes:
+        hits (int): Number of row evaluations served from the memo, or from another
+            check computing them at the same time.
+        misses (int): Number of row evaluations computed.
+    """
+
+    def __init__(self):
+        self._futures: dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def claim(
+        self, keys: t.Sequence[str]
+    ) -> tuple[list[str], dict[str, concurrent.futures.Future]]:
+        """Return the keys the caller must compute - the ones nobody else has claimed -
+        and the futures of all the keys."""
+        owned = []
+        futures = {}
+        with self._lock:
+            for key in keys:
+                if key in futures:
+                    self.hits += 1
+                    continue
+                future = self._futures.get(key)
+                if future is None:
+                    future = self._futures[key] = concurrent.futures.Future()
+                    owned.append(key)
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                futures[key] = future
+        return owned, futures
+
+    def release(self, keys: t.Sequence[str], exc: BaseException) -> None:
+        """Fail the claimed keys, and forget them so a later evaluation retries."""
+        with self._lock:
+            for key in keys:
+                future = self._futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(exc)
+
+    def summary(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_CURRENT_MEMO: contextvars.ContextVar[t.Optional[EvaluationMemo]] = contextvars.ContextVar(
+    "uptrain_current_memo", default=None
+)
+
+
+@contextlib.contextmanager
+def evaluation_memo(memo: t.Optional[EvaluationMemo] = None):
+    """Share the outputs of the evaluators run within the block."""
+    memo = memo if memo is not None else EvaluationMemo()
+    token = _CURRENT_MEMO.set(memo)
+    try:
+        yield memo
+    finally:
+        _CURRENT_MEMO.reset(token)
+
+
+def get_current_memo() -> t.Optional[EvaluationMemo]:
+    return _CURRENT_MEMO.get()
+
+
+def _evaluator_key(op: t.Any, name: str) -> str:
+    """Canonical form of the evaluator, its parameters and settings. The column names
+    are left out, as `evaluate_local` sees the rows with the columns already renamed."""
+    params = {
+        key: value
+        for key, value in op.model_dump().items()
+        if not key.startswith("col_") and key != "settings"
+    }
+    settings = getattr(op, "settings", None)
+    if settings is not None:
+        settings = settings.model_dump()
+    return _canonical([name, params, settings])
+
+
+def evaluate_memoized(
+    memo: EvaluationMemo, evaluate_local: t.Callable, name: str, op: t.Any, data: list
+) -> list[dict]:
+    """Run `evaluate_local` of the operator on the rows that aren't in the memo yet, and
+    return the outputs for all the rows."""
+    # keys are computed first, evaluators modify the rows they are given
+    prefix = _evaluator_key(op, name)
+    keys = [
+        hashlib.sha256((prefix + _canonical(row)).encode("utf-8")).hexdigest()
+        for row in data
+    ]
+    owned, futures = memo.claim(keys)
+    if owned:
+        owned_set = set(owned)
+        positions = {}
+        for position, key in enumerate(keys):
+            if key in owned_set and key not in positions:
+                positions[key] = position
+        try:
+            outputs = evaluate_local(op, [data[positions[key]] for key in owned])
+            if len(outputs) != len(owned):
+                raise ValueError(
+                    f"`{name}` returned {len(outputs)} outputs for {len(owned)} rows"
+                )
+        except BaseException as exc:
+            memo.release(owned, exc)
+            raise
+        for key, output in zip(owned, outputs):
+            futures[key].set_result(output)
+    # the rows claimed by other checks are computed by sub-evaluators, that don't
+    # wait on the ones above them, so this doesn't deadlock
+    return [dict(futures[key].result()) for key in keys]
+
+
+def run_memoized(op: t.Any, data: t.Any) -> t.Any:
+    """Run the operator, already set up, on the frame, with its `evaluate_local` going
+    through the memo of the current `evaluation_memo` block, if any."""
+    memo = get_current_memo()
+    if memo is None:
+        return op.run(data)
+    klass = type(op)
+    # `run` renames the columns and calls `evaluate_local`, shadowed on this instance
+    # for the duration of the call
+    object.__setattr__(
+        op,
+        "evaluate_local",
+        functools.partial(
+            evaluate_memoized, memo, klass.evaluate_local, klass.__name__, op
+        ),
+    )
+    try:
+        return op.run(data)
+    finally:
+        del op.__dict__["evaluate_local"]
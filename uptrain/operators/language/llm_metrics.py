@@ -0,0 +1,339 @@
+"""
+Telemetry for LLM calls. Every payload sent through `async_process_payload` carries a
+`RequestTelemetry` record (time queued at the limiters, request latency, retries,
+tokens, validation failures), which is handed to the registered metrics hooks once
+the payload is done. The default hook aggregates the records into counters and
+histograms per model and operator, exposed as a dict summary or in the Prometheus
+text exposition format.
+"""
+
+from __future__ import annotations
+import bisect
+import contextlib
+import contextvars
+import math
+import threading
+import typing as t
+
+from loguru import logger
+from pydantic import BaseModel
+
+__all__ = [
+    "RequestTelemetry",
+    "Histogram",
+    "MetricsRegistry",
+    "MetricsHook",
+    "get_metrics_registry",
+    "register_metrics_hook",
+    "unregister_metrics_hook",
+    "record_telemetry",
+    "summarize_payloads",
+    "operator_context",
+    "get_current_operator",
+]
+
+
+class RequestTelemetry(BaseModel):
+    """
+    Timing and usage of a single LLM payload, across all its attempts.
+
+    Attributes:
+        model (str): Model the payload was sent to.
+        operator (str): Operator the payload was made by, if known.
+        queue_time (float): Seconds spent waiting on the rate limiters and the concurrency cap.
+        latency (float): Seconds spent in requests to the API.
+        total_time (float): Seconds from the start of processing to the final response.
+        attempts (int): Number of requests sent to the API.
+        throttles (int): Number of attempts rejected for rate limits.
+        errors (int): Number of attempts that failed.
+        validation_failures (int): Number of responses that failed the validation function.
+        prompt_tokens (int): Prompt tokens used, summed over attempts.
+        completion_tokens (int): Completion tokens used, summed over attempts.
+        cached_prompt_tokens (int): Prompt tokens served from the provider's prompt cache.
+        cached (bool): The response was served from the response cache.
+        coalesced (bool): The response was shared from an identical request in flight.
+        hedged (bool): A duplicate request was sent to cut the latency.
+        success (bool): The payload ended up with a response and no error.
+    """
+
+    model: str = "unknown"
+    operator: t.Optional[str] = None
+    queue_time: float = 0.0
+    latency: float = 0.0
+    total_time: float = 0.0
+    attempts: int = 0
+    throttles: int = 0
+    errors: int = 0
+    validation_failures: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    cached: bool = False
+    coalesced: bool = False
+    hedged: bool = False
+    success: bool = False
+
+    @property
+    def retries(self) -> int:
+        return max(self.attempts - 1, 0)
+
+
+# -----------------------------------------------------------
+# Operator context
+# -----------------------------------------------------------
+
+_CURRENT_OPERATOR: contextvars.ContextVar[t.Optional[str]] = contextvars.ContextVar(
+    "uptrain_current_operator", default=None
+)
+
+
+@contextlib.contextmanager
+def operator_context(name: str):
+    """Attribute the LLM payloads made within the block to the named operator."""
+    token = _CURRENT_OPERATOR.set(name)
+    try:
+        yield
+    finally:
+        _CURRENT_OPERATOR.reset(token)
+
+
+def get_current_operator() -> t.Optional[str]:
+    return _CURRENT_OPERATOR.get()
+
+
+# -----------------------------------------------------------
+# Aggregation
+# -----------------------------------------------------------
+
+# Histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+COUNTERS = {
+    "uptrain_llm_requests_total": "Payloads processed.",
+    "uptrain_llm_failures_total": "Payloads that ended in an error.",
+    "uptrain_llm_cached_total": "Payloads served from the response cache.",
+    "uptrain_llm_coalesced_total": "Payloads served from an identical request in flight.",
+    "uptrain_llm_hedged_total": "Payloads for which a duplicate request was sent.",
+    "uptrain_llm_attempts_total": "Requests sent to the API.",
+    "uptrain_llm_retries_total": "Requests sent to the API after the first attempt.",
+    "uptrain_llm_throttles_total": "Requests rejected for rate limits.",
+    "uptrain_llm_errors_total": "Requests that failed.",
+    "uptrain_llm_validation_failures_total": "Responses that failed validation.",
+    "uptrain_llm_prompt_tokens_total": "Prompt tokens used.",
+    "uptrain_llm_completion_tokens_total": "Completion tokens used.",
+    "uptrain_llm_cached_prompt_tokens_total": "Prompt tokens served from the provider's prompt cache.",
+}
+
+HISTOGRAMS = {
+    "uptrain_llm_queue_seconds": "Time waiting on rate limits and the concurrency cap.",
+    "uptrain_llm_latency_seconds": "Time spent in requests to the API.",
+    "uptrain_llm_total_seconds": "Time to process a payload, end to end.",
+}
+
+
+class Histogram:
+    """Cumulative histogram over fixed buckets, as in Prometheus."""
+
+    def __init__(self, buckets: t.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the `q`-quantile, interpolated within the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank, cumulative = q * self.count, 0
+        for idx, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - cumulative) / count
+                # the bucket bound can be well above anything observed
+                return min(estimate, self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+LabelKey = t.Tuple[t.Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """Counters and histograms over request telemetry, labelled by model and operator."""
+
+    def __init__(self, buckets: t.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters: dict[str, dict[LabelKey, float]] = {name: {} for name in COUNTERS}
+        self._histograms: dict[str, dict[LabelKey, Histogram]] = {
+            name: {} for name in HISTOGRAMS
+        }
+        self._lock = threading.Lock()
+
+    def __call__(self, telemetry: RequestTelemetry) -> None:
+        self.record(telemetry)
+
+    def record(self, telemetry: RequestTelemetry) -> None:
+        labels = (("model", telemetry.model), ("operator", telemetry.operator or ""))
+        counts = {
+            "uptrain_llm_requests_total": 1,
+            "uptrain_llm_failures_total": int(not telemetry.success),
+            "uptrain_llm_cached_total": int(telemetry.cached),
+            "uptrain_llm_coalesced_total": int(telemetry.coalesced),
+            "uptrain_llm_hedged_total": int(telemetry.hedged),
+            "uptrain_llm_attempts_total": telemetry.attempts,
+            "uptrain_llm_retries_total": telemetry.retries,
+            "uptrain_llm_throttles_total": telemetry.throttles,
+            "uptrain_llm_errors_total": telemetry.errors,
+            "uptrain_llm_validation_failures_total": telemetry.validation_failures,
+            "uptrain_llm_prompt_tokens_total": telemetry.prompt_tokens,
+            "uptrain_llm_completion_tokens_total": telemetry.completion_tokens,
+            "uptrain_llm_cached_prompt_tokens_total": telemetry.cached_prompt_tokens,
+        }
+        observations = {
+            "uptrain_llm_total_seconds": telemetry.total_time,
+        }
+        if telemetry.attempts:
+            observations["uptrain_llm_queue_seconds"] = telemetry.queue_time
+            observations["uptrain_llm_latency_seconds"] = telemetry.latency
+        with self._lock:
+            for name, amount in counts.items():
+                self._counters[name][labels] = self._counters[name].get(labels, 0) + amount
+            for name, value in observations.items():
+                histogram = self._histograms[name].get(labels)
+                if histogram is None:
+                    histogram = self._histograms[name][labels] = Histogram(self.buckets)
+                histogram.observe(value)
+
+    def reset(self) -> None:
+        with self._lock:
+            for values in [*self._counters.values(), *self._histograms.values()]:
+                values.clear()
+
+    def summary(self) -> dict:
+        """Counters and latency percentiles, keyed by `model/operator`."""
+        summary: dict[str, dict] = {}
+        with self._lock:
+            for name, values in self._counters.items():
+                for labels, value in values.items():
+                    key = "/".join(value for _, value in labels if value)
+                    summary.setdefault(key, {})[_short_name(name)] = value
+            for name, values in self._histograms.items():
+                for labels, histogram in values.items():
+                    key = "/".join(value for _, value in labels if value)
+                    summary.setdefault(key, {})[_short_name(name)] = histogram.summary()
+        return summary
+
+    def to_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+
+        def format_labels(labels: LabelKey, extra: t.Optional[tuple] = None) -> str:
+            pairs = [*labels, *([extra] if extra else [])]
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name, values in self._counters.items():
+                lines.append(f"# HELP {name} {COUNTERS[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in values.items():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            for name, values in self._histograms.items():
+                lines.append(f"# HELP {name} {HISTOGRAMS[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in values.items():
+                    cumulative = 0
+                    for bound, count in zip(
+                        [*histogram.buckets, math.inf], histogram.counts
+                    ):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else str(bound)
+                        lines.append(
+                            f"{name}_bucket{format_labels(labels, ('le', le))} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _short_name(name: str) -> str:
+    """Metric name without the common prefix and the counter suffix, for summaries."""
+    name = name[len("uptrain_llm_") :]
+    return name[: -len("_total")] if name.endswith("_total") else name
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# -----------------------------------------------------------
+# Hooks
+# -----------------------------------------------------------
+
+
+class MetricsHook(t.Protocol):
+    """Called with the telemetry of each payload once it is done."""
+
+    def __call__(self, telemetry: RequestTelemetry) -> None:
+        ...
+
+
+_METRICS_REGISTRY = MetricsRegistry()
+_METRICS_HOOKS: list[MetricsHook] = [_METRICS_REGISTRY]
+_METRICS_HOOKS_LOCK = threading.Lock()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """The process wide registry aggregating the telemetry of all LLM calls."""
+    return _METRICS_REGISTRY
+
+
+def register_metrics_hook(hook: MetricsHook) -> None:
+    """Add a hook to receive the telemetry of every LLM payload, e.g. to forward it
+    to a metrics backend."""
+    with _METRICS_HOOKS_LOCK:
+        if hook not in _METRICS_HOOKS:
+            _METRICS_HOOKS.append(hook)
+
+
+def unregister_metrics_hook(hook: MetricsHook) -> None:
+    with _METRICS_HOOKS_LOCK:
+        if hook in _METRICS_HOOKS:
+            _METRICS_HOOKS.remove(hook)
+
+
+def record_telemetry(telemetry: RequestTelemetry) -> None:
+    """Hand the telemetry of a finished payload to all the hooks."""
+    with _METRICS_HOOKS_LOCK:
+        hooks = list(_METRICS_HOOKS)
+    for hook in hooks:
+        try:
+            hook(telemetry)
+        except Exception as e:
+            logger.warning(f"Metrics hook {hook} failed: {e}")
+
+
+def summarize_payloads(payloads: t.Iterable[t.Any]) -> dict:
+    """Summary of the telemetry attached to the payloads, keyed by `model/operator`."""
+    registry = MetricsRegistry()
+    for payload in payloads:
+        if payload.telemetry is not None:
+            registry.record(payload.telemetry)
+    return registry.summary()
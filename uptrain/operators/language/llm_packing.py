@@ -0,0 +1,226 @@
+"""
+Multi-row prompt packing. Cheap per-row evaluators repeat the same instructions and
+few-shot examples in every request; packing grades several rows in one request that
+shares them, with the rows numbered in the task data and a JSON array as the output.
+Rows whose packed output can't be parsed or validated are re-sent one per request.
+
+Packing composes with the prompt layout and with sampling several choices per request.
+Cascaded grading scores the output of each row on its own, so rows aren't packed when
+a cascade model is set.
+"""
+
+from __future__ import annotations
+import json
+import typing as t
+
+from loguru import logger
+
+from uptrain.operators.language.llm import Payload, load_json, validate_output
+from uptrain.operators.language.prompts.layout import render_prompt, split_template
+
+if t.TYPE_CHECKING:
+    from uptrain.framework import Settings
+    from uptrain.operators.language.llm import LLMMulticlient
+
+__all__ = [
+    "use_packed_requests",
+    "make_packed_output_format",
+    "make_packed_prompt",
+    "parse_packed_output",
+    "fetch_packed_responses",
+]
+
+
+TASK_DATA_MARKER = "Task Data."
+
+PACKED_ROWS_INSTRUCTIONS = """
+The task data below contains {num_rows} rows, numbered from 1 to {num_rows}. Grade each row independently of the others, as if it was the only task data given.
+Return a JSON array with one object per row, in the order of the rows. Each object must include the number of the row it grades.
+"""
+
+
+def use_packed_requests(settings: Settings, scenario_vars: t.Sequence[str]) -> bool:
+    """Whether an evaluator should grade its rows with packed prompts. Rows with a
+    scenario description of their own can't share a prompt."""
+    if settings.rows_per_request <= 1 or len(scenario_vars):
+        return False
+    if settings.cascade_model is not None:
+        logger.warning(
+            "Cascaded grading scores each row on its own, ignoring `rows_per_request` "
+            f"({settings.rows_per_request}) as `cascade_model` is set"
+        )
+        return False
+    return True
+
+
+def make_packed_output_format(output_format: str) -> str:
+    """Turn the output format of a single row into the format of a JSON array over rows."""
+    lines = output_format.strip("\n").split("\n")
+    row_line = '    "Row": [Row number],  # Number of the task data row being graded,'
+    lines = [lines[0], row_line] + lines[1:]
+    body = "\n".join("    " + line for line in lines)
+    return f"\n[\n{body},\n    ...\n]\n"
+
+
+def make_packed_prompt(template: str, rows: list[dict], prompt_kwargs: dict) -> str:
+    """
+    Build a single grading prompt for the rows from a per-row prompt template. The
+    instructions before the task data are included once, the task data is repeated
+    for each (numbered) row.
+    """
+    header, _, task_data = template.rpartition(TASK_DATA_MARKER)
+    if not header:
+        raise ValueError("Prompt template has no task data section to pack rows into")
+
+    kwargs = dict(prompt_kwargs)
+    kwargs["output_format"] = make_packed_output_format(kwargs["output_format"])
+    header = header.replace("this JSON object", "this JSON array").format(**kwargs)
+    prompt = header.rstrip("\n") + "\n" + PACKED_ROWS_INSTRUCTIONS.format(num_rows=len(rows))
+    prompt += f"\n{TASK_DATA_MARKER}\n"
+    for num, row in enumerate(rows, start=1):
+        prompt += f"\nRow {num}:" + task_data.format(**{**prompt_kwargs, **row})
+    return prompt
+
+
+def parse_packed_output(
+    content: str, num_rows: int, validate_func: t.Optional[t.Callable] = None
+) -> t.Optional[list[dict]]:
+    """Return the per-row outputs in row order, or None if the output doesn't cover all
+    the rows or any of them fails validation."""
+    first_index, last_index = content.find("["), content.rfind("]")
+    if first_index == -1 or last_index < first_index:
+        return None
+    json_str = content[first_index : last_index + 1]
+    try:
+        outputs = load_json(json_str)
+    except Exception:
+        return None
+    if not isinstance(outputs, list) or len(outputs) != num_rows:
+        return None
+
+    by_row = {}
+    for num, output in enumerate(outputs, start=1):
+        if not isinstance(output, dict):
+            return None
+        try:
+            num = int(output.pop("Row", num))
+        except (TypeError, ValueError):
+            return None
+        by_row[num] = output
+    if sorted(by_row) != list(range(1, num_rows + 1)):
+        return None
+    outputs = [by_row[num] for num in range(1, num_rows + 1)]
+    if validate_func is not None:
+        for output in outputs:
+            if not validate_output(output, validate_func):
+                return None
+    return outputs
+
+
+def _unpack_response(response: t.Any, outputs: dict[int, dict]) -> t.Any:
+    """Copy of a packed response, keeping the choices with an output for the row, with
+    their content replaced by that output."""
+    row_response = response.model_copy(deep=True)
+    row_response.choices = [row_response.choices[idx] for idx in outputs]
+    for choice, output in zip(row_response.choices, outputs.values()):
+        choice.message.content = json.dumps(output)
+    return row_response
+
+
+def fetch_packed_responses(
+    client: LLMMulticlient,
+    template: str,
+    rows: list[dict],
+    prompt_kwargs: dict,
+    validate_func: t.Optional[t.Callable] = None,
+    rows_per_request: int = 1,
+    prompt_layout: str = "classic",
+    sampling_kwargs: t.Optional[dict] = None,
+) -> list[Payload]:
+    """
+    Grade the rows with packed prompts, `rows_per_request` rows at a time. Returns one
+    payload per row (indexed by its position in `rows`) whose response holds just the
+    output for that row, so callers can parse it the same way as an unpacked response.
+
+    Args:
+        client (LLMMulticlient): Client to send the requests through.
+        template (str): Per-row prompt template, with the scenario description filled in.
+        rows (list[dict]): Task data of each row.
+        prompt_kwargs (dict): Values shared by all rows - output format, few shots, etc.
+        validate_func (Callable): Validation function for the output of a single row.
+        rows_per_request (int): Maximum number of rows to pack into a request.
+        prompt_layout (str): Layout of the prompts, see `prompts.layout.render_prompt`.
+        sampling_kwargs (dict): Arguments to sample several choices per request, see
+            `llm.get_sampling_kwargs`. Each row gets the choices that cover it.
+    """
+    sampling_kwargs = sampling_kwargs or {}
+    chunks = [
+        list(range(start, min(start + rows_per_request, len(rows))))
+        for start in range(0, len(rows), rows_per_request)
+    ]
+    packed_payloads = []
+    for chunk_idx, chunk in enumerate(chunks):
+        prompt = make_packed_prompt(template, [rows[idx] for idx in chunk], prompt_kwargs)
+        system_prompt, parts = None, None
+        if prompt_layout == "cacheable":
+            parts = split_template(prompt)
+        if parts is not None:
+            # the instructions are the same for every chunk, the rows go in the user message
+            system_prompt, prompt = parts[0].strip(), parts[1]
+        payload = client.make_payload(
+            chunk_idx, prompt, system_prompt=system_prompt, **sampling_kwargs
+        )
+        payload.metadata["packed_rows"] = chunk
+        packed_payloads.append(payload)
+
+    # packed outputs are validated below, a chunk that fails falls back to per-row
+    # requests rather than being retried as a whole
+    output_payloads = client.fetch_responses(packed_payloads)
+
+    results, fallback_rows = {}, []
+    for res in output_payloads:
+        chunk = res.metadata["packed_rows"]
+        # outputs of the rows, for each choice whose packed output is valid
+        choice_outputs = {}
+        if res.response is not None:
+            for choice_idx, choice in enumerate(res.response.choices):
+                outputs = parse_packed_output(
+                    choice.message.content or "", len(chunk), validate_func
+                )
+                if outputs is not None:
+                    choice_outputs[choice_idx] = outputs
+        if not choice_outputs:
+            fallback_rows.extend(chunk)
+            continue
+        for position, idx in enumerate(chunk):
+            outputs = {
+                choice_idx: outputs[position]
+                for choice_idx, outputs in choice_outputs.items()
+            }
+            row_payload = Payload(
+                data=res.data,
+                metadata={"index": idx, "packed": True},
+                response=_unpack_response(res.response, outputs),
+            )
+            # the row output is already parsed, don't parse it again for scoring
+            row_payload._parsed = (row_payload.response, list(outputs.values()))
+            results[idx] = row_payload
+
+    if fallback_rows:
+        logger.warning(
+            f"Packed outputs for {len(fallback_rows)} rows couldn't be parsed, grading them one per request"
+        )
+        input_payloads = []
+        for idx in fallback_rows:
+            system_prompt, prompt = render_prompt(
+                template, {**prompt_kwargs, **rows[idx]}, layout=prompt_layout
+            )
+            input_payloads.append(
+                client.make_payload(
+                    idx, prompt, system_prompt=system_prompt, **sampling_kwargs
+                )
+            )
+        for res in client.fetch_responses(input_payloads, validate_func):
+            results[res.metadata["index"]] = res
+
+    return [results[idx] for idx in sorted(results)]
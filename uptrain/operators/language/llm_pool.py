@@ -0,0 +1,213 @@
+"""
+Pool of LLM API clients - several API keys, Azure deployments or OpenAI compatible
+endpoints (e.g. vLLM servers) serving the same model. Each member has its own rate
+limits and concurrency control, members that keep failing are taken out of rotation
+for a while, and requests are routed to the member with the fewest outstanding
+requests relative to its weight.
+"""
+
+from __future__ import annotations
+import threading
+import time
+import typing as t
+
+from loguru import logger
+from pydantic import BaseModel
+
+from uptrain.operators.language.llm_ratelimit import (
+    AdaptiveConcurrencyController,
+    TokenBucketLimiter,
+    get_shared_limiters,
+)
+
+if t.TYPE_CHECKING:
+    from uptrain.framework import Settings
+
+__all__ = ["ClientPoolMember", "PoolMember", "ClientPool"]
+
+
+class ClientPoolMember(BaseModel):
+    """
+    Configuration of a member of the client pool, as listed in `Settings.client_pool`.
+
+    Attributes:
+        provider (str): "openai" for OpenAI and compatible endpoints, "azure" for Azure OpenAI.
+        api_key (str): API key of the member.
+        api_base (str): Base URL of the endpoint, the Azure endpoint for Azure deployments.
+        api_version (str): API version for Azure deployments.
+        model (str): Model (or Azure deployment) name to use with this member, defaults to the
+            model in the settings.
+        rpm_limit (int): Requests per minute limit, defaults to `Settings.rpm_limit`.
+        tpm_limit (int): Tokens per minute limit, defaults to `Settings.tpm_limit`.
+        weight (float): Relative share of the traffic the member should get.
+    """
+
+    provider: t.Literal["openai", "azure"] = "openai"
+    api_key: t.Optional[str] = None
+    api_base: t.Optional[str] = None
+    api_version: t.Optional[str] = None
+    model: t.Optional[str] = None
+    rpm_limit: t.Optional[int] = None
+    tpm_limit: t.Optional[int] = None
+    weight: float = 1.0
+
+
+class PoolMember:
+    """
+    Runtime state of a member of the client pool.
+
+    Attributes:
+        config (ClientPoolMember): Configuration of the member.
+        name (str): Name used in logs, the endpoint of the member.
+        rpm_limiter, tpm_limiter (TokenBucketLimiter): Rate limiters of the member.
+        controller (AdaptiveConcurrencyController): Concurrency control of the member.
+        outstanding (int): Number of requests currently routed to the member.
+        consecutive_failures (int): Failed requests since the last successful one.
+        unhealthy_until (float): Monotonic time until which the member is out of rotation.
+    """
+
+    def __init__(
+        self,
+        config: ClientPoolMember,
+        rpm_limiter: TokenBucketLimiter,
+        tpm_limiter: TokenBucketLimiter,
+        controller: AdaptiveConcurrencyController,
+        aclient: t.Any = None,
+    ):
+        self.config = config
+        self.name = config.api_base or config.provider
+        self.rpm_limiter = rpm_limiter
+        self.tpm_limiter = tpm_limiter
+        self.controller = controller
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.num_requests = 0
+        self.num_failures = 0
+        self.aclient = aclient
+
+    def get_aclient(self) -> t.Any:
+        """The async client of the member, shared on the running event loop and closed
+        along with it."""
+        if self.aclient is not None:
+            return self.aclient
+        from uptrain.operators.language import llm
+
+        if self.config.provider == "azure":
+            return llm.get_shared_aclient(
+                llm.AsyncAzureOpenAI,
+                api_key=self.config.api_key,
+                api_version=self.config.api_version,
+                azure_endpoint=self.config.api_base,
+            )
+        return llm.get_shared_aclient(
+            llm.AsyncOpenAI, api_key=self.config.api_key, base_url=self.config.api_base
+        )
+
+    def is_healthy(self, now: t.Optional[float] = None) -> bool:
+        return (now or time.monotonic()) >= self.unhealthy_until
+
+    def load(self) -> float:
+        """Outstanding requests relative to the weight of the member."""
+        return (self.outstanding + 1) / max(self.config.weight, 1e-6)
+
+
+class ClientPool:
+    """
+    Routes requests across the members of a client pool, using weighted
+    least-outstanding-requests among the healthy members.
+
+    Attributes:
+        members (list[PoolMember]): Members of the pool.
+        failure_threshold (int): Consecutive failures after which a member is taken out of rotation.
+        base_cooldown (float): Seconds a member stays out of rotation the first time, doubled for
+            each further failure.
+        max_cooldown (float): Upper bound on the time a member stays out of rotation.
+    """
+
+    def __init__(
+        self,
+        members: list[PoolMember],
+        failure_threshold: int = 3,
+        base_cooldown: float = 10.0,
+        max_cooldown: float = 300.0,
+    ):
+        if not members:
+            raise ValueError("A client pool needs at least one member")
+        self.members = members
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> ClientPool:
+        members = []
+        for config in settings.client_pool:
+            config = ClientPoolMember.model_validate(config)
+            rpm_limiter, tpm_limiter = get_shared_limiters(
+                settings,
+                f"{config.provider}@{config.api_base}",
+                config.api_key,
+                rpm_limit=config.rpm_limit,
+                tpm_limit=config.tpm_limit,
+            )
+            controller = AdaptiveConcurrencyController(
+                max_concurrency=settings.max_concurrency,
+                adaptive=settings.adaptive_concurrency,
+            )
+            members.append(PoolMember(config, rpm_limiter, tpm_limiter, controller))
+        return cls(members)
+
+    def acquire(self, exclude: t.Collection[PoolMember] = ()) -> PoolMember:
+        """Pick the member to send the next request to, and count it as outstanding.
+        If no member is healthy, the one due back in rotation first is used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [member for member in self.members if member not in exclude]
+            if not candidates:
+                candidates = self.members
+            healthy = [member for member in candidates if member.is_healthy(now)]
+            if healthy:
+                member = min(healthy, key=lambda member: member.load())
+            else:
+                member = min(candidates, key=lambda member: member.unhealthy_until)
+            member.outstanding += 1
+            member.num_requests += 1
+        return member
+
+    def release(self, member: PoolMember, success: t.Optional[bool]) -> None:
+        """Record the outcome of a request routed to the member, None if the request
+        was abandoned before it completed."""
+        with self._lock:
+            member.outstanding -= 1
+            if success is None:
+                return
+            if success:
+                member.consecutive_failures = 0
+                return
+            member.num_failures += 1
+            member.consecutive_failures += 1
+            if member.consecutive_failures >= self.failure_threshold:
+                num_trips = member.consecutive_failures - self.failure_threshold
+                cooldown = min(self.base_cooldown * 2**num_trips, self.max_cooldown)
+                member.unhealthy_until = time.monotonic() + cooldown
+                logger.warning(
+                    f"Taking {member.name} out of the client pool for {cooldown:.0f}s "
+                    f"after {member.consecutive_failures} consecutive failures"
+                )
+
+    def stats(self) -> list[dict]:
+        """Per member request counts and health."""
+        now = time.monotonic()
+        return [
+            {
+                "name": member.name,
+                "requests": member.num_requests,
+                "failures": member.num_failures,
+                "outstanding": member.outstanding,
+                "healthy": member.is_healthy(now),
+            }
+            for member in self.members
+        ]
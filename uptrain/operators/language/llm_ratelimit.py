@@ -0,0 +1,464 @@
+"""
+Rate limiting helpers for the LLM client: token bucket limiters shared by all clients
+in a process (or across processes), an AIMD-style concurrency controller that reacts
+to throttling, and exponential backoff that honours server hints.
+"""
+
+from __future__ import annotations
+import asyncio
+import collections
+import contextlib
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import typing as t
+import weakref
+
+from loguru import logger
+
+from uptrain.operators.language.llm_scheduler import PRIORITY_CLASSES
+
+if t.TYPE_CHECKING:
+    from uptrain.framework import Settings
+
+__all__ = [
+    "TokenBucketLimiter",
+    "SqliteTokenBucketLimiter",
+    "get_shared_limiters",
+    "AdaptiveConcurrencyController",
+    "backoff_delay",
+    "get_response_headers",
+    "parse_retry_after",
+]
+
+
+# -----------------------------------------------------------
+# Token bucket limiters, shareable across clients
+# -----------------------------------------------------------
+
+
+# Seconds between checks of requests leaving the capacity to higher priority ones
+PREEMPTED_POLL_INTERVAL = 0.1
+
+
+class TokenBucketLimiter:
+    """
+    Leaky bucket rate limiter, with the same semantics as `aiolimiter.AsyncLimiter`:
+    up to `max_rate` units can be acquired in a burst, and capacity drips back at
+    `max_rate / time_period` per second. Unlike `AsyncLimiter`, it isn't bound to an
+    event loop and is thread-safe, so a single instance can be shared by every client
+    in the process. While requests of a priority class wait for capacity, those of the
+    lower classes (see `llm_scheduler.PRIORITY_CLASSES`) leave it to them, whichever
+    event loop or thread they run on.
+
+    Attributes:
+        max_rate (float): Capacity of the bucket.
+        time_period (float): Seconds over which `max_rate` units drip out.
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 60):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._level = 0.0
+        self._last_check = time.monotonic()
+        self._lock = threading.Lock()
+        # requests of the process waiting for capacity, per priority class
+        self._num_waiting: collections.Counter[str] = collections.Counter()
+        self._waiting_lock = threading.Lock()
+
+    @property
+    def _rate_per_sec(self) -> float:
+        return self.max_rate / self.time_period
+
+    def _leak(self, level: float, last_check: float, now: float) -> float:
+        return max(level - (now - last_check) * self._rate_per_sec, 0)
+
+    def _try_acquire(self, amount: float) -> float:
+        """Acquire the amount if there's capacity. Returns 0 on success, else the
+        number of seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._level = self._leak(self._level, self._last_check, now)
+            self._last_check = now
+            needed = self._level + amount - self.max_rate
+            if needed <= 0:
+                self._level += amount
+                return 0
+            return needed / self._rate_per_sec
+
+    async def _atry_acquire(self, amount: float) -> float:
+        return self._try_acquire(amount)
+
+    def _is_preempted(self, priority: str) -> bool:
+        """Whether requests of a higher priority class are waiting for capacity."""
+        with self._waiting_lock:
+            for other in PRIORITY_CLASSES[: PRIORITY_CLASSES.index(priority)]:
+                if self._num_waiting[other]:
+                    return True
+        return False
+
+    async def acquire(self, amount: float = 1, priority: str = "default") -> None:
+        """Acquire capacity, waiting until enough of it is available, and for the
+        waiting requests of higher priority classes to get theirs."""
+        if not 0 <= amount <= self.max_rate:
+            raise ValueError(
+                "Amount must be a number between zero and the maximum capacity"
+            )
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(
+                f"Unknown request priority {priority}, expected one of {PRIORITY_CLASSES}"
+            )
+        waiting = False
+        try:
+            while True:
+                if self._is_preempted(priority):
+                    wait = PREEMPTED_POLL_INTERVAL
+                else:
+                    wait = await self._atry_acquire(amount)
+                    if wait <= 0:
+                        return
+                if not waiting:
+                    with self._waiting_lock:
+                        self._num_waiting[priority] += 1
+                    waiting = True
+                # small jitter so that waiters don't all retry at the same instant
+                await asyncio.sleep(wait + random.uniform(0, 0.05))
+        finally:
+            if waiting:
+                with self._waiting_lock:
+                    self._num_waiting[priority] -= 1
+
+    def adjust(self, amount: float) -> None:
+        """Return `amount` of capacity to the bucket, or consume it (without waiting) if negative."""
+        with self._lock:
+            now = time.monotonic()
+            level = self._leak(self._level, self._last_check, now)
+            self._level = min(max(level - amount, 0), self.max_rate)
+            self._last_check = now
+
+    async def aadjust(self, amount: float) -> None:
+        """Same as `adjust`, for callers running on an event loop."""
+        self.adjust(amount)
+
+
+class SqliteTokenBucketLimiter(TokenBucketLimiter):
+    """
+    Token bucket limiter whose state lives in a SQLite database, so that several
+    worker processes on the same machine draw from a single quota.
+
+    Attributes:
+        fpath (str): Path of the SQLite database file.
+        name (str): Name of the bucket within the database.
+    """
+
+    def __init__(self, fpath: str, name: str, max_rate: float, time_period: float = 60):
+        super().__init__(max_rate, time_period)
+        self.fpath = fpath
+        self.name = name
+        dirname = os.path.dirname(fpath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(
+            fpath, check_same_thread=False, timeout=30, isolation_level=None
+        )
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, level REAL NOT NULL, last_check REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO buckets (name, level, last_check) VALUES (?, 0, ?)",
+                (name, time.time()),
+            )
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock upfront, serializing all processes
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                level, last_check = self._conn.execute(
+                    "SELECT level, last_check FROM buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                state = {"level": self._leak(level, last_check, now)}
+                yield state
+                self._conn.execute(
+                    "UPDATE buckets SET level = ?, last_check = ? WHERE name = ?",
+                    (state["level"], now, self.name),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _try_acquire(self, amount: float) -> float:
+        with self._transaction() as state:
+            needed = state["level"] + amount - self.max_rate
+            if needed <= 0:
+                state["level"] += amount
+                return 0
+        return needed / self._rate_per_sec
+
+    def adjust(self, amount: float) -> None:
+        with self._transaction() as state:
+            state["level"] = min(max(state["level"] - amount, 0), self.max_rate)
+
+    # the transactions can wait on other processes for the database lock, so they run
+    # in a worker thread rather than block the event loop
+
+    async def _atry_acquire(self, amount: float) -> float:
+        return await asyncio.to_thread(self._try_acquire, amount)
+
+    async def aadjust(self, amount: float) -> None:
+        await asyncio.to_thread(self.adjust, amount)
+
+
+_SHARED_LIMITERS: dict[str, TokenBucketLimiter] = {}
+_SHARED_LIMITERS_LOCK = threading.Lock()
+
+
+def _get_shared_limiter(
+    settings: Settings, name: str, max_rate: float
+) -> TokenBucketLimiter:
+    if settings.rate_limiter_backend == "sqlite":
+        fpath = settings.rate_limiter_path
+        if fpath is None:
+            fpath = os.path.join(settings.logs_folder, "llm_rate_limits.sqlite")
+        registry_key = f"{fpath}:{name}"
+    else:
+        fpath = None
+        registry_key = name
+
+    with _SHARED_LIMITERS_LOCK:
+        limiter = _SHARED_LIMITERS.get(registry_key)
+        if limiter is None or (fpath is not None and not os.path.exists(fpath)):
+            if fpath is not None:
+                limiter = SqliteTokenBucketLimiter(fpath, name, max_rate, time_period=60)
+            else:
+                limiter = TokenBucketLimiter(max_rate, time_period=60)
+            _SHARED_LIMITERS[registry_key] = limiter
+        # the most recently configured limit wins
+        limiter.max_rate = max_rate
+    return limiter
+
+
+def get_shared_limiters(
+    settings: Settings,
+    provider: str,
+    api_key: t.Optional[str],
+    rpm_limit: t.Optional[int] = None,
+    tpm_limit: t.Optional[int] = None,
+) -> tuple[TokenBucketLimiter, TokenBucketLimiter]:
+    """Return the (requests per minute, tokens per minute) limiters shared by every
+    client talking to the same provider with the same API key. The limits default to
+    the ones in the settings.
+    """
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    name = f"{provider}:{key_hash}"
+    return (
+        _get_shared_limiter(settings, f"{name}:rpm", rpm_limit or settings.rpm_limit),
+        _get_shared_limiter(settings, f"{name}:tpm", tpm_limit or settings.tpm_limit),
+    )
+
+
+# -----------------------------------------------------------
+# Backoff and adaptive concurrency
+# -----------------------------------------------------------
+
+
+def get_response_headers(obj: t.Any) -> t.Mapping[str, str]:
+    """Headers attached to a response or an API error, if any."""
+    headers = getattr(obj, "headers", None)
+    if headers is None:
+        response = getattr(obj, "response", None)
+        headers = getattr(response, "headers", None)
+    return headers if headers is not None else {}
+
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_duration(value: str) -> t.Optional[float]:
+    """Parse durations like `20ms`, `1.5s` or `6m0s` used in the ratelimit reset headers."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(num) * _DURATION_UNITS[unit] for num, unit in parts)
+
+
+def parse_retry_after(headers: t.Mapping[str, str]) -> t.Optional[float]:
+    """Seconds the server asks us to wait before retrying, if it says so."""
+    if not headers:
+        return None
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    for key in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(key)
+        if value is not None:
+            seconds = _parse_duration(value)
+            if seconds is not None:
+                return seconds
+    return None
+
+
+# Rate limits of the LLM APIs are over a one minute window, throttled requests with no
+# hint of when to retry back off from this, so that the 3 retries of the default 4
+# attempts wait at least 60s in all.
+THROTTLE_BASE_DELAY = 20.0
+
+
+def backoff_delay(
+    attempt: int,
+    retry_after: t.Optional[float] = None,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    throttled: bool = False,
+) -> float:
+    """Exponential backoff with full jitter. If the server hinted a retry delay, we
+    wait for that long (with a little jitter so waiters don't wake up together),
+    never more than `max_delay`. Throttled requests without a hint back off from
+    `THROTTLE_BASE_DELAY` instead, with only half of each delay jittered.
+    """
+    if retry_after is not None:
+        return min(retry_after + random.uniform(0, base_delay), max_delay)
+    if throttled:
+        delay = min(max_delay, max(base_delay, THROTTLE_BASE_DELAY) * (2**attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+    return random.uniform(0, min(max_delay, base_delay * (2**attempt)))
+
+
+class _LoopSlots:
+    """Requests in flight on one event loop, and the condition to wait for a slot."""
+
+    __slots__ = ("cond", "in_flight")
+
+    def __init__(self):
+        self.cond = asyncio.Condition()
+        self.in_flight = 0
+
+
+class AdaptiveConcurrencyController:
+    """
+    Caps the number of requests in flight, and adapts the cap with additive-increase/
+    multiplicative-decrease: grow on success, shrink on throttling. Starts in
+    slow-start (the cap grows by one per success) until the first throttle.
+
+    Attributes:
+        limit (float): Current concurrency cap, per event loop.
+        min_concurrency (int): Lower bound for the cap.
+        max_concurrency (Optional[int]): Upper bound for the cap. None for no bound.
+        decrease_factor (float): Multiplier applied to the cap on throttling.
+        cooldown (float): Seconds after a decrease during which further throttles don't shrink the cap,
+            since they usually belong to requests sent before the decrease.
+        adaptive (bool): If False, the cap stays at `max_concurrency`.
+        num_throttles (int): Number of throttled requests seen.
+    """
+
+    def __init__(
+        self,
+        initial_concurrency: int = 10,
+        min_concurrency: int = 1,
+        max_concurrency: t.Optional[int] = 100,
+        decrease_factor: float = 0.5,
+        cooldown: float = 2.0,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        adaptive: bool = True,
+    ):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = (
+            None if max_concurrency is None else max(max_concurrency, min_concurrency)
+        )
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.adaptive = adaptive
+        if adaptive:
+            self.limit = float(
+                min(max(initial_concurrency, min_concurrency), self._upper_bound)
+            )
+        else:
+            self.limit = self._upper_bound
+        self.num_throttles = 0
+        self._slow_start = True
+        self._last_decrease = float("-inf")
+        # conditions are bound to an event loop, the client may be used across several
+        self._slots: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, _LoopSlots
+        ] = weakref.WeakKeyDictionary()
+        self._slots_lock = threading.Lock()
+
+    @property
+    def _upper_bound(self) -> float:
+        return float("inf") if self.max_concurrency is None else float(self.max_concurrency)
+
+    def _get_slots(self) -> _LoopSlots:
+        loop = asyncio.get_running_loop()
+        with self._slots_lock:
+            slots = self._slots.get(loop)
+            if slots is None:
+                slots = self._slots[loop] = _LoopSlots()
+        return slots
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one unit of concurrency for the duration of the block."""
+        if self.limit == float("inf"):
+            yield
+            return
+        slots = self._get_slots()
+        async with slots.cond:
+            await slots.cond.wait_for(lambda: slots.in_flight + 1 <= self.limit)
+            slots.in_flight += 1
+        try:
+            yield
+        finally:
+            async with slots.cond:
+                slots.in_flight -= 1
+                slots.cond.notify_all()
+
+    def on_success(self, headers: t.Mapping[str, str]) -> None:
+        """Grow the cap after a successful request, unless the server reports the quota is spent."""
+        if not self.adaptive:
+            return
+        for key in ("x-ratelimit-remaining-requests", "x-ratelimit-remaining-tokens"):
+            value = headers.get(key) if headers else None
+            if value is not None and value.isdigit() and int(value) == 0:
+                return
+        if self._slow_start:
+            self.limit = min(self.limit + 1, self._upper_bound)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self._upper_bound)
+
+    def on_throttle(self, headers: t.Mapping[str, str], attempt: int) -> float:
+        """Shrink the cap after a throttled request. Returns how long to wait before retrying."""
+        self.num_throttles += 1
+        now = time.monotonic()
+        if self.adaptive and now - self._last_decrease > self.cooldown:
+            self._slow_start = False
+            self._last_decrease = now
+            self.limit = max(self.limit * self.decrease_factor, self.min_concurrency)
+            logger.info(f"Throttled by the LLM API, reducing concurrency to {int(self.limit)}")
+        return self.backoff_delay(attempt, parse_retry_after(headers), throttled=True)
+
+    def backoff_delay(
+        self, attempt: int, retry_after: t.Optional[float] = None, throttled: bool = False
+    ) -> float:
+        return backoff_delay(
+            attempt, retry_after, self.base_delay, self.max_delay, throttled=throttled
+        )
@@ -0,0 +1,186 @@
+"""
+Priority-aware scheduling of LLM requests. Requests from every client talking to the
+same provider with the same API key on an event loop are admitted through a shared
+scheduler, which caps how many are in flight at once (`Settings.max_concurrency`).
+Waiting requests of a higher priority class are admitted first, and within a class the
+run with the fewest requests in flight goes next - so a small interactive evaluation
+isn't stuck behind thousands of queued payloads of a bulk one, which still gets all the
+capacity left over.
+
+Runs on different event loops or threads (each `fetch_responses` runs on a loop of its
+own, unless `Settings.persistent_event_loop` is set) don't share a scheduler, the
+priority classes are applied between them where they wait for the rate limiters of the
+process, see `llm_ratelimit.TokenBucketLimiter`.
+"""
+
+from __future__ import annotations
+import asyncio
+import collections
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import threading
+import typing as t
+import weakref
+
+__all__ = [
+    "PRIORITY_CLASSES",
+    "RequestScheduler",
+    "get_shared_scheduler",
+    "run_context",
+    "get_current_run",
+]
+
+
+# Highest priority first
+PRIORITY_CLASSES = ("interactive", "default", "bulk")
+
+
+class RequestScheduler:
+    """
+    Admits requests in priority order, with fair share between the runs of a class.
+
+    Attributes:
+        max_concurrency (Optional[int]): Maximum number of requests admitted at once. None for no limit,
+            the requests are then only ordered by the rate limiters.
+        in_flight (dict[str, int]): Number of admitted requests per run.
+        num_waiting (int): Number of requests waiting to be admitted.
+    """
+
+    def __init__(self, max_concurrency: t.Optional[int] = 100):
+        self.max_concurrency = _clamp_concurrency(max_concurrency)
+        self.in_flight: collections.Counter[str] = collections.Counter()
+        # priority -> run -> futures of the waiting requests, in arrival order
+        self._waiting: dict[str, dict[str, t.Deque[asyncio.Future]]] = {
+            priority: collections.OrderedDict() for priority in PRIORITY_CLASSES
+        }
+        self._num_admitted = 0
+
+    @property
+    def num_waiting(self) -> int:
+        return sum(
+            len(queue) for runs in self._waiting.values() for queue in runs.values()
+        )
+
+    def _next_run(self) -> t.Optional[tuple[str, str]]:
+        """(priority, run) of the next request to admit, None if nothing is waiting."""
+        for priority in PRIORITY_CLASSES:
+            runs = self._waiting[priority]
+            if runs:
+                # the run with the fewest requests in flight, the longest waiting on ties
+                run = min(runs, key=lambda run: self.in_flight[run])
+                return priority, run
+        return None
+
+    def _has_capacity(self) -> bool:
+        return self.max_concurrency is None or self._num_admitted < self.max_concurrency
+
+    def _admit_waiting(self) -> None:
+        while self._has_capacity():
+            next_run = self._next_run()
+            if next_run is None:
+                return
+            priority, run = next_run
+            queue = self._waiting[priority][run]
+            future = queue.popleft()
+            if not queue:
+                del self._waiting[priority][run]
+            else:
+                # move to the back, so runs with equal load take turns
+                self._waiting[priority].move_to_end(run)
+            if future.done():  # cancelled while waiting
+                continue
+            self._num_admitted += 1
+            self.in_flight[run] += 1
+            future.set_result(None)
+
+    async def acquire(self, priority: str = "default", run: str = "") -> None:
+        """Wait until the request is admitted."""
+        if priority not in self._waiting:
+            raise ValueError(
+                f"Unknown request priority {priority}, expected one of {PRIORITY_CLASSES}"
+            )
+        if self._has_capacity() and not self.num_waiting:
+            self._num_admitted += 1
+            self.in_flight[run] += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[priority].setdefault(run, collections.deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # admitted just as we were cancelled, pass the slot on
+                self.release(run)
+            raise
+
+    def release(self, run: str = "") -> None:
+        self._num_admitted -= 1
+        self.in_flight[run] -= 1
+        if self.in_flight[run] <= 0:
+            del self.in_flight[run]
+        self._admit_waiting()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: str = "default", run: str = ""):
+        """Hold an admission for the duration of the block."""
+        await self.acquire(priority, run)
+        try:
+            yield
+        finally:
+            self.release(run)
+
+
+# schedulers hold futures bound to an event loop, so they are shared per loop
+_SHARED_SCHEDULERS: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, RequestScheduler]
+] = weakref.WeakKeyDictionary()
+_SHARED_SCHEDULERS_LOCK = threading.Lock()
+
+
+def _clamp_concurrency(max_concurrency: t.Optional[int]) -> t.Optional[int]:
+    return None if max_concurrency is None else max(max_concurrency, 1)
+
+
+def get_shared_scheduler(
+    provider: str, api_key: t.Optional[str], max_concurrency: t.Optional[int]
+) -> RequestScheduler:
+    """Return the scheduler shared by every client talking to the same provider with
+    the same API key, on the running event loop."""
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    name = f"{provider}:{key_hash}"
+    loop = asyncio.get_running_loop()
+    with _SHARED_SCHEDULERS_LOCK:
+        schedulers = _SHARED_SCHEDULERS.setdefault(loop, {})
+        scheduler = schedulers.get(name)
+        if scheduler is None:
+            scheduler = schedulers[name] = RequestScheduler(max_concurrency)
+        # the most recently configured limit wins
+        scheduler.max_concurrency = _clamp_concurrency(max_concurrency)
+    return scheduler
+
+
+# -----------------------------------------------------------
+# Run context
+# -----------------------------------------------------------
+
+_CURRENT_RUN: contextvars.ContextVar[t.Optional[str]] = contextvars.ContextVar(
+    "uptrain_current_run", default=None
+)
+_RUN_IDS = itertools.count(1)
+
+
+@contextlib.contextmanager
+def run_context(run_id: t.Optional[str] = None):
+    """Share the capacity fairly between the LLM payloads made within the block and
+    those of other runs."""
+    token = _CURRENT_RUN.set(run_id or f"run-{next(_RUN_IDS)}")
+    try:
+        yield
+    finally:
+        _CURRENT_RUN.reset(token)
+
+
+def get_current_run() -> t.Optional[str]:
+    return _CURRENT_RUN.get()
@@ -0,0 +1,238 @@
+"""
+Token counting for LLM payloads. Used to budget requests against the tokens-per-minute
+rate limit before they are sent, and to fit prompts into the context window of a model.
+"""
+
+from __future__ import annotations
+import functools
+import importlib.util
+import math
+import re
+import typing as t
+
+from loguru import logger
+
+__all__ = [
+    "TokenCounter",
+    "HeuristicTokenCounter",
+    "TiktokenCounter",
+    "get_token_counter",
+    "lookup_model_table",
+    "get_context_window",
+    "truncate_prompt",
+]
+
+
+# Tokens consumed by the chat format around each message, and to prime the reply.
+# refer - https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class TokenCounter(t.Protocol):
+    """Counts the prompt tokens of a list of chat messages for a model."""
+
+    def count_text(self, text: str, model: str) -> int:
+        ...
+
+    def count_messages(self, messages: list[dict], model: str) -> int:
+        ...
+
+
+class HeuristicTokenCounter:
+    """Estimates tokens from the number of characters. Average token length is
+    about 4 characters for English text, we use 3 and round up to err on the
+    conservative side.
+    """
+
+    def __init__(self, chars_per_token: float = 3):
+        self.chars_per_token = chars_per_token
+
+    def count_text(self, text: str, model: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def count_messages(self, messages: list[dict], model: str) -> int:
+        num_tokens = TOKENS_PER_REPLY
+        for msg in messages:
+            num_tokens += TOKENS_PER_MESSAGE
+            num_tokens += self.count_text(msg["role"], model)
+            num_tokens += self.count_text(_message_text(msg), model)
+        return num_tokens
+
+
+class TiktokenCounter:
+    """Exact token counts for OpenAI models, using tiktoken. Falls back to the
+    heuristic if the encoding can't be loaded (tiktoken downloads it on first use).
+    """
+
+    def __init__(self, default_encoding: str = "cl100k_base"):
+        self.default_encoding = default_encoding
+        self._fallback = HeuristicTokenCounter()
+
+    @functools.lru_cache(maxsize=32)
+    def _get_encoding(self, model: str):
+        import tiktoken
+
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding(self.default_encoding)
+        except Exception as e:
+            logger.warning(
+                f"Unable to load the tiktoken encoding for {model}, estimating tokens instead: {e}"
+            )
+            return None
+
+    def count_text(self, text: str, model: str) -> int:
+        encoding = self._get_encoding(model)
+        if encoding is None:
+            return self._fallback.count_text(text, model)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages: list[dict], model: str) -> int:
+        num_tokens = TOKENS_PER_REPLY
+        for msg in messages:
+            num_tokens += TOKENS_PER_MESSAGE
+            num_tokens += self.count_text(msg["role"], model)
+            num_tokens += self.count_text(_message_text(msg), model)
+        return num_tokens
+
+
+def _message_text(msg: dict) -> str:
+    content = msg.get("content") or ""
+    if isinstance(content, list):
+        # multi-part content, only text parts count towards the prompt tokens
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+OPENAI_MODEL_PREFIXES = ("gpt", "azure/", "o1", "text-", "ft:gpt")
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_available() -> bool:
+    available = importlib.util.find_spec("tiktoken") is not None
+    if not available:
+        logger.warning(
+            "tiktoken is not installed, falling back to a heuristic for counting tokens. "
+            "Use `pip install tiktoken` for accurate rate limiting with OpenAI models."
+        )
+    return available
+
+
+_HEURISTIC_COUNTER = HeuristicTokenCounter()
+_TIKTOKEN_COUNTER = TiktokenCounter()
+
+
+def get_token_counter(model: str) -> TokenCounter:
+    """Return the token counter best suited to the model: tiktoken for OpenAI models
+    if installed, a character based heuristic otherwise.
+    """
+    if model.startswith(OPENAI_MODEL_PREFIXES) and _tiktoken_available():
+        return _TIKTOKEN_COUNTER
+    return _HEURISTIC_COUNTER
+
+
+# Context windows (prompt + completion tokens) of common models. Looked up by the
+# longest matching prefix of the model name, so dated snapshots share an entry.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16_385,
+    "gpt-3.5-turbo-0613": 4_096,
+    "gpt-3.5-turbo-instruct": 4_096,
+    "gpt-4": 8_192,
+    "gpt-4-32k": 32_768,
+    "gpt-4-turbo": 128_000,
+    "gpt-4-1106": 128_000,
+    "gpt-4-0125": 128_000,
+    "gpt-4o": 128_000,
+    "o1": 128_000,
+    "claude-2": 100_000,
+    "claude-3": 200_000,
+    "mistral/mistral-tiny": 32_000,
+    "mistral/mistral-small": 32_000,
+    "mistral/mistral-medium": 32_000,
+    "mistral/mistral-large": 32_000,
+}
+
+
+def lookup_model_table(table: dict[str, t.Any], model: str) -> t.Any:
+    """Entry of the table for the longest prefix of the model name, ignoring the
+    provider prefix of hosted models. None if no entry matches."""
+    for prefix in ["azure/", "anyscale/", "together/"]:
+        if model.startswith(prefix) and model not in table:
+            model = model[len(prefix) :]
+    matches = [name for name in table if model.startswith(name)]
+    if not matches:
+        return None
+    return table[max(matches, key=len)]
+
+
+def get_context_window(
+    model: str, overrides: t.Optional[dict[str, int]] = None
+) -> t.Optional[int]:
+    """Context window of the model, or None if it isn't known."""
+    return lookup_model_table({**MODEL_CONTEXT_WINDOWS, **(overrides or {})}, model)
+
+
+TRUNCATION_MARKER = " ... [truncated]"
+
+# Task data fields of the prompt templates in `prompts/classic.py`, i.e. `[Context]: ...`
+TASK_DATA_FIELD = re.compile(r"^\[[^\]\n]+\]: ", flags=re.MULTILINE)
+
+
+def _task_data_fields(prompt: str) -> list[str]:
+    """Values of the task data fields at the end of a prompt."""
+    _, marker, task_data = prompt.rpartition("Task Data.")
+    if not marker:
+        return []
+    return [value.strip("\n") for value in TASK_DATA_FIELD.split(task_data)[1:]]
+
+
+def truncate_prompt(
+    prompt: str,
+    max_tokens: int,
+    model: str,
+    token_counter: t.Optional[TokenCounter] = None,
+    variables: t.Optional[t.Sequence[str]] = None,
+) -> t.Optional[str]:
+    """
+    Shorten the longest variable in the prompt so the prompt fits in `max_tokens`.
+
+    Args:
+        prompt (str): The formatted prompt.
+        max_tokens (int): Token budget for the prompt.
+        model (str): Model the prompt is sent to, used for counting tokens.
+        token_counter (TokenCounter): Counter to use, picked for the model if not given.
+        variables (list[str]): Values substituted into the prompt that may be shortened.
+            Defaults to the fields of the task data section of the prompt.
+
+    Returns:
+        The truncated prompt, or None if it can't be made to fit.
+    """
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    excess = token_counter.count_text(prompt, model) - max_tokens
+    if excess <= 0:
+        return prompt
+
+    if variables is None:
+        variables = _task_data_fields(prompt)
+    variables = [value for value in variables if value and value in prompt]
+    if not variables:
+        return None
+    value = max(variables, key=len)
+    value_tokens = token_counter.count_text(value, model)
+    keep_tokens = value_tokens - excess - token_counter.count_text(TRUNCATION_MARKER, model)
+    if keep_tokens <= 0:
+        return None
+
+    # cut proportionally in characters, then tighten in case tokens are unevenly spread
+    keep_chars = int(len(value) * keep_tokens / value_tokens)
+    head, _, tail = prompt.rpartition(value)
+    for _ in range(5):
+        truncated = head + value[:keep_chars] + TRUNCATION_MARKER + tail
+        if token_counter.count_text(truncated, model) <= max_tokens:
+            return truncated
+        keep_chars = int(keep_chars * 0.9)
+    return None
@@ -5,13 +5,13 @@ Implement checks for multi query related operations
 
 from __future__ import annotations
 import typing as t
-import json
 
 from loguru import logger
 import polars as pl
 from uptrain.operators.language.prompts.classic import (
     MULTI_QUERY_ACCURACY_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     MULTI_QUERY_ACCURACY_FEW_SHOT__CLASSIFY,
     MULTI_QUERY_ACCURACY_FEW_SHOT__COT,
@@ -29,6 +29,7 @@ if t.TYPE_CHECKING:
 from uptrain.operators.base import register_op, ColumnOp, TYPE_TABLE_OUTPUT
 from uptrain.utilities import polars_to_json_serializable_dict
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
 
 
 @register_op
@@ -144,20 +145,25 @@ class MultiQueryAccuracy(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = (
-                    MULTI_QUERY_ACCURACY_PROMPT_TEMPLATE.replace(
-                        "{scenario_description}", self.scenario_description
-                    ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    MULTI_QUERY_ACCURACY_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
                 )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -169,7 +175,7 @@ class MultiQueryAccuracy(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_multi_query_accuracy"] = float(score)
                 output["explanation_multi_query_accuracy"] = res.response.choices[
@@ -0,0 +1,74 @@
+"""
+Layout of the grading prompts into chat messages.
+
+The templates in `classic.py` put the static instructions, few-shot examples and
+output format first and the task data of the row last. With the "classic" layout the
+whole template is sent as a single user message, with the scenario description in
+the middle of the instructions. The "cacheable" layout sends everything before the
+task data as a system message, which is the same for every row evaluated with the
+same settings - so providers that discount repeated prompt prefixes only bill it
+in full once - and moves the scenario description into the user message, next to
+the task data.
+"""
+
+from __future__ import annotations
+import re
+import typing as t
+
+__all__ = ["PROMPT_LAYOUTS", "split_template", "render_prompt"]
+
+
+PROMPT_LAYOUTS = ("classic", "cacheable")
+
+# the heading of the task data section, e.g. "Task Data." or "Task data:"
+_TASK_DATA_HEADING = re.compile(r"^Task data[.:]?[ \t]*$", re.IGNORECASE | re.MULTILINE)
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def split_template(template: str) -> t.Optional[tuple[str, str]]:
+    """Split a template into the instructions and the task data section, None if it
+    has no task data heading."""
+    matches = list(_TASK_DATA_HEADING.finditer(template))
+    if not matches:
+        return None
+    start = matches[-1].start()
+    return template[:start], template[start:]
+
+
+def render_prompt(
+    template: str,
+    kwargs: dict,
+    scenario_description: t.Optional[str] = None,
+    layout: str = "classic",
+) -> tuple[t.Optional[str], str]:
+    """
+    Fill in a grading prompt template.
+
+    Args:
+        template (str): Prompt template, from `classic.py`.
+        kwargs (dict): Values of the fields of the template - the row and the few-shot
+            examples, output format and prompting instructions.
+        scenario_description (str): Scenario description, which may itself refer to fields
+            of the row.
+        layout (str): One of "classic" or "cacheable".
+
+    Returns:
+        The system prompt (None for the classic layout) and the user prompt.
+    """
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(
+            f"Unknown prompt layout {layout}, expected one of {PROMPT_LAYOUTS}"
+        )
+    scenario_description = scenario_description or ""
+    parts = split_template(template) if layout == "cacheable" else None
+    if parts is None:
+        prompt = template.replace("{scenario_description}", scenario_description)
+        return None, prompt.format(**kwargs)
+
+    instructions, task_data = parts
+    instructions = _BLANK_LINES.sub(
+        "\n\n", instructions.replace("{scenario_description}", "")
+    )
+    if scenario_description.strip():
+        task_data = scenario_description.strip() + "\n\n" + task_data
+    return instructions.strip().format(**kwargs), task_data.format(**kwargs)
@@ -7,7 +7,6 @@ import typing as t
 
 from loguru import logger
 import polars as pl
-import json
 
 from uptrain.utilities.prompt_utils import parse_scenario_description
 
@@ -21,6 +20,7 @@ from uptrain.operators.language.llm import LLMMulticlient
 from uptrain.operators.language.prompts.classic import (
     QUERY_REWRITE_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.instructions import CLASSIFY
 from uptrain.operators.language.prompts.output_format import (
     QUERY_REWRITE_OUTPUT_FORMAT__CLASSIFY,
@@ -161,17 +161,20 @@ class QueryRewrite(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = (
-                    QUERY_REWRITE_PROMPT_TEMPLATE.replace(
-                        "{scenario_description}", self.scenario_description
-                    ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    QUERY_REWRITE_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
                 )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
             input_payloads, validation_func
@@ -184,7 +187,7 @@ class QueryRewrite(ColumnOp):
                 "revised_question": None,
             }
             try:
-                revised_question = json.loads(res.response.choices[0].message.content)["Question"]
+                revised_question = res.parsed_output()["Question"]
                 output["revised_question"] = revised_question
             except Exception:
                 logger.error(
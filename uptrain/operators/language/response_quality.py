@@ -4,7 +4,6 @@ Implement operaores to evaluate response quality i.e. quality of the generated r
 
 from __future__ import annotations
 import typing as t
-import json
 import copy
 
 from loguru import logger
@@ -18,6 +17,12 @@ if t.TYPE_CHECKING:
 from uptrain.operators.base import register_op, ColumnOp, TYPE_TABLE_OUTPUT
 from uptrain.utilities import polars_to_json_serializable_dict
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_cascade import mapped_score
+from uptrain.operators.language.llm_memo import run_memoized
+from uptrain.operators.language.llm_packing import (
+    fetch_packed_responses,
+    use_packed_requests,
+)
 from uptrain.operators.language.factual_accuracy import ResponseFactualScore
 from uptrain.operators.language.rouge import RougeScore
 from uptrain.framework import Settings
@@ -28,6 +33,7 @@ from uptrain.operators.language.prompts.classic import (
     RESPONSE_CONSISTENCY_PROMPT_TEMPLATE,
     VALID_RESPONSE_PROMPT_TEMPLATE,
 )
+from uptrain.operators.language.prompts.layout import render_prompt
 from uptrain.operators.language.prompts.few_shots import (
     RESPONSE_COMPLETENESS_FEW_SHOT__CLASSIFY,
     RESPONSE_COMPLETENESS_FEW_SHOT__COT,
@@ -164,18 +170,25 @@ class ResponseCompleteness(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = RESPONSE_COMPLETENESS_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    RESPONSE_COMPLETENESS_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -187,7 +200,7 @@ class ResponseCompleteness(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_response_completeness"] = float(score)
                 output["explanation_response_completeness"] = res.response.choices[
@@ -316,18 +329,25 @@ class ResponseConciseness(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = RESPONSE_CONCISENESS_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    RESPONSE_CONCISENESS_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
+            input_payloads,
+            validation_func,
+            score_func=mapped_score(self.score_mapping),
         )
 
         results = []
@@ -339,7 +359,7 @@ class ResponseConciseness(ColumnOp):
             }
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_response_conciseness"] = float(score)
                 output["explanation_response_conciseness"] = res.response.choices[
@@ -465,15 +485,20 @@ class ResponseConsistency(ColumnOp):
                 }
             )
             try:
-                grading_prompt_template = RESPONSE_CONSISTENCY_PROMPT_TEMPLATE.replace(
-                    "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
+                system_prompt, grading_prompt_template = render_prompt(
+                    RESPONSE_CONSISTENCY_PROMPT_TEMPLATE,
+                    kwargs,
+                    self.scenario_description,
+                    self.settings.prompt_layout,
+                )
             except KeyError as e:
                 raise KeyError(
                     f"Missing required attribute(s) for scenario description: {e}"
                 )
             input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+                self._api_client.make_payload(
+                    idx, grading_prompt_template, system_prompt=system_prompt
+                )
             )
         output_payloads = self._api_client.fetch_responses(
             input_payloads, validation_func
@@ -487,7 +512,7 @@ class ResponseConsistency(ColumnOp):
                 "explanation_response_consistency": None,
             }
             try:
-                parsed_output = json.loads(res.response.choices[0].message.content)
+                parsed_output = res.parsed_output()
                 score = parsed_output["Score"]
                 output["score_response_consistency"] = float(score)
                 output["explanation_response_consistency"] = parsed_output["Argument"]
@@ -603,29 +628,48 @@ class ValidResponseScore(ColumnOp):
                 f"Invalid eval_type: {self.settings.eval_type}. Must be either 'basic' or 'cot'"
             )
 
-        for idx, row in enumerate(data):
-            kwargs = row
-            kwargs.update(
-                {
-                    "output_format": output_format,
-                    "prompting_instructions": prompting_instructions,
-                    "few_shot_examples": few_shot_examples,
-                }
-            )
-            try:
-                grading_prompt_template = VALID_RESPONSE_PROMPT_TEMPLATE.replace(
+        prompt_kwargs = {
+            "output_format": output_format,
+            "prompting_instructions": prompting_instructions,
+            "few_shot_examples": few_shot_examples,
+        }
+        if use_packed_requests(self.settings, scenario_vars):
+            output_payloads = fetch_packed_responses(
+                self._api_client,
+                VALID_RESPONSE_PROMPT_TEMPLATE.replace(
                     "{scenario_description}", self.scenario_description
-                ).format(**kwargs)
-            except KeyError as e:
-                raise KeyError(
-                    f"Missing required attribute(s) for scenario description: {e}"
+                ),
+                data,
+                prompt_kwargs,
+                validation_func,
+                rows_per_request=self.settings.rows_per_request,
+                prompt_layout=self.settings.prompt_layout,
+            )
+        else:
+            for idx, row in enumerate(data):
+                kwargs = row
+                kwargs.update(prompt_kwargs)
+                try:
+                    system_prompt, grading_prompt_template = render_prompt(
+                        VALID_RESPONSE_PROMPT_TEMPLATE,
+                        kwargs,
+                        self.scenario_description,
+                        self.settings.prompt_layout,
+                    )
+                except KeyError as e:
+                    raise KeyError(
+                        f"Missing required attribute(s) for scenario description: {e}"
+                    )
+                input_payloads.append(
+                    self._api_client.make_payload(
+                        idx, grading_prompt_template, system_prompt=system_prompt
+                    )
                 )
-            input_payloads.append(
-                self._api_client.make_payload(idx, grading_prompt_template)
+            output_payloads = self._api_client.fetch_responses(
+                input_payloads,
+                validation_func,
+                score_func=mapped_score(self.score_mapping),
             )
-        output_payloads = self._api_client.fetch_responses(
-            input_payloads, validation_func
-        )
 
         results = []
 
@@ -634,7 +678,7 @@ class ValidResponseScore(ColumnOp):
             output = {"score_valid_response": None, "explanation_valid_response": None}
             try:
                 score = self.score_mapping[
-                    json.loads(res.response.choices[0].message.content)["Choice"]
+                    res.parsed_output()["Choice"]
                 ]
                 output["score_valid_response"] = float(score)
                 output["explanation_valid_response"] = res.response.choices[
@@ -732,22 +776,18 @@ class ResponseRelevance(ColumnOp):
             col_response=self.col_response,
             scenario_description=self.scenario_description,
         )
-        output_completeness = (
-            response_completeness.setup(settings=self.settings)
-            .run(pl.DataFrame(data))["output"]
-            .to_dicts()
-        )
+        output_completeness = run_memoized(
+            response_completeness.setup(settings=self.settings), pl.DataFrame(data)
+        )["output"].to_dicts()
 
         response_conciseness = ResponseConciseness(
             col_response=self.col_response,
             scenario_description=self.scenario_description,
         )
 
-        output_conciseness = (
-            response_conciseness.setup(settings=self.settings)
-            .run(pl.DataFrame(data))["output"]
-            .to_dicts()
-        )
+        output_conciseness = run_memoized(
+            response_conciseness.setup(settings=self.settings), pl.DataFrame(data)
+        )["output"].to_dicts()
 
         results = []
         for combined_row in zip(output_conciseness, output_completeness):
@@ -909,17 +949,15 @@ class ResponseMatchingScore(ColumnOp):
                 [data_precision, data_recall.select(data_precision.columns)]
             )
 
-            output = (
+            output = run_memoized(
                 ResponseFactualScore(
                     col_question=self.col_question,
                     col_response="response",
                     col_context="context",
                     scenario_description=self.scenario_description,
-                )
-                .setup(settings=self.settings)
-                .run(eval_data)["output"]
-                .to_dicts()
-            )
+                ).setup(settings=self.settings),
+                eval_data,
+            )["output"].to_dicts()
             output_precision = output[0 : len(data)]
             output_recall = output[len(data) :]
 
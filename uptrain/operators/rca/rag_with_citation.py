@@ -21,6 +21,7 @@ from uptrain.operators.base import (
 from uptrain import RcaTemplate
 from uptrain.utilities import polars_to_json_serializable_dict
 from uptrain.operators.language.llm import LLMMulticlient
+from uptrain.operators.language.llm_memo import run_memoized
 from uptrain.operators import (
     ValidQuestionScore,
     ResponseFactualScore,
@@ -97,35 +98,29 @@ class RagWithCitation(ColumnOp):
         return {"output": data.with_columns(pl.from_dicts(results))}
 
     def evaluate_local(self, data):
-        question_valid_scores = (
-            ValidQuestionScore(col_question="question")
-            .setup(settings=self.settings)
-            .run(pl.DataFrame(data))["output"]
-            .to_dicts()
-        )
-
-        response_valid_scores = (
-            ValidResponseScore(col_response="response")
-            .setup(settings=self.settings)
-            .run(pl.DataFrame(data))["output"]
-            .to_dicts()
-        )
-
-        context_relevance_scores = (
-            ContextRelevance(col_question="question", col_context="context")
-            .setup(settings=self.settings)
-            .run(pl.DataFrame(data))["output"]
-            .to_dicts()
-        )
-
-        factual_accuracy_scores = (
+        question_valid_scores = run_memoized(
+            ValidQuestionScore(col_question="question").setup(settings=self.settings),
+            pl.DataFrame(data),
+        )["output"].to_dicts()
+
+        response_valid_scores = run_memoized(
+            ValidResponseScore(col_response="response").setup(settings=self.settings),
+            pl.DataFrame(data),
+        )["output"].to_dicts()
+
+        context_relevance_scores = run_memoized(
+            ContextRelevance(col_question="question", col_context="context").setup(
+                settings=self.settings
+            ),
+            pl.DataFrame(data),
+        )["output"].to_dicts()
+
+        factual_accuracy_scores = run_memoized(
             ResponseFactualScore(
                 col_question="question", col_context="context", col_response="response"
-            )
-            .setup(settings=self.settings)
-            .run(pl.DataFrame(data))["output"]
-            .to_dicts()
-        )
+            ).setup(settings=self.settings),
+            pl.DataFrame(data),
+        )["output"].to_dicts()
 
         data_cited = (
             copy.deepcopy(pl.DataFrame(data))
@@ -133,21 +128,19 @@ class RagWithCitation(ColumnOp):
             .rename({"cited_context": "context"})
         )
 
-        cited_context_relevance_scores = (
-            ContextRelevance(col_question="question", col_context="context")
-            .setup(settings=self.settings)
-            .run(data_cited)["output"]
-            .to_dicts()
-        )
+        cited_context_relevance_scores = run_memoized(
+            ContextRelevance(col_question="question", col_context="context").setup(
+                settings=self.settings
+            ),
+            data_cited,
+        )["output"].to_dicts()
 
-        cited_factual_accuracy_scores = (
+        cited_factual_accuracy_scores = run_memoized(
             ResponseFactualScore(
                 col_question="question", col_context="context", col_response="response"
-            )
-            .setup(settings=self.settings)
-            .run(data_cited)["output"]
-            .to_dicts()
-        )
+            ).setup(settings=self.settings),
+            data_cited,
+        )["output"].to_dicts()
 
         results = []
 
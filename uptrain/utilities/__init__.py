@@ -1,4 +1,6 @@
 from __future__ import annotations
+import asyncio
+import atexit
 from datetime import datetime, timedelta, tzinfo
 import dataclasses
 import importlib
@@ -6,6 +8,7 @@ import importlib.util
 import json
 import typing as t
 import os
+import threading
 import time
 
 from lazy_loader import load as _lazy_load
@@ -201,14 +204,17 @@ def polars_to_pandas(data: pl.DataFrame):
 # -----------------------------------------------------------
 
 
-def clear_directory(dir_path: str):
+def clear_directory(dir_path: str, keep: t.Optional[t.Container[str]] = None):
     """Clears the directory at dir_path but without deleting the directory itself. `shutil.rmtree` will
-    have difficulties with mounted volumes or network drives.
+    have difficulties with mounted volumes or network drives. Files whose paths are in `keep` are left.
     """
     import shutil
 
+    keep = {os.path.abspath(fpath) for fpath in keep} if keep else set()
     for filename in os.listdir(dir_path):
         file_path = os.path.join(dir_path, filename)
+        if os.path.abspath(file_path) in keep:
+            continue
         if os.path.isfile(file_path) or os.path.islink(file_path):
             os.unlink(file_path)
         elif os.path.isdir(file_path):
@@ -266,6 +272,98 @@ class Timer:
         self.time = round(time.perf_counter() - self.time, 3)
 
 
+# -----------------------------------------------------------
+# routines to run coroutines from synchronous code
+# -----------------------------------------------------------
+
+
+class BackgroundEventLoop:
+    """An event loop running forever in a daemon thread. Synchronous code submits
+    coroutines to it instead of calling `asyncio.run` each time, so that state bound
+    to the loop (like HTTP connection pools) survives across calls.
+
+    A forked child doesn't inherit the thread running the loop, so it starts a loop of
+    its own on first use.
+    """
+
+    def __init__(self, name: str = "uptrain-event-loop"):
+        self.name = name
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._thread: t.Optional[threading.Thread] = None
+        self._pid: t.Optional[int] = None
+        self._lock = threading.Lock()
+        self._shutdown_hooks: list[t.Callable[[], t.Awaitable]] = []
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The event loop, started on first access."""
+        if self._pid is not None and self._pid != os.getpid():
+            self._forget()
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name=self.name, daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+            return self._loop
+
+    def _forget(self) -> None:
+        """Drop the loop inherited from the parent process, nothing runs it in the child.
+        The lock may have been held by another thread of the parent, so it's reset too."""
+        self._lock = threading.Lock()
+        self._loop, self._thread, self._pid = None, None, None
+
+    def is_current(self) -> bool:
+        """Whether the caller is running inside this event loop."""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def run(self, coro: t.Coroutine, timeout: t.Optional[float] = None) -> t.Any:
+        """Run the coroutine on the background loop and block until it completes."""
+        if self.is_current():
+            coro.close()
+            raise RuntimeError(
+                "Can't block on the background event loop from within itself, await the coroutine instead."
+            )
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result(timeout)
+
+    def on_shutdown(self, hook: t.Callable[[], t.Awaitable]) -> None:
+        """Await `hook()` on the loop before it stops, to release what is bound to it."""
+        self._shutdown_hooks.append(hook)
+
+    def shutdown(self) -> None:
+        if self._pid is not None and self._pid != os.getpid():
+            self._forget()
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                return
+            if self._loop.is_running() and not self.is_current():
+                for hook in self._shutdown_hooks:
+                    try:
+                        asyncio.run_coroutine_threadsafe(hook(), self._loop).result(5)
+                    except Exception as exc:
+                        logger.warning(f"Error when shutting down the background event loop: {exc}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            if self._thread is not None:
+                self._thread.join(timeout=5)
+            if not self._loop.is_running():
+                self._loop.close()
+            self._loop, self._thread = None, None
+
+
+_BACKGROUND_LOOP = BackgroundEventLoop()
+atexit.register(_BACKGROUND_LOOP.shutdown)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_BACKGROUND_LOOP._forget)
+
+
+def get_background_loop() -> BackgroundEventLoop:
+    """The background event loop shared by the whole process."""
+    return _BACKGROUND_LOOP
+
+
 # -----------------------------------------------------------
 # routines to deal with optional dependencies
 # -----------------------------------------------------------
@@ -280,7 +378,10 @@ def lazy_load_dep(import_name: str, package_name: str):
     try:
         spec = importlib.util.find_spec(import_name)
     except Exception:
+        # the parent package of the submodule is missing, loading the submodule would
+        # raise right away - the package is loaded instead, to raise when used
         spec = None
+        import_name = import_name.split(".")[0]
     if spec is None:
         logger.warning(
             f"Optional feature dependent on missing package: {import_name} was initialized.\n"